@@ -1,3 +1,23 @@
-from .gmx_optim_component import OptimGmxComponent
+import importlib
 
 __all__ = ["OptimGmxComponent"]
+
+# Components are imported on first access so that importing the
+# package does not load mmic_optim, mmelemental and the translators
+_components = {
+    "OptimGmxComponent": ".gmx_optim_component",
+    "PrepGmxComponent": ".gmx_prep_component",
+    "ComputeGmxComponent": ".gmx_compute_component",
+    "PostGmxComponent": ".gmx_post_component",
+}
+
+
+def __getattr__(name):
+    if name in _components:
+        module = importlib.import_module(_components[name], __name__)
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_components))
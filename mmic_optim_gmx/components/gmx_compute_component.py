@@ -1,29 +1,51 @@
 # Import models
-from ..models import InputComputeGmx, OutputComputeGmx
 from cmselemental.util.decorators import classproperty
 
 # Import components
-from mmic_cmd.components import CmdComponent
 from mmic.components.blueprints import GenericComponent
 
-from typing import Dict, Any, List, Tuple, Optional
+from typing import Dict, Any, List, Tuple, Optional, Union, TYPE_CHECKING
 from pathlib import Path
 import os
 import shutil
-import tempfile
 import ntpath
+import time
 
+from ..util.checkpoint import Checkpoint
+from ..util.cmd import run_gmx, time_limit
+from ..util.errors import GmxError, GmxTimeoutError
+from ..util.gmx import probe_gmx
+from ..util.gro import write_gro_coordinates
+from ..util.tpr import TprCache, tpr_key
+from ..util.workspace import Workspace, new_file
+from .gmx_prep_component import PrepGmxComponent
+
+# Models are imported on first use to keep the import cheap
+if TYPE_CHECKING:
+    from ..models import InputOptimGmx, InputComputeGmx, OutputComputeGmx
 
 __all__ = ["ComputeGmxComponent"]
 
+# Output files of each job of a -multidir batch, in the order of parse_output
+_multidir_files = {
+    "-o": "traj.trr",
+    "-c": "confout.gro",
+    "-e": "ener.edr",
+    "-g": "md.log",
+}
+
 
 class ComputeGmxComponent(GenericComponent):
     @classproperty
     def input(cls):
+        from ..models import InputComputeGmx
+
         return InputComputeGmx
 
     @classproperty
     def output(cls):
+        from ..models import OutputComputeGmx
+
         return OutputComputeGmx
 
     @classproperty
@@ -38,47 +60,455 @@ class ComputeGmxComponent(GenericComponent):
 
     def execute(
         self,
-        inputs: InputComputeGmx,
+        inputs: "InputComputeGmx",
         extra_outfiles: Optional[List[str]] = None,
         extra_commands: Optional[List[str]] = None,
         scratch_name: Optional[str] = None,
         timeout: Optional[int] = None,
-    ) -> Tuple[bool, OutputComputeGmx]:
+    ) -> Tuple[bool, "OutputComputeGmx"]:
 
         # Call gmx pdb2gmx, mdrun, etc. here
         if isinstance(inputs, dict):
             inputs = self.input(**inputs)
 
-        proc_input, mdp_file, gro_file, top_file = (
+        proc_input = inputs.proc_input
+        deadline = time.time() + timeout if timeout is not None else None
+
+        checkpoint = None
+        if proc_input.checkpoint_dir:
+            checkpoint = Checkpoint(proc_input.checkpoint_dir, inputs.stage)
+            if checkpoint.done():
+                return True, self.skip_stage(inputs, checkpoint)
+            self.resume(inputs, checkpoint)
+
+        tpr_file, grompp_scratch_dir = self.run_grompp(inputs, deadline)
+        return True, self.run_mdrun(
+            inputs, tpr_file, grompp_scratch_dir, checkpoint, deadline
+        )
+
+    def run_grompp(
+        self, inputs: "InputComputeGmx", deadline: Optional[float] = None
+    ) -> Tuple[str, Optional[str]]:
+        """
+        Runs grompp and removes the input files no longer needed. Returns
+        the .tpr file and the scratch directory of grompp. If
+        proc_input.tpr_cache is set and a .tpr of the same inputs was cached,
+        grompp is skipped.
+        """
+        proc_input, gro_file, top_file = (
             inputs.proc_input,
-            inputs.mdp_file,
             inputs.molecule,
             inputs.forcefield,
-        )  # The parameters here are all str
-
-        tpr_file = tempfile.NamedTemporaryFile(suffix=".tpr").name  # , delete=False)
+        )
+        tpr_file = new_file(".tpr", proc_input.work_dir)
 
         input_model = {
             "proc_input": proc_input,
-            "mdp_file": mdp_file,
+            "mdp_file": inputs.mdp_file,
             "gro_file": gro_file,
             "top_file": top_file,
             "tpr_file": tpr_file,
+            "index_file": inputs.index_file,
+            "reference_file": inputs.reference_file,
         }
 
         clean_files, cmd_input_grompp = self.build_input_grompp(input_model)
-        rvalue = CmdComponent.compute(cmd_input_grompp)
-        grompp_scratch_dir = [str(rvalue.scratch_directory)]
+
+        cache = None
+        if proc_input.tpr_cache:
+            cache = TprCache(proc_input.tpr_cache)
+            key, nsteps = tpr_key(
+                inputs.mdp_file,
+                [gro_file, top_file, inputs.index_file, inputs.reference_file],
+                extra=f"{proc_input.maxwarn} {probe_gmx(proc_input.engine).get('version')}",
+            )
+            reused, scratch_dir = self.reuse_tpr(
+                cache, key, nsteps, tpr_file, proc_input, deadline
+            )
+            if reused:
+                return self._grompp_done(inputs, clean_files, tpr_file, scratch_dir)
+
+        try:
+            rvalue = run_gmx(
+                "grompp", cmd_input_grompp, timeout=time_limit(proc_input, deadline)
+            )
+        except GmxError:
+            # Abort the whole pipeline, nothing of this job is reused
+            self.cleanup(clean_files + [top_file, gro_file, tpr_file])
+            self.cleanup([inputs.scratch_dir])
+            raise
+        if cache is not None:
+            cache.put(key, nsteps, tpr_file)
+
+        return self._grompp_done(
+            inputs, clean_files, tpr_file, str(rvalue.scratch_directory)
+        )
+
+    def _grompp_done(
+        self,
+        inputs: "InputComputeGmx",
+        clean_files: List[str],
+        tpr_file: str,
+        scratch_dir: Optional[str],
+    ) -> Tuple[str, Optional[str]]:
+        if inputs.keep_forcefield:
+            clean_files = [inputs.mdp_file]
         self.cleanup(clean_files)  # Del mdp and top file in the working dir
         self.cleanup([inputs.scratch_dir])
+        return tpr_file, scratch_dir
+
+    def reuse_tpr(
+        self,
+        cache: TprCache,
+        key: str,
+        nsteps: Optional[int],
+        tpr_file: str,
+        proc_input: "InputOptimGmx",
+        deadline: Optional[float] = None,
+    ) -> Tuple[bool, Optional[str]]:
+        """
+        Writes tpr_file from a cached .tpr of the same inputs, copied as is
+        if nsteps matches and patched with gmx convert-tpr otherwise. Returns
+        whether a cached .tpr was used and the scratch directory of convert-tpr.
+        """
+        cached, exact = cache.get(key, nsteps)
+        if cached is None or (not exact and nsteps is None):
+            return False, None
+        if exact:
+            shutil.copyfile(cached, tpr_file)
+            return True, None
+
+        cmd_input = self.build_input_convert_tpr(cached, tpr_file, nsteps, proc_input)
+        try:
+            rvalue = run_gmx(
+                "convert-tpr", cmd_input, timeout=time_limit(proc_input, deadline)
+            )
+        except GmxTimeoutError:
+            raise
+        except GmxError:
+            return False, None  # grompp it is
+        cache.put(key, nsteps, tpr_file)
+        return True, str(rvalue.scratch_directory)
+
+    def build_input_convert_tpr(
+        self,
+        cached_file: str,
+        tpr_file: str,
+        nsteps: int,
+        proc_input: "InputOptimGmx",
+    ) -> Dict[str, Any]:
+        """
+        Build the input for convert-tpr
+        """
+        env = os.environ.copy()
+        env["GMX_MAXBACKUP"] = "-1"
+        cmd = [
+            proc_input.engine,
+            "convert-tpr",
+            "-s",
+            cached_file,
+            "-nsteps",
+            str(nsteps),
+            "-o",
+            tpr_file,
+        ]
+        return {
+            "command": cmd,
+            "as_binary": [tpr_file],
+            "infiles": [cached_file],
+            "outfiles": [tpr_file],
+            "outfiles_track": [tpr_file],
+            "scratch_directory": proc_input.work_dir,
+            "environment": env,
+            "scratch_messy": True,
+        }
 
-        input_model = {"proc_input": proc_input, "tpr_file": tpr_file}
+    def run_mdrun(
+        self,
+        inputs: "InputComputeGmx",
+        tpr_file: str,
+        grompp_scratch_dir: Optional[str],
+        checkpoint: Optional[Checkpoint] = None,
+        deadline: Optional[float] = None,
+    ) -> "OutputComputeGmx":
+        """Runs mdrun on the .tpr file written by run_grompp."""
+        proc_input = inputs.proc_input
+        input_model = {
+            "proc_input": proc_input,
+            "tpr_file": tpr_file,
+            "trr_file": checkpoint.trajectory if checkpoint else None,
+        }
         cmd_input_mdrun = self.build_input_mdrun(input_model)
-        rvalue = CmdComponent.compute(cmd_input_mdrun)
-        self.cleanup([tpr_file, gro_file])
-        self.cleanup(grompp_scratch_dir)
+        try:
+            rvalue = run_gmx(
+                "mdrun", cmd_input_mdrun, timeout=time_limit(proc_input, deadline)
+            )
+        except GmxError:
+            # The checkpoint is kept for a rerun
+            self.cleanup(
+                [
+                    path
+                    for path in cmd_input_mdrun["outfiles"]
+                    if not checkpoint or path != checkpoint.trajectory
+                ]
+            )
+            raise
+        finally:
+            self.cleanup([tpr_file, inputs.molecule])
+            if grompp_scratch_dir:
+                self.cleanup([grompp_scratch_dir])
+
+        output = self.parse_output(rvalue.dict(), proc_input)
+        if checkpoint:
+            checkpoint.finish(output.molecule)
+        return output
+
+    @classmethod
+    def compute_batch(
+        cls,
+        inputs: List["InputComputeGmx"],
+        engine: str = "gmx_mpi",
+        launcher: Optional[List[str]] = None,
+        return_errors: bool = False,
+        timeout: Optional[float] = None,
+    ) -> List[Union["OutputComputeGmx", GmxError]]:
+        """
+        Minimizes several prepared jobs with a single ``mdrun -multidir``
+        launch, sharing the start-up cost of mdrun between them. Meant for
+        many small systems e.g. single ligands or waters.
+
+        Parameters
+        ----------
+        inputs : List[InputComputeGmx]
+            The prepared jobs, e.g. outputs of PrepGmxComponent.
+        engine : str
+            MPI enabled gmx executable.
+        launcher : List[str], Optional
+            MPI launcher command, mpirun with one rank per job by default.
+            An empty list runs the engine directly e.g. a thread-MPI gmx.
+        return_errors : bool
+            If True, the error of a failed job is returned in place of its
+            output instead of being raised.
+        timeout : float, Optional
+            Max run time of the batch in seconds.
 
-        return True, self.parse_output(rvalue.dict(), proc_input)
+        Returns
+        -------
+        List[OutputComputeGmx]
+            The outputs of the jobs, in the order of inputs. If the batch
+            launch fails, e.g. because one system blew up, the jobs are rerun
+            one by one so that only the failing ones fail. Jobs with different
+            engines or mdrun keywords cannot share a launch and are run one
+            by one.
+        """
+        program = cls(
+            name=cls.__name__,
+            scratch=False,
+            thread_safe=False,
+            thread_parallel=False,
+            node_parallel=False,
+            managed_memory=False,
+            extras=None,
+        )
+        inputs = [cls.input(**job) if isinstance(job, dict) else job for job in inputs]
+        if any(job.proc_input.checkpoint_dir for job in inputs):
+            raise ValueError("Jobs with a checkpoint_dir cannot be run in a batch.")
+        deadline = time.time() + timeout if timeout is not None else None
+
+        results, prepared = [None] * len(inputs), {}
+
+        def discard():
+            for i, (tpr_file, grompp_scratch_dir) in prepared.items():
+                cls.cleanup(
+                    [
+                        path
+                        for path in (tpr_file, inputs[i].molecule, grompp_scratch_dir)
+                        if path
+                    ]
+                )
+
+        for i, job in enumerate(inputs):
+            try:
+                prepared[i] = program.run_grompp(job, deadline)
+            except GmxError as e:
+                if not return_errors:
+                    discard()
+                    raise
+                results[i] = e
+
+        if not prepared:
+            return results
+
+        def run_separately():
+            for i in list(prepared):
+                tpr_file, grompp_scratch_dir = prepared.pop(i)
+                try:
+                    results[i] = program.run_mdrun(
+                        inputs[i], tpr_file, grompp_scratch_dir, deadline=deadline
+                    )
+                except GmxError as e:
+                    if not return_errors:
+                        discard()
+                        raise
+                    results[i] = e
+            return results
+
+        # mdrun -multidir takes one set of options for the whole batch
+        first = inputs[next(iter(prepared))].proc_input
+        if any(
+            inputs[i].proc_input.engine != first.engine
+            or (inputs[i].proc_input.keywords or {}) != (first.keywords or {})
+            for i in prepared
+        ):
+            return run_separately()
+
+        try:
+            outputs = program.run_multidir(
+                [inputs[i] for i in prepared],
+                [tpr_file for tpr_file, _ in prepared.values()],
+                engine,
+                launcher,
+                deadline,
+            )
+        except GmxTimeoutError:
+            discard()
+            raise
+        except GmxError:
+            # All the ranks stop with the first failing job, which is found
+            # by running the jobs separately
+            return run_separately()
+
+        for i, output in zip(prepared, outputs):
+            results[i] = output
+        discard()
+        return results
+
+    def run_multidir(
+        self,
+        inputs: List["InputComputeGmx"],
+        tpr_files: List[str],
+        engine: str = "gmx_mpi",
+        launcher: Optional[List[str]] = None,
+        deadline: Optional[float] = None,
+    ) -> List["OutputComputeGmx"]:
+        """
+        Runs ``mdrun -multidir`` on the .tpr files, one subdirectory per job,
+        and moves the output files of each job to its work_dir. The .tpr
+        files are left untouched.
+        """
+        with Workspace() as batch_dir:
+            job_dirs = []
+            for i, tpr_file in enumerate(tpr_files):
+                job_dir = os.path.join(batch_dir, f"job{i}")
+                os.mkdir(job_dir)
+                os.symlink(tpr_file, os.path.join(job_dir, "topol.tpr"))
+                job_dirs.append(job_dir)
+
+            if launcher is None:
+                launcher = ["mpirun", "-np", str(len(job_dirs))]
+            cmd = [
+                *launcher,
+                engine,
+                "mdrun",
+                "-multidir",
+                *job_dirs,
+                "-s",
+                "topol.tpr",
+            ]
+            for flag, fname in _multidir_files.items():
+                cmd.extend([flag, fname])
+            # mdrun options must be the same for the whole batch
+            for key, val in (inputs[0].proc_input.keywords or {}).items():
+                cmd.extend([key, val] if val else [key])
+
+            outfiles = [
+                os.path.join(job_dir, fname)
+                for job_dir in job_dirs
+                for fname in _multidir_files.values()
+            ]
+            env = os.environ.copy()
+            env["GMX_MAXBACKUP"] = "-1"
+            cmd_input = {
+                "command": cmd,
+                "as_binary": [
+                    path for path in outfiles if path.endswith((".trr", ".edr"))
+                ],
+                "infiles": [],
+                "outfiles": outfiles,
+                "outfiles_track": outfiles,
+                "scratch_directory": batch_dir,
+                "environment": env,
+                "scratch_messy": True,
+            }
+
+            limits = [time_limit(job.proc_input, deadline) for job in inputs]
+            limits = [limit for limit in limits if limit is not None]
+            rvalue = run_gmx(
+                "mdrun", cmd_input, timeout=min(limits) if limits else None
+            )
+            self.cleanup([str(rvalue.scratch_directory)])
+
+            outputs = []
+            for job, job_dir in zip(inputs, job_dirs):
+                outfiles = {}
+                for fname in _multidir_files.values():
+                    path = new_file(os.path.splitext(fname)[1], job.proc_input.work_dir)
+                    shutil.move(os.path.join(job_dir, fname), path)
+                    outfiles[path] = None
+                outputs.append(
+                    self.parse_output(
+                        {"outfiles": outfiles, "scratch_directory": job_dir},
+                        job.proc_input,
+                    )
+                )
+
+        return outputs
+
+    @staticmethod
+    def resume(inputs: "InputComputeGmx", checkpoint: Checkpoint):
+        """
+        Restarts the stage from its checkpoint, if any. The last complete
+        frame of the checkpoint .trr (or the coordinates of the previous
+        restart) are written to inputs.molecule and the steps already run
+        are removed from nsteps in inputs.mdp_file.
+        """
+        frame = checkpoint.last_frame()
+        steps = checkpoint.steps_done()
+        if frame is not None:
+            step, coords, box = frame
+            steps += step
+            write_gro_coordinates(inputs.molecule, inputs.molecule, coords, box)
+            checkpoint.restart(inputs.molecule, steps)
+        elif os.path.isfile(checkpoint.start):
+            shutil.copyfile(checkpoint.start, inputs.molecule)
+        else:
+            return
+
+        proc_input = inputs.proc_input
+        mdp = PrepGmxComponent.build_mdp(proc_input, proc_input.stages()[inputs.stage])
+        if mdp.nsteps >= 0:
+            mdp = mdp.copy(update={"nsteps": max(mdp.nsteps - steps, 0)})
+        with open(inputs.mdp_file, "w") as fp:
+            fp.write(mdp.to_mdp())
+
+    def skip_stage(
+        self, inputs: "InputComputeGmx", checkpoint: Checkpoint
+    ) -> "OutputComputeGmx":
+        """Returns the output of a stage finished in a previous run of the job."""
+        clean_files = [inputs.mdp_file, inputs.molecule, inputs.scratch_dir]
+        if not inputs.keep_forcefield:
+            clean_files += [inputs.forcefield, inputs.index_file, inputs.reference_file]
+        self.cleanup([path for path in clean_files if path])
+
+        gro_file = new_file(".gro", inputs.proc_input.work_dir)
+        shutil.copyfile(checkpoint.confout, gro_file)
+
+        return self.output.construct(
+            proc_input=inputs.proc_input,
+            molecule=gro_file,
+            trajectory=checkpoint.trajectory,
+            scratch_dir=inputs.scratch_dir,
+        )
 
     @staticmethod
     def cleanup(remove: List[str]):
@@ -104,8 +534,13 @@ class ComputeGmxComponent(GenericComponent):
         if config:
             env["MKL_NUM_THREADS"] = str(config.ncores)
             env["OMP_NUM_THREADS"] = str(config.ncores)
+        # The output files are allocated beforehand, gmx must not back them up
+        env["GMX_MAXBACKUP"] = "-1"
 
-        scratch_directory = config.scratch_directory if config else None
+        # Scratch directories of the job go to its work_dir
+        scratch_directory = (
+            config.scratch_directory if config else inputs["proc_input"].work_dir
+        )
 
         tpr_file = inputs["tpr_file"]
 
@@ -125,8 +560,20 @@ class ComputeGmxComponent(GenericComponent):
             "-o",
             tpr_file,
             "-maxwarn",
-            "-1",
+            str(inputs["proc_input"].maxwarn),
         ]
+        infiles = [inputs["mdp_file"], inputs["gro_file"], inputs["top_file"]]
+
+        if inputs.get("index_file"):
+            cmd.extend(["-n", inputs["index_file"]])
+            infiles.append(inputs["index_file"])
+            clean_files.append(inputs["index_file"])
+        if inputs.get("reference_file"):
+            # Position restraints hold the atoms to these coordinates
+            cmd.extend(["-r", inputs["reference_file"]])
+            infiles.append(inputs["reference_file"])
+            clean_files.append(inputs["reference_file"])
+
         outfiles = [tpr_file]
 
         return (
@@ -134,7 +581,7 @@ class ComputeGmxComponent(GenericComponent):
             {
                 "command": cmd,
                 "as_binary": [tpr_file],
-                "infiles": [inputs["mdp_file"], inputs["gro_file"], inputs["top_file"]],
+                "infiles": infiles,
                 "outfiles": outfiles,
                 "outfiles_track": outfiles,
                 "scratch_directory": scratch_directory,
@@ -155,13 +602,19 @@ class ComputeGmxComponent(GenericComponent):
         if config:
             env["MKL_NUM_THREADS"] = str(config.ncores)
             env["OMP_NUM_THREADS"] = str(config.ncores)
+        # The output files are allocated beforehand, gmx must not back them up
+        env["GMX_MAXBACKUP"] = "-1"
 
-        scratch_directory = config.scratch_directory if config else None
+        # Scratch directories of the job go to its work_dir
+        scratch_directory = (
+            config.scratch_directory if config else inputs["proc_input"].work_dir
+        )
 
-        log_file = tempfile.NamedTemporaryFile(suffix=".log").name
-        trr_file = tempfile.NamedTemporaryFile(suffix=".trr").name
-        edr_file = tempfile.NamedTemporaryFile(suffix=".edr").name
-        gro_file = tempfile.NamedTemporaryFile(suffix=".gro").name
+        work_dir = inputs["proc_input"].work_dir
+        log_file = new_file(".log", work_dir)
+        trr_file = inputs.get("trr_file") or new_file(".trr", work_dir)
+        edr_file = new_file(".edr", work_dir)
+        gro_file = new_file(".gro", work_dir)
 
         tpr_file = inputs["tpr_file"]
         tpr_fname = ntpath.basename(tpr_file)
@@ -197,8 +650,7 @@ class ComputeGmxComponent(GenericComponent):
                 tpr_fname,
                 trr_file,
                 edr_file,
-            ],  # For outfiles, mmic_cmd does not use ntpath.basename to obtain the basic nameT
-            # Therefore trr and edr do not need to be dealed by ntpath.basename
+            ],  # trr and edr are given by their full paths in the work_dir
             "infiles": [tpr_file],
             "outfiles": outfiles,
             "outfiles_track": outfiles,
@@ -209,7 +661,7 @@ class ComputeGmxComponent(GenericComponent):
 
     def parse_output(
         self, output: Dict[str, str], inputs: Dict[str, Any]
-    ) -> OutputComputeGmx:
+    ) -> "OutputComputeGmx":
         # stdout = output["stdout"]
         # stderr = output["stderr"]
         outfiles = output["outfiles"]
@@ -217,9 +669,19 @@ class ComputeGmxComponent(GenericComponent):
 
         traj, conf, energy, log = outfiles.keys()
 
-        self.cleanup([energy, log])  # Not sure if edr and log should be deleted
-        # But this is the last chance to delete them
-
-        return self.output(
-            proc_input=inputs, molecule=conf, trajectory=traj, scratch_dir=scratch_dir
+        if inputs.lowest_energy or inputs.by_reference:
+            # The energies are needed to find the lowest energy frame,
+            # or returned with the other files
+            self.cleanup([log])
+        else:
+            self.cleanup([energy, log])
+            energy = None
+
+        # Built from validated values, compute() still validates it
+        return self.output.construct(
+            proc_input=inputs,
+            molecule=conf,
+            trajectory=traj,
+            scratch_dir=scratch_dir,
+            energy=energy,
         )
@@ -1,5 +1,4 @@
 # Import schema models for energy optim
-from mmic_optim.models import InputOptim, OutputOptim
 from cmselemental.util.decorators import classproperty
 
 # Import subcomponents for running energy min with GMX
@@ -7,36 +6,307 @@ from .gmx_prep_component import PrepGmxComponent
 from .gmx_compute_component import ComputeGmxComponent
 from .gmx_post_component import PostGmxComponent
 
+from ..util.checkpoint import Checkpoint
+from ..util.cmd import pause_point
+from ..util.errors import GmxError
+from ..util.gmx import probe_gmx
+from ..util.methods import translate_method
+from ..util.singleflight import SingleFlight, request_key
+from ..util.workspace import Workspace
 from mmic.components.blueprints import TacticComponent
-from typing import Optional, Tuple, List, Any
+from typing import Dict, Optional, Tuple, List, Any, ClassVar, TYPE_CHECKING
+import time
+
+# Models are imported on first use to keep the import cheap
+if TYPE_CHECKING:
+    from mmic_optim.models import InputOptim
+    from ..models import (
+        EMStage,
+        RetryPolicy,
+        InputOptimGmx,
+        OutputOptimGmx,
+        InputComputeGmx,
+        OutputComputeGmx,
+    )
 
 __all__ = ["OptimGmxComponent"]
 
+# Requests being computed, shared by identical concurrent requests
+_inflight = SingleFlight()
+
 
 class OptimGmxComponent(TacticComponent):
     """Main entry component for running FF assignment."""
 
     @classproperty
     def input(cls):
-        return InputOptim
+        from ..models import InputOptimGmx
+
+        return InputOptimGmx
 
     @classproperty
     def output(cls):
-        return OutputOptim
+        from ..models import OutputOptimGmx
+
+        return OutputOptimGmx
+
+    # If True, identical requests running at the same time share one
+    # execution, at the cost of hashing the system of every request
+    single_flight: ClassVar[bool] = False
+    # The models passed between the stages are built by the pipeline from
+    # validated values and only validated at the public boundary, set to
+    # True to validate them at every stage as compute() does
+    validate_stages: ClassVar[bool] = False
+
+    @classmethod
+    def compute(cls, input_data: "InputOptim", *args, **kwargs) -> "OutputOptimGmx":
+        from mmic_optim.models import InputOptim
+
+        # Plain mmic_optim inputs are accepted and upgraded to the gmx schema
+        if isinstance(input_data, InputOptim) and not isinstance(input_data, cls.input):
+            input_data = cls.input(**input_data.dict())
+        compute = super().compute
+        if not cls.single_flight:
+            return compute(input_data, *args, **kwargs)
+
+        if isinstance(input_data, dict):
+            input_data = cls.input(**input_data)
+        output, shared = _inflight.do(
+            request_key(input_data), compute, input_data, *args, **kwargs
+        )
+        # Every caller gets its own output model
+        return output.copy(deep=True) if shared else output
 
     def execute(
         self,
-        inputs: InputOptim,
+        inputs: "InputOptimGmx",
         extra_outfiles: Optional[List[str]] = None,
         extra_commands: Optional[List[str]] = None,
         scratch_name: Optional[str] = None,
         timeout: Optional[int] = None,
-    ) -> Tuple[bool, OutputOptim]:
+    ) -> Tuple[bool, "OutputOptimGmx"]:
+
+        if isinstance(inputs, dict):
+            inputs = self.input(**inputs)
+
+        # The deadline is carried by the inputs since compute() does not
+        # pass the timeout on to the subcomponents
+        limits = [t for t in (timeout, inputs.timeout) if t is not None]
+        if limits:
+            deadline = time.time() + min(limits)
+            if inputs.deadline is not None:
+                deadline = min(deadline, inputs.deadline)
+            inputs = inputs.copy(update={"deadline": deadline})
+
+        if inputs.retry is None:
+            return True, self.run(inputs)
+        return True, self.run_with_retry(inputs)
+
+    @classmethod
+    def run(cls, inputs: "InputOptimGmx") -> "OutputOptimGmx":
+        """
+        Runs the prep, compute and post stages once. The files of the job
+        are written to a private directory, removed when the run ends.
+        """
+        with Workspace() as work_dir:
+            inputs = inputs.copy(update={"work_dir": work_dir})
+            computeInput = cls.run_stage(PrepGmxComponent, inputs)
+            if len(inputs.stages()) > 1:
+                computeOutput = cls.run_protocol(computeInput)
+            else:
+                computeOutput = cls.run_stage(ComputeGmxComponent, computeInput)
+            optimOutput = cls.run_stage(PostGmxComponent, computeOutput)
+        if inputs.checkpoint_dir:
+            Checkpoint.clear(inputs.checkpoint_dir)
+        return optimOutput
+
+    @classmethod
+    def run_with_retry(cls, inputs: "InputOptimGmx") -> "OutputOptimGmx":
+        """
+        Runs the job and reruns it with adjusted parameters each time it fails
+        with a GmxError whose category is in inputs.retry.retry_on, up to
+        inputs.retry.max_attempts runs. The attempts are recorded in the
+        output, or in the attempts attribute of the error raised by the last one.
+        """
+        from ..models import EMAttempt
+
+        policy, attempts, changes = inputs.retry, [], {}
+
+        for attempt in range(1, policy.max_attempts + 1):
+            start = time.perf_counter()
+            try:
+                output = cls.run(inputs)
+            except GmxError as e:
+                attempts.append(
+                    EMAttempt(
+                        attempt=attempt,
+                        success=False,
+                        category=e.category,
+                        error=str(e),
+                        changes=changes,
+                        wall_time=time.perf_counter() - start,
+                    )
+                )
+                if attempt == policy.max_attempts or e.category not in policy.retry_on:
+                    e.attempts = attempts
+                    raise
+                changes = cls.adjust_inputs(inputs, e, policy)
+                inputs = inputs.copy(update=changes)
+                if inputs.checkpoint_dir:
+                    # The stages change, nothing of the failed run is resumed
+                    Checkpoint.clear(inputs.checkpoint_dir)
+                continue
+
+            attempts.append(
+                EMAttempt(
+                    attempt=attempt,
+                    success=True,
+                    changes=changes,
+                    wall_time=time.perf_counter() - start,
+                )
+            )
+            return output.copy(update={"attempts": attempts})
+
+    @staticmethod
+    def adjust_inputs(
+        inputs: "InputOptimGmx", error: GmxError, policy: "RetryPolicy"
+    ) -> Dict[str, Any]:
+        """
+        Returns the input fields to change before rerunning a job that failed
+        with error: smaller step sizes, the fallback method instead of cg or
+        l-bfgs (with more steps), the cut-off pre-pass and, for constraint
+        failures, no constraints.
+        """
+        from ..models import MdpParams
+
+        def steep(method: Optional[str]) -> bool:
+            return translate_method(method)["integrator"] == "steep"
+
+        def adjust_stage(stage: "EMStage") -> "EMStage":
+            update = {}
+            if stage.step_size is not None:
+                update["step_size"] = stage.step_size * policy.step_factor
+            if stage.method is not None and not steep(stage.method):
+                update["method"] = policy.fallback_method
+                if stage.max_steps is not None:
+                    update["max_steps"] = int(stage.max_steps * policy.steps_factor)
+            if stage.mdp and "emstep" in stage.mdp:
+                update["mdp"] = {
+                    **stage.mdp,
+                    "emstep": stage.mdp["emstep"] * policy.step_factor,
+                }
+            return stage.copy(update=update)
+
+        step_size = inputs.step_size or MdpParams.__fields__["emstep"].default
+        changes = {"step_size": step_size * policy.step_factor}
+        if not steep(inputs.method):
+            changes["method"] = policy.fallback_method
+            if inputs.max_steps is not None:
+                changes["max_steps"] = int(inputs.max_steps * policy.steps_factor)
+
+        mdp = dict(inputs.mdp or {})
+        if "emstep" in mdp:
+            mdp["emstep"] = mdp["emstep"] * policy.step_factor
+        if error.category == "constraints":
+            mdp["constraints"] = "none"
+        if mdp != (inputs.mdp or {}):
+            changes["mdp"] = mdp
+
+        if inputs.protocol:
+            changes["protocol"] = [adjust_stage(stage) for stage in inputs.protocol]
+        if policy.prepass and not inputs.cutoff_prepass:
+            changes["cutoff_prepass"] = True
+
+        return changes
+
+    @classmethod
+    def run_stage(cls, component: Any, inputs: Any) -> Any:
+        """
+        Runs a stage component on inputs built by the pipeline. Unlike
+        compute(), the input and output models are not validated again
+        unless validate_stages is set, which saves a copy and a validation
+        of every molecule of the system per stage. A suspended job waits
+        here before starting the stage.
+        """
+        pause_point(component.__name__)
+        if cls.validate_stages:
+            return component.compute(inputs)
+
+        program = component(
+            name=component.__name__,
+            scratch=False,
+            thread_safe=False,
+            thread_parallel=False,
+            node_parallel=False,
+            managed_memory=False,
+            extras=None,
+        )
+        _, output = program.execute(inputs)
+        return output
+
+    @classmethod
+    def run_protocol(cls, computeInput: "InputComputeGmx") -> "OutputComputeGmx":
+        """
+        Runs the stages in proc_input.stages() one after another. The
+        confout .gro of each stage is fed directly to the grompp of the
+        next one, the topology is shared by all the stages and only the
+        output of the last stage is returned.
+        """
+        from ..models import InputComputeGmx
+
+        inputs = computeInput.proc_input
+        stages = inputs.stages()
+        nstages = len(stages)
+
+        for i, stage in enumerate(stages):
+            last = i == nstages - 1
+            if i > 0:
+                mdp_file = PrepGmxComponent.write_mdp(
+                    PrepGmxComponent.build_mdp(inputs, stage), inputs.work_dir
+                )
+                computeInput = InputComputeGmx.construct(
+                    proc_input=inputs,
+                    schema_name=inputs.schema_name,
+                    schema_version=inputs.schema_version,
+                    mdp_file=mdp_file,
+                    forcefield=computeInput.forcefield,
+                    molecule=computeOutput.molecule,
+                    scratch_dir=computeOutput.scratch_dir,
+                    keep_forcefield=not last,
+                    index_file=computeInput.index_file,
+                    reference_file=computeInput.reference_file,
+                    stage=i,
+                )
+            else:
+                computeInput = computeInput.copy(update={"keep_forcefield": not last})
+
+            try:
+                computeOutput = cls.run_stage(ComputeGmxComponent, computeInput)
+            except GmxError:
+                # Files shared by the stages are left over by a failed stage
+                ComputeGmxComponent.cleanup(
+                    [
+                        path
+                        for path in (
+                            computeInput.forcefield,
+                            computeInput.index_file,
+                            computeInput.reference_file,
+                        )
+                        if path
+                    ]
+                )
+                raise
+            if not last:
+                # Intermediate trajectories are not part of the output
+                ComputeGmxComponent.cleanup(
+                    [
+                        path
+                        for path in (computeOutput.trajectory, computeOutput.energy)
+                        if path
+                    ]
+                )
 
-        computeInput = PrepGmxComponent.compute(inputs)
-        computeOutput = ComputeGmxComponent.compute(computeInput)
-        optimOutput = PostGmxComponent.compute(computeOutput)
-        return True, optimOutput
+        return computeOutput
 
     @classproperty
     def version(cls) -> str:
@@ -46,7 +316,7 @@ class OptimGmxComponent(TacticComponent):
         str
             Return a valid, safe python version string.
         """
-        return ""
+        return probe_gmx().get("version", "")
 
     @classproperty
     def strategy_comps(cls) -> Any:
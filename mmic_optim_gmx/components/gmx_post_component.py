@@ -1,16 +1,20 @@
 # Import models
-from mmic_optim.models.output import OutputOptim
-from mmelemental.models import Molecule, Trajectory
-from ..models import OutputComputeGmx
 from cmselemental.util.decorators import classproperty
 
 # Import components
 from mmic.components.blueprints import GenericComponent
 
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, TYPE_CHECKING
 import os
 import shutil
 
+# Models and mmelemental are imported on first use to keep the import cheap
+if TYPE_CHECKING:
+    from mmelemental.models import Molecule
+    import numpy
+    from ..util.trajectory import TrajectoryIndex
+    from ..models import OutputComputeGmx, OutputOptimGmx
+
 
 __all__ = ["PostGmxComponent"]
 
@@ -18,11 +22,15 @@ __all__ = ["PostGmxComponent"]
 class PostGmxComponent(GenericComponent):
     @classproperty
     def input(cls):
+        from ..models import OutputComputeGmx
+
         return OutputComputeGmx
 
     @classproperty
     def output(cls):
-        return OutputOptim
+        from ..models import OutputOptimGmx
+
+        return OutputOptimGmx
 
     @classproperty
     def version(cls) -> str:
@@ -36,21 +44,27 @@ class PostGmxComponent(GenericComponent):
 
     def execute(
         self,
-        inputs: OutputComputeGmx,
+        inputs: "OutputComputeGmx",
         extra_outfiles: Optional[List[str]] = None,
         extra_commands: Optional[List[str]] = None,
         scratch_name: Optional[str] = None,
         timeout: Optional[int] = None,
-    ) -> Tuple[bool, OutputOptim]:
+    ) -> Tuple[bool, "OutputOptimGmx"]:
 
         """
         This method translate the output of em
-        to mmic schema. But right now it can only
-        be applied to single molecule conditions
+        to mmic schema. The minimized coordinates
+        are split back into the molecules of the system
         """
+        from mmelemental.models import Trajectory
+        from ..util.gro import read_gro_coordinates
+
         if isinstance(inputs, dict):
             inputs = self.input(**inputs)
 
+        if inputs.proc_input.by_reference:
+            return True, self.output_by_reference(inputs)
+
         traj_names = []
         traj = {}
 
@@ -77,24 +91,165 @@ class PostGmxComponent(GenericComponent):
             }
 
         mol_file = inputs.molecule
-        mol = Molecule.from_file(mol_file, translator="mmic_mda")
-        mols = [mol]
+        step, energy = None, None
+        if inputs.proc_input.lowest_energy and inputs.energy:
+            coords, step, energy = self.lowest_energy_frame(
+                inputs.trajectory, inputs.energy
+            )
+        else:
+            coords, _ = read_gro_coordinates(mol_file)
+        mols = self.update_molecules(list(inputs.proc_input.system), coords)
         self.cleanup([inputs.scratch_dir])
         self.cleanup([inputs.trajectory])
         self.cleanup([mol_file])
+        if inputs.energy:
+            self.cleanup([inputs.energy])
 
         return (
             True,
-            OutputOptim(
+            self.output(
                 proc_input=inputs.proc_input,
                 molecule=mols,
                 trajectory=traj,
                 schema_name=inputs.proc_input.schema_name,
                 schema_version=inputs.proc_input.schema_version,
                 success=True,
+                lowest_energy_step=step,
+                lowest_energy=energy,
             ),
         )
 
+    @staticmethod
+    def atom_ranges(molecules: List["Molecule"]) -> List[Tuple[int, int]]:
+        """
+        Returns the (start, stop) indices of the atoms of each molecule in
+        the system assembled by the prep stage, i.e. in the order of molecules.
+        """
+        import numpy
+
+        stops = numpy.cumsum([len(mol.symbols) for mol in molecules])
+        starts = numpy.concatenate(([0], stops[:-1]))
+        return [(int(start), int(stop)) for start, stop in zip(starts, stops)]
+
+    @staticmethod
+    def update_molecules(
+        molecules: List["Molecule"], coords: "numpy.ndarray"
+    ) -> List["Molecule"]:
+        """
+        Returns copies of molecules with the minimized (natoms, 3) coordinates
+        in nm, e.g. read from the confout. Every other field is shared with
+        the input molecules and each geometry is a view of coords. The atoms
+        of coords are expected in the order of molecules, atoms past the
+        last molecule e.g. the solvent added by the prep stage are ignored.
+        """
+        from ..util.gro import length_factor
+
+        ranges = PostGmxComponent.atom_ranges(molecules)
+        if ranges and ranges[-1][1] > len(coords):
+            raise ValueError(
+                f"The system has {ranges[-1][1]} atoms but {len(coords)} coordinates were read."
+            )
+
+        mols = []
+        for mol, (start, stop) in zip(molecules, ranges):
+            geometry = coords[start:stop]
+            geometry *= length_factor(mol.geometry_units)
+            if mol.geometry is not None:
+                geometry = geometry.reshape(mol.geometry.shape)
+            mols.append(mol.copy(update={"geometry": geometry}))
+
+        return mols
+
+    def output_by_reference(self, inputs: "OutputComputeGmx") -> "OutputOptimGmx":
+        """
+        Moves the final .gro, .trr and .edr files to the results_dir of the
+        job under their content hash and returns handles on them, nothing
+        is loaded. With lowest_energy, the lowest energy frame is written
+        to the .gro first.
+        """
+        from ..models import FileRef
+        from ..util.gro import write_gro_coordinates
+        from ..util.results import store_file
+
+        proc_input = inputs.proc_input
+        step, energy = None, None
+        if proc_input.lowest_energy and inputs.energy:
+            coords, step, energy = self.lowest_energy_frame(
+                inputs.trajectory, inputs.energy
+            )
+            # The box line of the confout is kept
+            write_gro_coordinates(inputs.molecule, inputs.molecule, coords)
+
+        files = {}
+        for key, path in (
+            ("molecule", inputs.molecule),
+            ("trajectory", inputs.trajectory),
+            ("energy", inputs.energy),
+        ):
+            if path and os.path.isfile(path):
+                stored, digest, size = store_file(path, proc_input.results_dir)
+                files[key] = FileRef(path=stored, sha256=digest, size=size)
+        self.cleanup([inputs.scratch_dir])
+
+        return self.output(
+            proc_input=proc_input,
+            molecule=[],
+            trajectory={},
+            schema_name=proc_input.schema_name,
+            schema_version=proc_input.schema_version,
+            success=True,
+            lowest_energy_step=step,
+            lowest_energy=energy,
+            files=files,
+        )
+
+    @staticmethod
+    def lowest_energy_frame(
+        traj_file: str, edr_file: str
+    ) -> Tuple["numpy.ndarray", int, float]:
+        """
+        Finds the frame of traj_file with the lowest potential energy in
+        edr_file and reads only that frame.
+
+        Returns
+        -------
+        Tuple[numpy.ndarray, int, float]
+            The (natoms, 3) coordinates in nm, the step and the potential energy.
+        """
+        from ..util.energy import read_energy
+        from ..util.trajectory import TrajectoryIndex
+        import numpy
+
+        index = TrajectoryIndex.build(traj_file, sidecar=False)
+        times, potential = read_energy(edr_file, "Potential")
+
+        # Only the energies of the steps with a frame can be used
+        has_frame = numpy.isin(numpy.round(times), index.steps) & numpy.isfinite(
+            potential
+        )
+        if not has_frame.any():
+            raise ValueError(
+                f"No frame of {traj_file} matches an energy in {edr_file}."
+            )
+
+        best = numpy.flatnonzero(has_frame)[numpy.argmin(potential[has_frame])]
+        step = int(round(times[best]))
+        coords = index.positions(index.frame_at_step(step))
+        index.close()
+
+        return coords, step, float(potential[best])
+
+    @staticmethod
+    def index_trajectory(traj_file: str, sidecar: bool = True) -> "TrajectoryIndex":
+        """
+        Returns a frame index of a .trr or .xtc file, giving random access to
+        single frames without loading the whole trajectory. The frame offsets
+        are cached in a sidecar file next to traj_file if sidecar is True.
+        """
+        from ..util.trajectory import TrajectoryIndex
+
+        return TrajectoryIndex.build(traj_file, sidecar=sidecar)
+
     @staticmethod
     def cleanup(remove: List[str]):
         for item in remove:
@@ -1,19 +1,41 @@
 # Import models
-from mmic_optim.models.input import InputOptim
-from mmic_optim_gmx.models import InputComputeGmx
+from mmic_optim_gmx.util import translate_method
+from mmic_optim_gmx.util.cmd import run_gmx, time_limit
+from mmic_optim_gmx.util.errors import GmxError
+from mmic_optim_gmx.util.ndx import write_ndx
+from mmic_optim_gmx.util.gro import merge_gro, read_gro_coordinates
+from mmic_optim_gmx.util.solvent import (
+    solvent_models,
+    solvent_topology,
+    ion_counts,
+    place_ions,
+    replace_with_ions,
+)
+from mmic_optim_gmx.util.topology import (
+    add_position_restraints,
+    add_molecule_types,
+    merge_topologies,
+    system_charge,
+)
+from mmic_optim_gmx.util.workspace import new_file, new_path
 from cmselemental.util.decorators import classproperty
 
 # Import components
-from mmic_cmd.components import CmdComponent
 from mmic.components.blueprints import GenericComponent
 
-from typing import Any, Dict, List, Tuple, Optional
+from typing import Any, Dict, List, Tuple, Optional, TYPE_CHECKING
 from pathlib import Path
 import os
-import tempfile
+import shutil
+import time
+
+# Models are imported on first use to keep the import cheap
+if TYPE_CHECKING:
+    from mmic_optim_gmx.models import InputOptimGmx, EMStage, InputComputeGmx, MdpParams
 
 __all__ = ["PrepGmxComponent"]
-_supported_solvents = ("spc", "tip3p", "tip4p")
+_supported_solvents = solvent_models()  # spc, tip3p and tip4p
+_posres_define = "POSRES_MMIC"
 
 
 class PrepGmxComponent(GenericComponent):
@@ -27,10 +49,14 @@ class PrepGmxComponent(GenericComponent):
 
     @classproperty
     def input(cls):
-        return InputOptim
+        from mmic_optim_gmx.models import InputOptimGmx
+
+        return InputOptimGmx
 
     @classproperty
     def output(cls):
+        from mmic_optim_gmx.models import InputComputeGmx
+
         return InputComputeGmx
 
     @classproperty
@@ -45,71 +71,26 @@ class PrepGmxComponent(GenericComponent):
 
     def execute(
         self,
-        inputs: InputOptim,
+        inputs: "InputOptimGmx",
         extra_outfiles: Optional[List[str]] = None,
         extra_commands: Optional[List[str]] = None,
         scratch_name: Optional[str] = None,
         timeout: Optional[int] = None,
-    ) -> Tuple[bool, InputComputeGmx]:
+    ) -> Tuple[bool, "InputComputeGmx"]:
 
         if isinstance(inputs, dict):
             inputs = self.input(**inputs)
+        deadline = time.time() + timeout if timeout is not None else None
 
-        mdp_inputs = {
-            "integrator": inputs.method,
-            "emtol": inputs.tol,
-            "emstep": inputs.step_size,
-            "nsteps": inputs.max_steps,
-            "pbc": inputs.boundary,
-            "vdwtype": inputs.short_forces.method,
-            "coulombtype": inputs.long_forces.method,
-        }
-
-        # The following part is ugly and may be
-        # improved in the future
-        # Translate the method
-        if "steep" in mdp_inputs["integrator"]:
-            mdp_inputs["integrator"] = "steep"
-        if "conjugate" in mdp_inputs["integrator"]:
-            mdp_inputs["integrator"] = "cg"
-
-        if mdp_inputs["integrator"] is None:
-            mdp_inputs["integrator"] = "steep"
-        if mdp_inputs["emtol"] is None:
-            mdp_inputs["emtol"] = "1000"
-        if mdp_inputs["emstep"] is None:
-            mdp_inputs["emstep"] = "0.01"  # The unit here is nm
-        if mdp_inputs["emstep"] is None:
-            mdp_inputs["emstep"] = "0.01"
-        # if mdp_inputs["cutoff-scheme"] is None:
-        #    mdp_inputs["cutoff-scheme"] = "Verlet"
-        if mdp_inputs["coulombtype"] is None:
-            mdp_inputs["coulombtype"] = "PME"
-
-        # Translate boundary str tuple (perodic,perodic,perodic) to a string e.g. xyz
-        pbc_dict = dict(zip(["x", "y", "z"], list(mdp_inputs["pbc"])))
-        pbc = ""
-        for dim in list(pbc_dict.keys()):
-            if pbc_dict[dim] != "periodic":
-                continue
-            else:
-                pbc = pbc + dim  # pbc is a str, may need to be initiated elsewhere
-        mdp_inputs["pbc"] = pbc
-
-        # Write .mdp file
-        mdp_file = tempfile.NamedTemporaryFile(suffix=".mdp", delete=False).name
-        with open(mdp_file, "w") as inp:
-            for key, val in mdp_inputs.items():
-                inp.write(f"{key} = {val}\n")
-
-        mol, ff = list(inputs.system.items()).pop()
+        work_dir = inputs.work_dir
+        mdp_file = self.write_mdp(self.build_mdp(inputs, inputs.stages()[0]), work_dir)
 
-        gro_file = tempfile.NamedTemporaryFile(suffix=".gro").name  # output gro
-        top_file = tempfile.NamedTemporaryFile(suffix=".top").name
-        boxed_gro_file = tempfile.NamedTemporaryFile(suffix=".gro").name
+        # Written by ParmEd, which does not overwrite existing files
+        gro_file = new_path(".gro", work_dir)  # output gro
+        top_file = new_path(".top", work_dir)
+        boxed_gro_file = new_file(".gro", work_dir)
 
-        mol.to_file(gro_file, translator="mmic_parmed")
-        ff.to_file(top_file, translator="mmic_parmed")
+        self.write_system(inputs, gro_file, top_file)
 
         input_model = {
             "gro_file": gro_file,
@@ -117,14 +98,57 @@ class PrepGmxComponent(GenericComponent):
             "boxed_gro_file": boxed_gro_file,
         }
         cmd_input = self.build_input(input_model)
-        rvalue = CmdComponent.compute(cmd_input)
+        try:
+            rvalue = run_gmx(
+                "editconf", cmd_input, timeout=time_limit(inputs, deadline)
+            )
+        except GmxError:
+            self.cleanup([mdp_file, gro_file, top_file, boxed_gro_file])
+            raise
 
         scratch_dir = str(rvalue.scratch_directory)
         self.cleanup(
             [gro_file]
         )  # Del the gro in the working dir; !!!!!!!MUST INPUT A LIST HERE!!!!!!
 
-        gmx_compute = InputComputeGmx(
+        index_file, reference_file = None, None
+        try:
+            if inputs.solvent:
+                self.solvate(inputs, boxed_gro_file, top_file, deadline)
+            if inputs.freeze:
+                with open(boxed_gro_file) as fp:
+                    fp.readline()
+                    natoms = int(fp.readline())
+                index_file = new_file(".ndx", work_dir)
+                write_ndx(
+                    index_file, {"System": range(natoms), "Frozen": inputs.freeze}
+                )
+            if inputs.restrain:
+                add_position_restraints(
+                    top_file, inputs.restrain, inputs.restraint_fc, _posres_define
+                )
+                # grompp -r, the following stages restrain to the same coordinates
+                reference_file = new_file(".gro", work_dir)
+                shutil.copyfile(boxed_gro_file, reference_file)
+        except (GmxError, ValueError):
+            self.cleanup(
+                [
+                    path
+                    for path in (
+                        mdp_file,
+                        top_file,
+                        boxed_gro_file,
+                        scratch_dir,
+                        index_file,
+                        reference_file,
+                    )
+                    if path
+                ]
+            )
+            raise
+
+        # Built from validated values, compute() still validates it
+        gmx_compute = self.output.construct(
             proc_input=inputs,
             schema_name=inputs.schema_name,
             schema_version=inputs.schema_version,
@@ -132,10 +156,196 @@ class PrepGmxComponent(GenericComponent):
             forcefield=top_file,
             molecule=boxed_gro_file,
             scratch_dir=scratch_dir,
+            index_file=index_file,
+            reference_file=reference_file,
         )
 
         return True, gmx_compute
 
+    def solvate(
+        self,
+        inputs: "InputOptimGmx",
+        gro_file: str,
+        top_file: str,
+        deadline: Optional[float] = None,
+    ):
+        """
+        Fills the box of gro_file with inputs.solvent water molecules, replaces
+        some of them with NA/CL ions to neutralize the system (if
+        inputs.neutralize) and reach inputs.salt_concentration, and adds the
+        solvent to top_file. gro_file is overwritten with the solvated system.
+        """
+        box_file, natoms_water, atomtypes, moltypes = solvent_topology(
+            inputs.solvent, top_file
+        )
+        charge = system_charge(top_file) if inputs.neutralize else 0.0
+
+        with open(gro_file) as fp:
+            fp.readline()
+            solute = int(fp.readline())
+
+        solvated_file = new_file(".gro", inputs.work_dir)
+        cmd_input = self.build_input_solvate(inputs, gro_file, box_file, solvated_file)
+        try:
+            rvalue = run_gmx("solvate", cmd_input, timeout=time_limit(inputs, deadline))
+        except GmxError:
+            self.cleanup([solvated_file])
+            raise
+        self.cleanup([str(rvalue.scratch_directory)])
+
+        try:
+            coords, box = read_gro_coordinates(solvated_file)
+            waters = (len(coords) - solute) // natoms_water
+            counts = ion_counts(
+                charge, float(box[:3].prod()), inputs.salt_concentration
+            )
+            names = [name for name, count in counts.items() for _ in range(count)]
+            picked = place_ions(coords, box, solute, waters, natoms_water, len(names))
+            replace_with_ions(
+                solvated_file, gro_file, solute, natoms_water, picked, names
+            )
+        finally:
+            self.cleanup([solvated_file])
+
+        add_molecule_types(
+            top_file,
+            atomtypes,
+            moltypes,
+            [("SOL", waters - len(names))] + list(counts.items()),
+        )
+
+    def build_input_solvate(
+        self,
+        inputs: "InputOptimGmx",
+        gro_file: str,
+        box_file: str,
+        solvated_file: str,
+    ) -> Dict[str, Any]:
+        """
+        Build the input for solvate
+        """
+        env = os.environ.copy()
+        env["GMX_MAXBACKUP"] = "-1"
+        cmd = [
+            inputs.engine,
+            "solvate",
+            "-cp",
+            gro_file,
+            "-cs",
+            box_file,  # Found in the gmx data directory
+            "-o",
+            solvated_file,
+        ]
+        return {
+            "command": cmd,
+            "infiles": [gro_file],
+            "outfiles": [solvated_file],
+            "outfiles_track": [solvated_file],
+            "scratch_directory": inputs.work_dir,
+            "environment": env,
+            "scratch_messy": True,
+        }
+
+    @staticmethod
+    def write_system(inputs: "InputOptimGmx", gro_file: str, top_file: str):
+        """
+        Writes the molecules of inputs.system to one .gro file and their
+        force fields to one .top file. With several molecules, each one is
+        translated on its own and the files are merged, in the order of
+        inputs.system, identical molecule types being defined once.
+        """
+        system = list(inputs.system.items())
+        if len(system) == 1:
+            mol, ff = system[0]
+            mol.to_file(gro_file, translator="mmic_parmed")
+            ff.to_file(top_file, translator="mmic_parmed")
+            return
+
+        gro_files, top_files = [], []
+        try:
+            for mol, ff in system:
+                gro_files.append(new_path(".gro", inputs.work_dir))
+                top_files.append(new_path(".top", inputs.work_dir))
+                mol.to_file(gro_files[-1], translator="mmic_parmed")
+                ff.to_file(top_files[-1], translator="mmic_parmed")
+            merge_gro(gro_files, gro_file)
+            merge_topologies(top_files, top_file)
+        finally:
+            PrepGmxComponent.cleanup(gro_files + top_files)
+
+    @staticmethod
+    def build_mdp(
+        inputs: "InputOptimGmx", stage: Optional["EMStage"] = None
+    ) -> "MdpParams":
+        """
+        Translates the mmic_optim input to .mdp parameters. The parameters
+        are taken, in increasing order of precedence, from the inputs.preset
+        performance preset, the InputOptim fields, inputs.mdp, the fields
+        set in stage and stage.mdp.
+        """
+        from mmic_optim_gmx.models import MdpParams
+
+        # Translate boundary str tuple (perodic,perodic,perodic) to a string e.g. xyz
+        pbc_dict = dict(zip(["x", "y", "z"], list(inputs.boundary)))
+        pbc = ""
+        for dim in list(pbc_dict.keys()):
+            if pbc_dict[dim] != "periodic":
+                continue
+            else:
+                pbc = pbc + dim
+
+        mdp_inputs = {
+            # e.g. "conjugate gradient" -> cg, plus the parameters
+            # that go along with the integrator
+            **translate_method(inputs.method),
+            "emtol": inputs.tol,
+            "emstep": inputs.step_size,  # The unit here is nm
+            "nsteps": inputs.max_steps,
+            "pbc": pbc or "no",
+            "vdwtype": inputs.short_forces.method,
+            "coulombtype": inputs.long_forces.method,
+        }
+        if inputs.freeze:
+            mdp_inputs["freezegrps"] = "Frozen"
+            mdp_inputs["freezedim"] = inputs.freeze_dims
+        if inputs.restrain:
+            mdp_inputs["define"] = f"-D{_posres_define}"
+        if inputs.lowest_energy:
+            # Frames and energies are needed at the same steps
+            mdp_inputs["nstxout"] = 1
+            mdp_inputs["nstenergy"] = 1
+        elif inputs.checkpoint_dir:
+            # The frames are the checkpoints a rerun resumes from
+            mdp_inputs["nstxout"] = inputs.checkpoint_interval
+        mdp_inputs.update(inputs.mdp or {})
+
+        if stage is not None:
+            if stage.method is not None:
+                mdp_inputs.update(translate_method(stage.method))
+            for key, val in {
+                "emtol": stage.tol,
+                "emstep": stage.step_size,
+                "nsteps": stage.max_steps,
+            }.items():
+                if val is not None:
+                    mdp_inputs[key] = val
+            mdp_inputs.update(stage.mdp or {})
+
+        mdp_inputs = {
+            key.replace("-", "_"): val
+            for key, val in mdp_inputs.items()
+            if val is not None
+        }
+        return MdpParams.from_preset(inputs.preset, **mdp_inputs)
+
+    @staticmethod
+    def write_mdp(mdp: "MdpParams", work_dir: Optional[str] = None) -> str:
+        """Writes the .mdp parameters to a new file in work_dir and returns its path."""
+        mdp_file = new_file(".mdp", work_dir)
+        with open(mdp_file, "w") as inp:
+            inp.write(mdp.to_mdp())
+        return mdp_file
+
     @staticmethod
     def cleanup(remove: List[str]):
         for item in remove:
@@ -160,8 +370,13 @@ class PrepGmxComponent(GenericComponent):
         if config:
             env["MKL_NUM_THREADS"] = str(config.ncores)
             env["OMP_NUM_THREADS"] = str(config.ncores)
+        # The output files are allocated beforehand, gmx must not back them up
+        env["GMX_MAXBACKUP"] = "-1"
 
-        scratch_directory = config.scratch_directory if config else None
+        # Scratch directories of the job go to its work_dir
+        scratch_directory = (
+            config.scratch_directory if config else inputs["proc_input"].work_dir
+        )
 
         cmd = [
             inputs["proc_input"].engine,
@@ -1,6 +1,8 @@
 from .input import *
 from .output import *
+from .mdp import *
 from . import input
 from . import output
+from . import mdp
 
-__all__ = input.__all__ + output.__all__
+__all__ = input.__all__ + output.__all__ + mdp.__all__
@@ -1,13 +1,262 @@
 from cmselemental.models.procedures import InputProc
+from cmselemental.models.base import ProtoModel
 from mmic_optim.models import InputOptim
-from pydantic import Field
+from ..util.methods import translate_method
+from ..util.solvent import solvent_models
+from .mdp import MdpParams, mdp_presets
+from pydantic import Field, validator
+from typing import Any, Dict, List, Optional
 
 
-__all__ = ["InputComputeGmx"]
+__all__ = ["EMStage", "RetryPolicy", "InputOptimGmx", "InputComputeGmx"]
+
+
+def _check_mdp_keys(mdp: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    if mdp:
+        unknown = [
+            key for key in mdp if key.replace("-", "_") not in MdpParams.__fields__
+        ]
+        if unknown:
+            raise ValueError(f"Unsupported .mdp parameter(s): {', '.join(unknown)}")
+    return mdp
+
+
+class EMStage(ProtoModel):
+    method: Optional[str] = Field(
+        None,
+        description="Minimization algorithm for this stage e.g. steepest descent. Defaults to InputOptim.method.",
+    )
+    max_steps: Optional[int] = Field(
+        None,
+        description="Max number of steps for this stage. Defaults to InputOptim.max_steps.",
+    )
+    step_size: Optional[float] = Field(
+        None,
+        description="Initial step size for this stage (nm). Defaults to InputOptim.step_size.",
+    )
+    tol: Optional[float] = Field(
+        None,
+        description="Force tolerance for this stage (kJ/(mol*nm)). Defaults to InputOptim.tol.",
+    )
+    mdp: Optional[Dict[str, Any]] = Field(
+        None,
+        description="Extra .mdp parameters for this stage e.g. {'coulombtype': 'Reaction-Field'}. "
+        "See :class:``MdpParams`` for the supported keys.",
+    )
+
+    @validator("method")
+    def _valid_method(cls, v):
+        if v is not None:
+            translate_method(v)
+        return v
+
+    _valid_mdp = validator("mdp", allow_reuse=True)(_check_mdp_keys)
+
+
+class RetryPolicy(ProtoModel):
+    max_attempts: int = Field(
+        3, description="Max number of runs of the job, including the first one."
+    )
+    retry_on: List[str] = Field(
+        ["non_finite_force", "constraints", "segfault"],
+        description="Categories of the gmx failures (GmxError.category) worth retrying.",
+    )
+    step_factor: float = Field(
+        0.5, description="Factor applied to the step sizes on every retry."
+    )
+    steps_factor: float = Field(
+        2.0,
+        description="Factor applied to the max number of steps when cg or l-bfgs is replaced by steep.",
+    )
+    fallback_method: str = Field(
+        "steepest descent",
+        description="Minimization algorithm used on retry instead of cg or l-bfgs.",
+    )
+    prepass: bool = Field(
+        True, description="If True, the cut-off pre-pass is turned on on retry."
+    )
+
+    @validator("max_attempts")
+    def _valid_max_attempts(cls, v):
+        if v < 1:
+            raise ValueError("max_attempts must be at least 1.")
+        return v
+
+    @validator("fallback_method")
+    def _valid_method(cls, v):
+        translate_method(v)
+        return v
+
+
+class InputOptimGmx(InputOptim):
+    protocol: Optional[List[EMStage]] = Field(
+        None,
+        description="Sequence of energy minimization stages e.g. steep -> cg. Each stage starts from the "
+        "final coordinates of the previous one. If None, a single stage built from the InputOptim fields is run.",
+    )
+    preset: str = Field(
+        "balanced",
+        description="Performance preset for the .mdp parameters: fast, balanced or accurate.",
+    )
+    mdp: Optional[Dict[str, Any]] = Field(
+        None,
+        description="Per job .mdp parameters overriding the preset and the InputOptim fields e.g. {'rvdw': 1.1}. "
+        "See :class:``MdpParams`` for the supported keys.",
+    )
+    cutoff_prepass: bool = Field(
+        False,
+        description="If True, a cheap minimization with reaction-field electrostatics and short cut-offs "
+        "is run first to remove steric clashes, followed by the PME minimization (protocol or InputOptim fields).",
+    )
+    prepass: EMStage = Field(
+        EMStage(
+            method="steepest descent",
+            max_steps=500,
+            tol=1000.0,
+            mdp={
+                "coulombtype": "Reaction-Field",
+                "epsilon_rf": 0,
+                "rcoulomb": 0.8,
+                "rvdw": 0.8,
+                "rlist": 0.8,
+            },
+        ),
+        description="Settings of the cut-off pre-pass, only used if cutoff_prepass is True.",
+    )
+
+    freeze: Optional[List[int]] = Field(
+        None,
+        description="0-based indices of the atoms kept fixed during the minimization. gmx skips the force "
+        "work for these atoms, e.g. freeze everything except a ligand and its binding site.",
+    )
+    freeze_dims: str = Field(
+        "Y Y Y", description="Frozen dimensions (x y z) of the atoms in freeze."
+    )
+    restrain: Optional[List[int]] = Field(
+        None,
+        description="0-based indices of the atoms position restrained to their initial coordinates.",
+    )
+    restraint_fc: float = Field(
+        1000.0,
+        description="Force constant of the position restraints in kJ/(mol*nm**2).",
+    )
+
+    solvent: Optional[str] = Field(
+        None,
+        description="Water model the system is solvated in before the minimization: spc, tip3p or tip4p. "
+        "The force field must use a sigma/epsilon combination rule. The solvent is not part of the output molecules.",
+    )
+    neutralize: bool = Field(
+        True,
+        description="If True, NA or CL ions replace water molecules to neutralize the solvated system.",
+    )
+    salt_concentration: float = Field(
+        0.0, description="NaCl concentration (mol/L) of the solvent."
+    )
+
+    maxwarn: int = Field(
+        0,
+        description="Number of grompp warnings tolerated before failing, -1 means any. "
+        "grompp errors always stop the job.",
+    )
+    lowest_energy: bool = Field(
+        False,
+        description="If True, the frame with the lowest potential energy visited during the minimization "
+        "is returned instead of the last one. Coordinates and energies are then written every step "
+        "unless nstxout/nstenergy are set in mdp. Requires pyedr.",
+    )
+    by_reference: bool = Field(
+        False,
+        description="If True, the final .gro, .trr and .edr files are moved to results_dir under their "
+        "content hash and returned as file handles in OutputOptimGmx.files, loaded on demand, instead "
+        "of being read into the output molecule and trajectory.",
+    )
+    results_dir: Optional[str] = Field(
+        None,
+        description="Directory the files returned by reference are moved to, required if by_reference is True.",
+    )
+
+    checkpoint_dir: Optional[str] = Field(
+        None,
+        description="Persistent job directory. If set, the coordinates of the running stage are saved there "
+        "every checkpoint_interval steps and when the stage finishes, and a rerun of the same job with the "
+        "same directory resumes from the last saved frame instead of step 0. The saved files are removed "
+        "once the job succeeds.",
+    )
+    checkpoint_interval: int = Field(
+        100,
+        description="Number of steps between two saved frames, only used if checkpoint_dir is set.",
+    )
+    timeout: Optional[float] = Field(
+        None,
+        description="Max wall time of the whole job in seconds, retries included. The running gmx program "
+        "is terminated when the time is up and a GmxTimeoutError is raised.",
+    )
+    stage_timeout: Optional[float] = Field(
+        None, description="Max wall time in seconds of each gmx program run."
+    )
+    deadline: Optional[float] = Field(
+        None,
+        description="Time (as returned by time.time()) by which the job must finish. Set from timeout "
+        "when the job starts.",
+    )
+    work_dir: Optional[str] = Field(
+        None,
+        description="Directory the files of the job are written to. Set to a new private directory "
+        "for each run of the job, the system temp directory is used if None.",
+    )
+    tpr_cache: Optional[str] = Field(
+        None,
+        description="Directory caching the .tpr files written by grompp. A rerun of the same system whose "
+        "inputs only differ in nsteps gets its .tpr from gmx convert-tpr instead of grompp.",
+    )
+    retry: Optional[RetryPolicy] = Field(
+        None,
+        description="If set, failed minimizations are rerun with adjusted parameters (smaller steps, "
+        "steepest descent, cut-off pre-pass) according to this policy.",
+    )
+
+    def stages(self) -> List[EMStage]:
+        """Returns the minimization stages to run, in order."""
+        stages = list(self.protocol) if self.protocol else [EMStage()]
+        if self.cutoff_prepass:
+            stages.insert(0, self.prepass)
+        return stages
+
+    @validator("method")
+    def _valid_method(cls, v):
+        translate_method(v)
+        return v
+
+    @validator("results_dir", always=True)
+    def _results_dir_set(cls, v, values):
+        if values.get("by_reference") and v is None:
+            raise ValueError(
+                "results_dir is required to return the results by reference."
+            )
+        return v
+
+    @validator("solvent")
+    def _valid_solvent(cls, v):
+        if v is not None and v not in solvent_models():
+            raise ValueError(
+                f"Solvent {v!r} is not supported. Supported solvents: {', '.join(solvent_models())}"
+            )
+        return v
+
+    @validator("preset")
+    def _valid_preset(cls, v):
+        if v not in mdp_presets():
+            raise ValueError(
+                f"Unknown mdp preset {v!r}. Available presets: {', '.join(mdp_presets())}"
+            )
+        return v
+
+    _valid_mdp = validator("mdp", allow_reuse=True)(_check_mdp_keys)
 
 
 class InputComputeGmx(InputProc):
-    proc_input: InputOptim = Field(..., description="Procedure input schema.")
+    proc_input: InputOptimGmx = Field(..., description="Procedure input schema.")
     mdp_file: str = Field(
         ...,
         description="The file used for specifying the parameters. Should be a .mdp file.",
@@ -24,3 +273,19 @@ class InputComputeGmx(InputProc):
         ...,
         description="The path to the directory where the temporary files are written. Generally it's a directory in /tmp",
     )
+    keep_forcefield: bool = Field(
+        False,
+        description="If True, the .top and .ndx files are not removed after grompp so they can be reused by a following stage.",
+    )
+    index_file: Optional[str] = Field(
+        None, description="The file of the atom groups. Should be a .ndx file."
+    )
+    reference_file: Optional[str] = Field(
+        None,
+        description="The coordinates the restrained atoms are held to, the starting coordinates of the "
+        "first stage. Should be a .gro file.",
+    )
+    stage: int = Field(
+        0,
+        description="Index of the stage being run in proc_input.stages(), names its checkpoint files.",
+    )
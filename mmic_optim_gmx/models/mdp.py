@@ -0,0 +1,144 @@
+from cmselemental.models.base import ProtoModel
+from pydantic import Field
+from typing import Any, Dict, Optional
+
+
+__all__ = ["MdpParams", "mdp_presets"]
+
+# Performance presets for energy minimization. Cut-offs, PME grid and
+# neighbour list settings trade accuracy of the forces for throughput.
+_presets = {
+    "fast": {
+        "nstlist": 20,
+        "rlist": 0.9,
+        "rcoulomb": 0.9,
+        "rvdw": 0.9,
+        "fourierspacing": 0.16,
+        "pme_order": 4,
+        "ewald_rtol": 1e-4,
+    },
+    "balanced": {
+        "nstlist": 10,
+        "rlist": 1.0,
+        "rcoulomb": 1.0,
+        "rvdw": 1.0,
+        "fourierspacing": 0.12,
+        "pme_order": 4,
+        "ewald_rtol": 1e-5,
+    },
+    "accurate": {
+        "nstlist": 10,
+        "rlist": 1.2,
+        "rcoulomb": 1.2,
+        "rvdw": 1.2,
+        "fourierspacing": 0.10,
+        "pme_order": 6,
+        "ewald_rtol": 1e-6,
+    },
+}
+
+
+def mdp_presets() -> Dict[str, Dict[str, Any]]:
+    """Returns a copy of the available .mdp performance presets."""
+    return {name: dict(params) for name, params in _presets.items()}
+
+
+class MdpParams(ProtoModel):
+    """
+    Energy minimization parameters written to the .mdp file. Field names
+    use "_" in place of the "-" of the gmx keys, fields set to None are
+    not written and fall back to the gmx defaults.
+    """
+
+    # Run control
+    integrator: str = Field("steep", description="Minimization algorithm.")
+    nsteps: int = Field(-1, description="Max number of steps, -1 means no limit.")
+    emtol: float = Field(1000.0, description="Force tolerance (kJ/(mol*nm)).")
+    emstep: float = Field(0.01, description="Initial step size (nm).")
+    nstcgsteep: Optional[int] = Field(
+        None, description="Frequency of steepest descent steps during cg."
+    )
+    nbfgscorr: Optional[int] = Field(
+        None, description="Number of correction steps for l-bfgs."
+    )
+    define: Optional[str] = Field(
+        None, description="Preprocessor defines e.g. -DPOSRES."
+    )
+
+    # Output control
+    nstxout: Optional[int] = Field(
+        None, description="Frequency of trr coordinate frames."
+    )
+    nstvout: Optional[int] = Field(
+        None, description="Frequency of trr velocity frames."
+    )
+    nstfout: Optional[int] = Field(None, description="Frequency of trr force frames.")
+    nstlog: Optional[int] = Field(None, description="Frequency of energies in the log.")
+    nstenergy: Optional[int] = Field(
+        None, description="Frequency of energies in the edr."
+    )
+
+    # Neighbour searching
+    cutoff_scheme: str = Field("Verlet", description="Cut-off scheme.")
+    nstlist: Optional[int] = Field(None, description="Neighbour list update frequency.")
+    pbc: str = Field("xyz", description="Periodic boundary conditions.")
+    rlist: Optional[float] = Field(None, description="Neighbour list cut-off (nm).")
+    verlet_buffer_tolerance: Optional[float] = Field(
+        None, description="Max allowed error due to the Verlet buffer (kJ/mol/ps)."
+    )
+
+    # Electrostatics
+    coulombtype: str = Field("PME", description="Electrostatics treatment.")
+    coulomb_modifier: Optional[str] = Field(
+        None, description="Coulomb potential modifier."
+    )
+    rcoulomb: Optional[float] = Field(None, description="Coulomb cut-off (nm).")
+    epsilon_rf: Optional[float] = Field(
+        None, description="Reaction-field dielectric constant, 0 means infinity."
+    )
+
+    # Van der Waals
+    vdwtype: str = Field("Cut-off", description="Van der Waals treatment.")
+    vdw_modifier: Optional[str] = Field(
+        None, description="Van der Waals potential modifier."
+    )
+    rvdw: Optional[float] = Field(None, description="Van der Waals cut-off (nm).")
+    dispcorr: Optional[str] = Field(
+        None, description="Long range dispersion correction."
+    )
+
+    # Ewald
+    fourierspacing: Optional[float] = Field(
+        None, description="Max PME grid spacing (nm)."
+    )
+    pme_order: Optional[int] = Field(None, description="PME interpolation order.")
+    ewald_rtol: Optional[float] = Field(
+        None, description="Relative strength of the direct potential at the cut-off."
+    )
+
+    # Frozen atoms
+    freezegrps: Optional[str] = Field(None, description="Index groups of frozen atoms.")
+    freezedim: Optional[str] = Field(
+        None, description="Frozen dimensions for each freeze group e.g. Y Y Y."
+    )
+
+    # Bonds
+    constraints: Optional[str] = Field(
+        None, description="Bonds converted to constraints."
+    )
+
+    @classmethod
+    def from_preset(cls, name: str, **overrides: Any) -> "MdpParams":
+        """Builds the parameters from a performance preset, fields in overrides take precedence."""
+        if name not in _presets:
+            raise ValueError(
+                f"Unknown mdp preset {name!r}. Available presets: {', '.join(_presets)}"
+            )
+        return cls(**{**_presets[name], **overrides})
+
+    def to_mdp(self) -> str:
+        """Returns the content of the .mdp file."""
+        return "".join(
+            f"{key.replace('_', '-')} = {val}\n"
+            for key, val in self.dict(exclude_none=True).items()
+        )
@@ -1,15 +1,108 @@
 from cmselemental.models.base import ProtoModel
-from mmic_optim.models import InputOptim
+from mmic_optim.models import OutputOptim
+from .input import InputOptimGmx
 from pydantic import Field
+from typing import Any, Dict, List, Optional, TYPE_CHECKING
+import os
 
+if TYPE_CHECKING:
+    from mmelemental.models import Molecule, Trajectory
 
-__all__ = ["OutputComputeGmx"]
+
+__all__ = ["OutputComputeGmx", "EMAttempt", "FileRef", "OutputOptimGmx"]
 
 
 class OutputComputeGmx(ProtoModel):
-    proc_input: InputOptim = Field(..., description="Procedure input schema.")
+    proc_input: InputOptimGmx = Field(..., description="Procedure input schema.")
     molecule: str = Field(..., description="Molecule file string object")
     trajectory: str = Field(..., description="Trajectory file string object.")
     scratch_dir: str = Field(
         ..., description="The dir containing the traj file and the mold file"
     )
+    energy: Optional[str] = Field(
+        None,
+        description="Energy file string object, only kept if needed by the post stage.",
+    )
+
+
+class EMAttempt(ProtoModel):
+    attempt: int = Field(..., description="1-based number of the attempt.")
+    success: bool = Field(..., description="Whether the attempt finished.")
+    category: Optional[str] = Field(
+        None, description="Category of the gmx failure e.g. non_finite_force."
+    )
+    error: Optional[str] = Field(None, description="Error message of the failure.")
+    changes: Dict[str, Any] = Field(
+        {},
+        description="Input fields changed with respect to the previous attempt.",
+    )
+    wall_time: float = Field(..., description="Duration of the attempt in seconds.")
+
+
+class FileRef(ProtoModel):
+    path: str = Field(..., description="Absolute path of the stored file.")
+    sha256: str = Field(..., description="Hex digest of the content of the file.")
+    size: int = Field(..., description="Size of the file in bytes.")
+
+    def verify(self) -> bool:
+        """Returns whether the file exists with its recorded content."""
+        from ..util.results import file_digest
+
+        return os.path.isfile(self.path) and file_digest(self.path) == self.sha256
+
+    def load(self) -> Any:
+        """
+        Reads the file: the (natoms, 3) coordinates and the box in nm of a
+        .gro, the Trajectory of a .trr or .xtc and the steps and potential
+        energies of an .edr.
+        """
+        ext = os.path.splitext(self.path)[1]
+        if ext == ".gro":
+            from ..util.gro import read_gro_coordinates
+
+            return read_gro_coordinates(self.path)
+        if ext in (".trr", ".xtc"):
+            from mmelemental.models import Trajectory
+
+            return Trajectory.from_file(self.path)
+        if ext == ".edr":
+            from ..util.energy import read_energy
+
+            return read_energy(self.path)
+        raise ValueError(f"Cannot load {ext} files.")
+
+
+class OutputOptimGmx(OutputOptim):
+    proc_input: InputOptimGmx = Field(..., description="Procedure input schema.")
+    lowest_energy_step: Optional[int] = Field(
+        None,
+        description="Step of the returned frame if proc_input.lowest_energy is True.",
+    )
+    lowest_energy: Optional[float] = Field(
+        None,
+        description="Potential energy (kJ/mol) of the returned frame if proc_input.lowest_energy is True.",
+    )
+    attempts: List[EMAttempt] = Field(
+        [],
+        description="Runs of the job, only recorded if proc_input.retry is set.",
+    )
+    files: Dict[str, FileRef] = Field(
+        {},
+        description="Result files returned by reference, keyed molecule, trajectory and energy, "
+        "if proc_input.by_reference is True. molecule and trajectory are then left empty.",
+    )
+
+    def load_molecules(self) -> List["Molecule"]:
+        """Returns the minimized molecules, read from files if returned by reference."""
+        if "molecule" not in self.files:
+            return list(self.molecule)
+
+        from ..components.gmx_post_component import PostGmxComponent
+
+        coords, _ = self.files["molecule"].load()
+        return PostGmxComponent.update_molecules(list(self.proc_input.system), coords)
+
+    def load_trajectory(self) -> Optional["Trajectory"]:
+        """Returns the trajectory read from files, None if not returned by reference."""
+        ref = self.files.get("trajectory")
+        return ref.load() if ref else None
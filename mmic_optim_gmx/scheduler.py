@@ -0,0 +1,383 @@
+"""
+scheduler.py
+Size-aware scheduling of energy minimizations on a fixed number of cores.
+
+Jobs are ordered by their cost predicted by a CostModel, shortest first,
+with the cost of a job lowered by the time it has waited (aging) so that
+big jobs are not starved. A job longer than the remaining queued work
+spread over all the cores starts first, since it alone bounds the
+makespan. A job needing more cores than are free holds its place while
+shorter jobs expected to finish before it can start fill the free cores
+(backfilling). The timings of finished jobs train the cost model.
+
+Jobs belong to a priority class, a class only runs on the cores left by
+the classes above it. A job which does not fit the free cores can
+preempt running jobs of lower classes, most recently started first:
+either by suspending their gmx processes (SIGSTOP, kept in memory and
+continued once cores are free) or by stopping them (SIGTERM) and
+requeueing them. A suspended job in between two gmx programs, e.g. in
+the Python work of the prep or post stage, goes on until its next
+program or stage starts. A stopped job holds its cores until its gmx
+program has exited. A requeued job restarts from scratch, or from its
+last checkpoint if inputs.checkpoint_dir is set.
+
+    with Scheduler(slots=16) as scheduler:
+        futures = [scheduler.submit(inputs, priority="batch") for inputs in batch]
+        output = scheduler.submit(query, priority="interactive").result()
+    print(scheduler.summary())
+"""
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, TYPE_CHECKING
+import itertools
+import os
+import threading
+import time
+
+from .util.cmd import ProcessControl
+from .util.cost import CostModel, job_features
+from .util.errors import GmxPreemptedError
+
+if TYPE_CHECKING:
+    import numpy
+    from .models import InputOptimGmx
+
+__all__ = ["Scheduler", "Job", "priority_classes"]
+
+# Highest priority first
+priority_classes = ("interactive", "normal", "batch")
+
+
+# mdrun options setting its number of threads, -nt is added if none is set
+_thread_keywords = ("-nt", "-ntmpi", "-ntomp")
+
+
+def _compute(inputs: "InputOptimGmx") -> Any:
+    from .components import OptimGmxComponent
+
+    return OptimGmxComponent.compute(inputs)
+
+
+def _with_cores(inputs: "InputOptimGmx", cores: int) -> "InputOptimGmx":
+    """Returns inputs whose mdrun runs on cores threads, unless the job sets its own."""
+    keywords = dict(inputs.keywords or {})
+    if any(key in keywords for key in _thread_keywords):
+        return inputs
+    keywords["-nt"] = str(cores)
+    return inputs.copy(update={"keywords": keywords})
+
+
+class Job:
+    """A submitted job, its predicted cost and its timings (time.time() values)."""
+
+    def __init__(
+        self,
+        id: int,
+        inputs: "InputOptimGmx",
+        cores: int,
+        features: "numpy.ndarray",
+        predicted: float,
+        priority: str = "normal",
+    ):
+        self.id = id
+        self.inputs = inputs
+        self.cores = cores
+        self.features = features
+        self.predicted = predicted
+        self.priority = priority
+        self.rank = priority_classes.index(priority)
+        self.control = ProcessControl()
+        self.suspended = False
+        self.preemptions = 0
+        self.submitted = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.error: Optional[BaseException] = None
+        self.future = Future()
+
+    @property
+    def actual(self) -> Optional[float]:
+        """Wall time of the job in seconds, None until it finished."""
+        if self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def record(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "cores": self.cores,
+            "priority": self.priority,
+            "preemptions": self.preemptions,
+            "predicted": self.predicted,
+            "actual": self.actual,
+            "waited": (self.started or time.time()) - self.submitted,
+            "failed": self.error is not None,
+        }
+
+
+class Scheduler:
+    """
+    Runs jobs on slots cores, see the module docstring for the policy.
+
+    Parameters
+    ----------
+    slots : int, Optional
+        Number of cores shared by the jobs, os.cpu_count() if None.
+    model : CostModel, Optional
+        Cost model of the jobs, trained on the go. A new one if None.
+    aging : float
+        Seconds of predicted cost forgiven per second waited.
+    runner : Callable, Optional
+        Runs the inputs of a job, OptimGmxComponent.compute if None. The
+        inputs get the mdrun option -nt with the cores of the job unless
+        their keywords already set -nt, -ntmpi or -ntomp.
+    preempt : str, Optional
+        How jobs are preempted: "suspend", "requeue" or None to never preempt.
+    """
+
+    def __init__(
+        self,
+        slots: Optional[int] = None,
+        model: Optional[CostModel] = None,
+        aging: float = 0.1,
+        runner: Optional[Callable[["InputOptimGmx"], Any]] = None,
+        preempt: Optional[str] = "requeue",
+    ):
+        if preempt not in ("suspend", "requeue", None):
+            raise ValueError(f"Unknown preemption mode {preempt!r}.")
+        self.slots = slots or os.cpu_count() or 1
+        self.model = model or CostModel()
+        self.aging = aging
+        self.runner = runner or _compute
+        self.preempt = preempt
+        self._cond = threading.Condition()
+        self._ids = itertools.count()
+        self._queue: List[Job] = []
+        self._running: List[Job] = []
+        # Preempted jobs whose programs are being stopped
+        self._stopping: List[Job] = []
+        self._done: List[Job] = []
+        self._closed = False
+
+    def submit(
+        self, inputs: "InputOptimGmx", cores: int = 1, priority: str = "normal"
+    ) -> Future:
+        """
+        Queues a job using cores cores in one of the priority_classes,
+        returns the future of its output.
+        """
+        if not 1 <= cores <= self.slots:
+            raise ValueError(f"A job can use 1 to {self.slots} cores, not {cores}.")
+        if priority not in priority_classes:
+            raise ValueError(
+                f"Unknown priority {priority!r}. Priority classes: {', '.join(priority_classes)}"
+            )
+
+        features = job_features(inputs)
+        job = Job(
+            next(self._ids),
+            inputs,
+            cores,
+            features,
+            self.model.predict_features(features),
+            priority,
+        )
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("The scheduler is shut down.")
+            self._queue.append(job)
+            self._dispatch()
+        return job.future
+
+    def map(
+        self, inputs: List["InputOptimGmx"], cores: int = 1, priority: str = "normal"
+    ) -> List[Any]:
+        """Runs all the jobs and returns their outputs in order."""
+        futures = [self.submit(job, cores, priority) for job in inputs]
+        return [future.result() for future in futures]
+
+    def shutdown(self, wait: bool = True):
+        """Stops accepting jobs, waits for the queued and running ones if wait."""
+        with self._cond:
+            self._closed = True
+            if wait:
+                self._cond.wait_for(
+                    lambda: not (self._queue or self._running or self._stopping)
+                )
+
+    def __enter__(self) -> "Scheduler":
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def report(self) -> List[Dict[str, Any]]:
+        """Returns the predicted and actual cost of every job, finished jobs first."""
+        with self._cond:
+            jobs = self._done + self._running + self._stopping + self._queue
+            return [job.record() for job in jobs]
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Returns the numbers of jobs, the relative error of the predicted
+        costs of the finished jobs and the predicted time (s) to run the
+        queued and running jobs on all the slots.
+        """
+        now = time.time()
+        with self._cond:
+            done = [job for job in self._done if job.error is None]
+            errors = [
+                abs(job.predicted - job.actual) / max(job.actual, 1e-3) for job in done
+            ]
+            work = sum(job.predicted * job.cores for job in self._queue)
+            work += sum(
+                max(job.started + job.predicted - now, 0.0) * job.cores
+                for job in self._running
+            )
+            return {
+                "queued": len(self._queue),
+                "running": len(self._running),
+                "preemptions": sum(
+                    job.preemptions
+                    for job in self._done + self._running + self._stopping + self._queue
+                ),
+                "finished": len(self._done),
+                "mean_error": sum(errors) / len(errors) if errors else None,
+                "max_error": max(errors) if errors else None,
+                "predicted_backlog": work / self.slots,
+            }
+
+    # Called with self._cond held
+    def _dispatch(self):
+        self._queue = [job for job in self._queue if not job.future.cancelled()]
+        now = time.time()
+        # Stopped jobs use their cores until their program has exited
+        free = self.slots - sum(job.cores for job in self._running + self._stopping)
+        while self._queue and free > 0:
+            job = self._next(now, free)
+            if job is None:
+                break
+            self._queue.remove(job)
+            if self._start(job, now):
+                free -= job.cores
+
+        if not self._queue or not self.preempt:
+            return
+        head = self._order(now)[0]
+        # Cores freed once the jobs being stopped have exited
+        free += sum(job.cores for job in self._stopping)
+        if head.cores <= free:
+            return
+        victims = []
+        for job in sorted(self._running, key=lambda job: job.started, reverse=True):
+            if free >= head.cores:
+                break
+            if job.rank > head.rank:
+                victims.append(job)
+                free += job.cores
+        if free >= head.cores:
+            for job in victims:
+                self._preempt(job)
+            self._dispatch()
+
+    def _order(self, now: float) -> List[Job]:
+        """Returns the queued jobs in the order they should start."""
+        top = min(job.rank for job in self._queue)
+        jobs = [job for job in self._queue if job.rank == top]
+        others = [job for job in self._queue if job.rank != top]
+
+        def score(job: Job):
+            # Suspended jobs go first, they hold on to their memory
+            return (
+                not job.suspended,
+                job.predicted - self.aging * (now - job.submitted),
+            )
+
+        order = sorted(jobs, key=score)
+        longest = max(jobs, key=lambda job: job.predicted)
+        work = sum(job.predicted * job.cores for job in jobs)
+        if longest.predicted * self.slots >= work:
+            order.remove(longest)
+            order.insert(0, longest)
+        return order + sorted(others, key=lambda job: (job.rank, score(job)))
+
+    def _next(self, now: float, free: int) -> Optional[Job]:
+        order = self._order(now)
+        head = order[0]
+        if head.cores <= free:
+            return head
+
+        # Earliest time enough cores are free for head, from the predicted
+        # ends of the running jobs
+        shadow, cores = now, free
+        for job in sorted(self._running, key=lambda job: job.started + job.predicted):
+            shadow = max(job.started + job.predicted, now)
+            cores += job.cores
+            if cores >= head.cores:
+                break
+
+        for job in order[1:]:
+            if job.cores <= free and now + job.predicted <= shadow:
+                return job
+        return None
+
+    def _preempt(self, job: Job):
+        self._running.remove(job)
+        job.preemptions += 1
+        if self.preempt == "suspend":
+            job.control.suspend()
+            job.suspended = True
+            self._queue.append(job)
+        else:
+            job.control.stop()
+            self._stopping.append(job)
+
+    def _start(self, job: Job, now: float) -> bool:
+        if job.suspended:
+            job.suspended = False
+            job.control.resume()
+            self._running.append(job)
+            return True
+        if not job.future.running() and not job.future.set_running_or_notify_cancel():
+            return False
+        job.started = now
+        self._running.append(job)
+        threading.Thread(
+            target=self._run, args=(job,), name=f"mmic_optim_gmx-job{job.id}"
+        ).start()
+        return True
+
+    def _run(self, job: Job):
+        result = None
+        try:
+            with job.control:
+                result = self.runner(_with_cores(job.inputs, job.cores))
+        except BaseException as e:
+            job.error = e
+        finished = time.time()
+
+        with self._cond:
+            for jobs in (self._running, self._stopping, self._queue):
+                if job in jobs:
+                    jobs.remove(job)
+            # Also requeued when waiting on an identical preempted request
+            requeue = isinstance(job.error, GmxPreemptedError)
+            if requeue:
+                job.error = None
+                job.suspended = False
+                job.control = ProcessControl()
+                self._queue.append(job)
+            else:
+                job.finished = finished
+                self._done.append(job)
+            self._dispatch()
+            self._cond.notify_all()
+
+        if requeue:
+            return
+        if job.error is None:
+            # Preempted jobs did not run in one go, their time is not the job cost
+            if not job.preemptions:
+                self.model.observe(job.features, job.actual)
+            job.future.set_result(result)
+        else:
+            job.future.set_exception(job.error)
@@ -10,9 +10,14 @@ from mmelemental.models import Molecule, Trajectory, ForceField
 import mmic_optim_gmx
 
 from mmic_optim_gmx.components import OptimGmxComponent
+from mmic_optim_gmx.components.gmx_prep_component import PrepGmxComponent
+from mmic_optim_gmx.models import InputOptimGmx
+from mmic_optim_gmx.util import translate_method
 
 import mm_data
 import pytest
+import json
+import subprocess
 import sys
 import os
 
@@ -22,6 +27,37 @@ def test_mmic_optim_gmx_imported():
     assert "mmic_optim_gmx" in sys.modules
 
 
+def _imported_modules(statement):
+    code = f"import sys; {statement}; print(' '.join(sys.modules))"
+    out = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    return set(out.split())
+
+
+def test_import_time():
+    """
+    Importing the package or the components must not load the models
+    and the heavy dependencies, they are only loaded when a component
+    is computed
+    """
+    heavy = (
+        "mmic_optim_gmx.models",
+        "mmelemental",
+        "mmic_optim",
+        "parmed",
+        "MDAnalysis",
+    )
+    for statement in (
+        "import mmic_optim_gmx",
+        "from mmic_optim_gmx.components import OptimGmxComponent",
+    ):
+        modules = _imported_modules(statement)
+        assert "mmic_optim_gmx" in modules
+        for module in heavy:
+            assert module not in modules, f"{statement!r} imports {module}"
+
+
 def test_preprocess_component():
     """
     This test reads the mol and ff files in data/ and
@@ -60,6 +96,1041 @@ def test_preprocess_component():
     outputs = OptimGmxComponent.compute(inputs)
 
 
+def water_inputs(**kwargs):
+    mol = mmelemental.models.Molecule.from_file(mm_data.mols["water-mol.json"])
+    ff = mmelemental.models.ForceField.from_file(mm_data.ffs["water-ff.json"])
+
+    return InputOptimGmx(
+        engine="gmx",
+        schema_name="test",
+        schema_version=1.0,
+        system={mol: ff},
+        boundary=(
+            "periodic",
+            "periodic",
+            "periodic",
+            "periodic",
+            "periodic",
+            "periodic",
+        ),
+        cell=(0, 0, 0, 1, 1, 1),
+        max_steps=10,
+        step_size=0.01,
+        tol=1000,
+        method="steepest descent",
+        long_forces={"method": "PME"},
+        short_forces={"method": "cutoff"},
+        **kwargs,
+    )
+
+
+def test_protocol():
+    """
+    Runs a steep -> cg protocol where the second stage
+    starts from the confout of the first one
+    """
+    inputs = water_inputs(
+        protocol=[
+            {"method": "steepest descent", "max_steps": 5},
+            {"method": "conjugate gradient", "max_steps": 5},
+        ]
+    )
+    outputs = OptimGmxComponent.compute(inputs)
+    assert len(outputs.molecule) == 1
+
+
+def test_cutoff_prepass():
+    inputs = water_inputs(cutoff_prepass=True)
+    prepass, polish = inputs.stages()
+    assert PrepGmxComponent.build_mdp(inputs, prepass).coulombtype == "Reaction-Field"
+    assert PrepGmxComponent.build_mdp(inputs, polish).coulombtype == "PME"
+
+    outputs = OptimGmxComponent.compute(inputs)
+    assert len(outputs.molecule) == 1
+
+
+def test_freeze_and_restrain():
+    inputs = water_inputs(freeze=[0], restrain=[1, 2])
+    mdp = PrepGmxComponent.build_mdp(inputs)
+    assert mdp.freezegrps == "Frozen"
+    assert mdp.define == "-DPOSRES_MMIC"
+
+    outputs = OptimGmxComponent.compute(inputs)
+    assert len(outputs.molecule) == 1
+
+
+def test_restraint_reference(monkeypatch):
+    """
+    Every stage restrains to the starting coordinates written by prep,
+    not to the confout of the previous stage
+    """
+    from mmic_optim_gmx.components.gmx_compute_component import ComputeGmxComponent
+
+    inputs = water_inputs(
+        restrain=[0],
+        protocol=[
+            {"method": "steepest descent", "max_steps": 5},
+            {"method": "conjugate gradient", "max_steps": 5},
+        ],
+    )
+    computeInput = PrepGmxComponent.compute(inputs)
+    assert computeInput.reference_file != computeInput.molecule
+    with open(computeInput.reference_file) as ref, open(computeInput.molecule) as gro:
+        assert ref.read() == gro.read()
+
+    program = ComputeGmxComponent(
+        name="ComputeGmxComponent",
+        scratch=False,
+        thread_safe=False,
+        thread_parallel=False,
+        node_parallel=False,
+        managed_memory=False,
+        extras=None,
+    )
+    _, cmd_input = program.build_input_grompp(
+        {
+            "proc_input": inputs,
+            "mdp_file": computeInput.mdp_file,
+            "gro_file": computeInput.molecule,
+            "top_file": computeInput.forcefield,
+            "tpr_file": "out.tpr",
+            "reference_file": computeInput.reference_file,
+        }
+    )
+    cmd = cmd_input["command"]
+    assert cmd[cmd.index("-r") + 1] == computeInput.reference_file
+    ComputeGmxComponent.cleanup(
+        [
+            computeInput.mdp_file,
+            computeInput.forcefield,
+            computeInput.molecule,
+            computeInput.reference_file,
+            computeInput.scratch_dir,
+        ]
+    )
+
+    reference_files = []
+    run_stage = OptimGmxComponent.run_stage.__func__
+
+    def record(cls, component, stage_input):
+        if component is ComputeGmxComponent:
+            reference_files.append(stage_input.reference_file)
+        return run_stage(cls, component, stage_input)
+
+    monkeypatch.setattr(OptimGmxComponent, "run_stage", classmethod(record))
+    outputs = OptimGmxComponent.compute(inputs)
+    assert len(outputs.molecule) == 1
+    assert len(reference_files) == 2 and len(set(reference_files)) == 1
+    assert not os.path.exists(reference_files[0])
+
+
+def test_translate_method():
+    assert translate_method("Steepest Descent") == {"integrator": "steep"}
+    assert translate_method("conjugate_gradient")["nstcgsteep"] > 0
+    assert translate_method("L-BFGS")["integrator"] == "l-bfgs"
+
+    with pytest.raises(ValueError):
+        translate_method("newton")
+
+    # Unsupported methods are rejected before any gmx process is launched
+    with pytest.raises(ValueError):
+        water_inputs(protocol=[{"method": "newton"}])
+
+
+def test_mdp_presets():
+    inputs = water_inputs(preset="fast", mdp={"rvdw": 1.1, "pme-order": 5})
+    mdp = PrepGmxComponent.build_mdp(inputs)
+    assert mdp.cutoff_scheme == "Verlet"
+    assert mdp.fourierspacing == 0.16
+    assert mdp.rvdw == 1.1
+    assert mdp.pme_order == 5
+    assert "pme-order = 5" in mdp.to_mdp()
+
+    with pytest.raises(ValueError):
+        water_inputs(preset="fastest")
+    with pytest.raises(ValueError):
+        water_inputs(mdp={"not-a-key": 1})
+
+
+def test_worker():
+    from mmic_optim_gmx.worker import Worker
+
+    worker = Worker()
+    assert (
+        json.loads(worker.handle('{"jsonrpc": "2.0", "id": 1, "method": "ping"}'))[
+            "result"
+        ]
+        == "pong"
+    )
+    caps = json.loads(worker.handle('{"id": 2, "method": "capabilities"}'))["result"]
+    assert "mmic_optim_gmx.models" in caps["modules"]
+    assert (
+        json.loads(worker.handle('{"id": 3, "method": "nope"}'))["error"]["code"]
+        == -32601
+    )
+    # Notifications get no response, even when they fail
+    assert worker.handle('{"method": "nope"}') is None
+    assert worker.handle('{"method": "ping", "params": {"x": 1}}') is None
+
+    mol = mmelemental.models.Molecule.from_file(mm_data.mols["water-mol.json"])
+    ff = mmelemental.models.ForceField.from_file(mm_data.ffs["water-ff.json"])
+    params = json.loads(water_inputs().json(exclude={"system"}))
+    params["system"] = [[json.loads(mol.json()), json.loads(ff.json())]]
+    request = json.dumps({"id": 4, "method": "compute", "params": params})
+    assert "result" in json.loads(worker.handle(request))
+    assert worker.served == 1
+
+    worker._compute(params)
+    assert isinstance(params["system"], list)
+
+
+def test_read_gro_coordinates(tmp_path):
+    from mmic_optim_gmx.util.gro import read_gro_coordinates
+    import numpy
+
+    gro_file = tmp_path / "water.gro"
+    gro_file.write_text(
+        "water\n"
+        "    3\n"
+        "    1SOL     OW    1   0.126   1.624   1.679\n"
+        "    1SOL    HW1    2   0.190   1.661   1.747\n"
+        "    1SOL    HW2    3  -0.177   1.568   1.613\n"
+        "   1.86206   1.86206   1.86206\n"
+    )
+    coords, box = read_gro_coordinates(str(gro_file))
+    assert coords.shape == (3, 3)
+    assert numpy.allclose(coords[2], [-0.177, 1.568, 1.613])
+    assert numpy.allclose(box, 1.86206)
+
+
+def test_output_topology_shared():
+    """Only the coordinates of the output molecule come from the confout"""
+    inputs = water_inputs()
+    (mol,) = inputs.system
+    (outmol,) = OptimGmxComponent.compute(inputs).molecule
+    assert outmol.symbols is mol.symbols or list(outmol.symbols) == list(mol.symbols)
+    assert outmol.geometry.shape == mol.geometry.shape
+
+
+def write_trr(trr_file, frames, step=5):
+    """Writes a single precision .trr with a box and coordinates per frame"""
+    import numpy
+    import struct
+
+    with open(trr_file, "wb") as fp:
+        for i, x in enumerate(frames):
+            natoms = len(x)
+            fp.write(struct.pack(">iii", 1993, 13, 12) + b"GMX_trn_file")
+            fp.write(
+                struct.pack(
+                    ">13i", 0, 0, 36, 0, 0, 0, 0, 12 * natoms, 0, 0, natoms, i * step, 0
+                )
+            )
+            fp.write(struct.pack(">ff", i * step * 0.001, 0.0))
+            fp.write(numpy.eye(3, dtype=">f4").tobytes())
+            fp.write(numpy.asarray(x, dtype=">f4").tobytes())
+
+
+def test_trajectory_index(tmp_path):
+    from mmic_optim_gmx.components.gmx_post_component import PostGmxComponent
+    import numpy
+
+    frames = numpy.random.rand(4, 10, 3)
+    trr_file = str(tmp_path / "traj.trr")
+    write_trr(trr_file, frames)
+
+    index = PostGmxComponent.index_trajectory(trr_file)
+    assert len(index) == 4
+    assert list(index.steps) == [0, 5, 10, 15]
+    assert numpy.allclose(index.positions(2), frames[2], atol=1e-6)
+    assert numpy.allclose(index.box(3), numpy.eye(3))
+
+    # Second time around the offsets come from the sidecar file
+    assert os.path.isfile(index.sidecar(trr_file))
+    index = PostGmxComponent.index_trajectory(trr_file)
+    assert numpy.allclose(
+        index.positions(index.frame_at_step(15)), frames[3], atol=1e-6
+    )
+
+
+def test_truncated_xtc(tmp_path):
+    """A last frame cut short, e.g. by a killed mdrun, is left out of the index"""
+    from mmic_optim_gmx.util.trajectory import TrajectoryIndex
+    import numpy
+    import struct
+
+    frames = numpy.random.rand(3, 3, 3)
+    data = b""
+    for i, x in enumerate(frames):  # Up to 9 atoms, stored uncompressed
+        data += struct.pack(">iiif", 1995, 3, i, float(i))
+        data += numpy.eye(3, dtype=">f4").tobytes() + struct.pack(">i", 3)
+        data += numpy.asarray(x, dtype=">f4").tobytes()
+
+    xtc_file = tmp_path / "traj.xtc"
+    for cut in (1, 40, 80):
+        xtc_file.write_bytes(data[:-cut])
+        index = TrajectoryIndex.build(str(xtc_file), sidecar=False)
+        assert len(index) == 2
+        assert numpy.allclose(index.positions(1), frames[1], atol=1e-6)
+
+    # Compressed frame whose size is cut off
+    xtc_file.write_bytes(struct.pack(">iiif", 1995, 100, 0, 0.0) + bytes(60))
+    assert len(TrajectoryIndex.build(str(xtc_file), sidecar=False)) == 0
+
+
+def test_checkpoint_resume(tmp_path):
+    from mmic_optim_gmx.util.checkpoint import Checkpoint
+    from mmic_optim_gmx.util.gro import read_gro_coordinates, write_gro_coordinates
+    import numpy
+
+    checkpoint = Checkpoint(str(tmp_path / "job"), 0)
+    frames = numpy.random.rand(3, 3, 3)
+    write_trr(checkpoint.trajectory, frames)
+    # A frame cut short by a killed mdrun is ignored
+    with open(checkpoint.trajectory, "ab") as fp:
+        fp.write(b"\x00\x00\x07\xc9")
+
+    step, coords, box = checkpoint.last_frame()
+    assert step == 10
+    assert numpy.allclose(coords, frames[2], atol=1e-6)
+
+    gro_file = tmp_path / "water.gro"
+    gro_file.write_text(
+        "water\n"
+        "    3\n"
+        "    1SOL     OW    1   0.126   1.624   1.679\n"
+        "    1SOL    HW1    2   0.190   1.661   1.747\n"
+        "    1SOL    HW2    3  -0.177   1.568   1.613\n"
+        "   1.86206   1.86206   1.86206\n"
+    )
+    write_gro_coordinates(str(gro_file), str(gro_file), coords, box)
+    checkpoint.restart(str(gro_file), step)
+    assert checkpoint.steps_done() == 10
+    assert not os.path.isfile(checkpoint.trajectory)
+    assert numpy.allclose(read_gro_coordinates(checkpoint.start)[0], coords, atol=1e-3)
+
+    Checkpoint.clear(checkpoint.directory)
+    assert not os.path.isdir(checkpoint.directory)
+
+
+def test_lowest_energy():
+    outputs = OptimGmxComponent.compute(water_inputs(lowest_energy=True))
+    assert outputs.lowest_energy_step is not None
+    assert outputs.lowest_energy < 0
+
+
+def test_classify_errors():
+    from mmic_optim_gmx.util import errors
+
+    grompp = (
+        "WARNING 1 [file topol.top, line 12]:\n"
+        "  The bond in molecule-type SOL has a zero force constant\n"
+        "\n"
+        "ERROR 1 [file topol.top, line 20]:\n"
+        "  No default Bond types\n"
+        "\n"
+        "-------------------------------------------------------\n"
+        "Program:     gmx grompp, version 2021\n"
+        "\n"
+        "Fatal error:\n"
+        "There was 1 error in input file(s)\n"
+        "\n"
+        "For more information and tips for troubleshooting, please check the GROMACS\n"
+    )
+    error = errors.classify("grompp", grompp)
+    assert isinstance(error, errors.GromppError)
+    assert "No default Bond types" in str(error)
+    assert len(error.warnings) == 1
+
+    mdrun = (
+        "Energy minimization has stopped because the force on at least one atom "
+        "is not finite. This usually means atoms are overlapping.\n"
+    )
+    error = errors.classify("mdrun", mdrun)
+    assert isinstance(error, errors.NonFiniteForceError)
+    assert error.retryable
+
+    assert (
+        errors.classify("mdrun", "Steepest Descents converged to Fmax < 1000") is None
+    )
+
+    with pytest.raises(errors.GromppError):
+        OptimGmxComponent.compute(water_inputs(mdp={"integrator": "md-vv-not"}))
+
+
+def test_exit_status():
+    from mmic_optim_gmx.util import errors
+    from mmic_optim_gmx.util.cmd import run_gmx
+
+    def run(script):
+        return run_gmx("mdrun", {"command": ["sh", "-c", script], "outfiles": []})
+
+    with pytest.raises(errors.SegmentationFaultError) as crash:
+        run("kill -SEGV $$")
+    assert crash.value.category in water_inputs(retry={}).retry.retry_on
+
+    with pytest.raises(errors.MdrunError, match="code 3"):
+        run("exit 3")
+    with pytest.raises(errors.GmxError, match="SIGKILL"):
+        run("kill -KILL $$")
+    assert run("exit 0").returncode == 0
+
+    with pytest.raises(errors.GmxError, match="could not be started"):
+        run_gmx("mdrun", {"command": ["no-such-gmx", "mdrun"], "outfiles": []})
+
+
+def test_retry():
+    from mmic_optim_gmx.util.errors import NonFiniteForceError
+
+    inputs = water_inputs(method="conjugate gradient", retry={"max_attempts": 2})
+    changes = OptimGmxComponent.adjust_inputs(
+        inputs, NonFiniteForceError("mdrun failed"), inputs.retry
+    )
+    assert changes["step_size"] == pytest.approx(0.005)
+    assert changes["method"] == "steepest descent"
+    assert changes["max_steps"] == 20
+    assert changes["cutoff_prepass"]
+
+    outputs = OptimGmxComponent.compute(inputs)
+    assert len(outputs.attempts) == 1
+    assert outputs.attempts[0].success
+
+
+def test_timeout():
+    from mmic_optim_gmx.util.cmd import run_gmx
+    from mmic_optim_gmx.util.errors import GmxTimeoutError
+    import time
+
+    # The child of the shell is in the same process group and stopped too
+    cmd_input = {"command": ["sh", "-c", "sleep 30 & wait"], "outfiles": []}
+    start = time.time()
+    with pytest.raises(GmxTimeoutError) as error:
+        run_gmx("mdrun", cmd_input, timeout=0.5)
+    assert error.value.category == "timeout"
+    assert time.time() - start < 10
+
+    with pytest.raises(TimeoutError):
+        OptimGmxComponent.compute(water_inputs(timeout=1e-6))
+
+
+def test_new_file_concurrent(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    from mmic_optim_gmx.util.workspace import new_file
+
+    with ThreadPoolExecutor(64) as pool:
+        paths = list(pool.map(lambda _: new_file(".gro", str(tmp_path)), range(1000)))
+    assert len(set(paths)) == 1000
+    assert all(os.path.isfile(path) for path in paths)
+
+
+def test_new_path_and_prep_cleanup(tmp_path):
+    """
+    Files written by ParmEd do not exist beforehand, and a failed prep
+    leaves nothing behind in the work dir, scratch directories included
+    """
+    from mmic_optim_gmx.util.workspace import new_path
+
+    paths = {new_path(".top", str(tmp_path)) for _ in range(1000)}
+    assert len(paths) == 1000
+    assert all(
+        os.path.dirname(path) == str(tmp_path) and not os.path.exists(path)
+        for path in paths
+    )
+
+    with pytest.raises(ValueError):
+        PrepGmxComponent.compute(water_inputs(restrain=[100], work_dir=str(tmp_path)))
+    assert os.listdir(tmp_path) == []
+
+
+def test_concurrent_pipelines():
+    """Hundreds of jobs run in threads of one process, each in its own work dir"""
+    from concurrent.futures import ThreadPoolExecutor
+    import glob
+    import tempfile
+
+    pattern = os.path.join(tempfile.gettempdir(), "mmic_optim_gmx_*")
+    before = set(glob.glob(pattern))
+
+    with ThreadPoolExecutor(16) as pool:
+        outputs = list(
+            pool.map(
+                lambda i: OptimGmxComponent.compute(
+                    water_inputs().copy(update={"max_steps": 10 + i})
+                ),
+                range(200),
+            )
+        )
+    assert all(len(output.molecule) == 1 for output in outputs)
+    assert set(glob.glob(pattern)) == before
+
+
+def test_compute_batch():
+    """Without an MPI build of gmx the -multidir launch falls back to one mdrun per job"""
+    from mmic_optim_gmx.components.gmx_compute_component import ComputeGmxComponent
+    from mmic_optim_gmx.components.gmx_post_component import PostGmxComponent
+    from unittest import mock
+    import shutil
+
+    mpi = shutil.which("gmx_mpi") and shutil.which("mpirun")
+    jobs = [PrepGmxComponent.compute(water_inputs()) for _ in range(3)]
+    outputs = ComputeGmxComponent.compute_batch(
+        jobs, engine="gmx_mpi" if mpi else "gmx", launcher=None if mpi else []
+    )
+    assert len(outputs) == 3
+    for output in outputs:
+        assert len(PostGmxComponent.compute(output).molecule) == 1
+
+    # Jobs with different mdrun keywords are not run with the same options
+    jobs = [
+        PrepGmxComponent.compute(water_inputs(keywords=keywords))
+        for keywords in ({"-nt": "1"}, {"-nt": "2"})
+    ]
+    with mock.patch.object(ComputeGmxComponent, "run_multidir") as run_multidir:
+        outputs = ComputeGmxComponent.compute_batch(jobs, engine="gmx", launcher=[])
+    run_multidir.assert_not_called()
+    assert all(
+        len(PostGmxComponent.compute(output).molecule) == 1 for output in outputs
+    )
+
+    # A launcher which cannot be started also falls back to one mdrun per job
+    jobs = [PrepGmxComponent.compute(water_inputs()) for _ in range(2)]
+    outputs = ComputeGmxComponent.compute_batch(jobs, launcher=["no-such-mpirun"])
+    assert all(
+        len(PostGmxComponent.compute(output).molecule) == 1 for output in outputs
+    )
+
+
+def test_tpr_cache(tmp_path):
+    from mmic_optim_gmx.util.tpr import TprCache, tpr_key
+
+    mdp = tmp_path / "em.mdp"
+    mdp.write_text("integrator = steep\nnsteps = 10\n")
+    key, nsteps = tpr_key(str(mdp), [None])
+    assert nsteps == 10
+    mdp.write_text("integrator = steep\nnsteps = 20\n")
+    assert tpr_key(str(mdp), [None]) == (key, 20)
+
+    cache = TprCache(str(tmp_path / "cache"))
+    assert cache.get(key, 20) == (None, False)
+    cache.put(key, 10, str(mdp))
+    assert cache.get(key, 20)[1] is False
+    assert cache.get(key, 10)[1] is True
+
+    # The second run only changes nsteps and skips grompp
+    cache_dir = str(tmp_path / "tpr")
+    for max_steps in (10, 20):
+        outputs = OptimGmxComponent.compute(
+            water_inputs(tpr_cache=cache_dir).copy(update={"max_steps": max_steps})
+        )
+        assert len(outputs.molecule) == 1
+    assert len(os.listdir(cache_dir)) == 2
+
+
+WATER_TOP = """
+[ defaults ]
+1 2 yes 0.5 0.8333
+
+[ atomtypes ]
+OW 8 15.9994 0.0 A 0.315 0.636
+HW 1 1.008 0.0 A 0.0 0.0
+
+[ moleculetype ]
+SOL 2
+
+[ atoms ]
+1 OW 1 SOL OW 1 -0.834 15.9994
+2 HW 1 SOL HW1 1 0.417 1.008
+3 HW 1 SOL HW2 1 0.417 1.008
+
+[ system ]
+water
+
+[ molecules ]
+SOL 1
+"""
+
+
+def test_merge_topologies(tmp_path):
+    from mmic_optim_gmx.util.topology import merge_topologies, read_molecules
+
+    top_files = []
+    for i, text in enumerate((WATER_TOP, WATER_TOP, WATER_TOP.replace("HW2", "HW3"))):
+        top_files.append(str(tmp_path / f"mol{i}.top"))
+        with open(top_files[-1], "w") as fp:
+            fp.write(text)
+
+    out_file = str(tmp_path / "system.top")
+    merge_topologies(top_files, out_file)
+    natoms, molecules = read_molecules(out_file)
+    # Identical molecule types are shared, different ones renamed
+    assert natoms == {"SOL": 3, "SOL_2": 3}
+    assert molecules == [("SOL", 2), ("SOL_2", 1)]
+
+
+def test_add_molecule_types(tmp_path):
+    from mmic_optim_gmx.util.topology import add_molecule_types, read_molecules
+
+    ion = "[ moleculetype ]\nNA 1\n\n[ atoms ]\n1 NA 1 NA NA 1 1.0 22.99\n"
+    untyped = (
+        WATER_TOP[: WATER_TOP.index("[ atomtypes ]")]
+        + WATER_TOP[WATER_TOP.index("[ moleculetype ]") :]
+    )
+    for text in (WATER_TOP, untyped):
+        top_file = tmp_path / "system.top"
+        top_file.write_text(text)
+        add_molecule_types(
+            str(top_file), ["NA 11 22.99 0.0 A 0.333 0.0116"], [ion], [("NA", 2)]
+        )
+        lines = top_file.read_text().splitlines()
+
+        # The atom type is defined once, right after [ defaults ]
+        assert lines.count("[ atomtypes ]") == 1
+        assert lines.index("[ atomtypes ]") > lines.index("[ defaults ]")
+        assert lines.index("[ atomtypes ]") < lines.index("[ moleculetype ]")
+        assert "NA 11 22.99 0.0 A 0.333 0.0116" in lines
+        assert read_molecules(str(top_file)) == (
+            {"SOL": 3, "NA": 1},
+            [("SOL", 1), ("NA", 2)],
+        )
+
+
+def test_multi_molecule_system():
+    """A complex of several molecules is minimized in one mdrun"""
+    inputs = water_inputs()
+    (mol,) = inputs.system
+    ff = inputs.system[mol]
+    other = mol.copy(update={"geometry": mol.geometry + 5.0})
+    inputs = inputs.copy(update={"system": {mol: ff, other: ff}})
+
+    outputs = OptimGmxComponent.compute(inputs)
+    assert len(outputs.molecule) == 2
+    for outmol, inmol in zip(outputs.molecule, (mol, other)):
+        assert outmol.geometry.shape == inmol.geometry.shape
+
+
+def test_place_ions(tmp_path):
+    from mmic_optim_gmx.util.solvent import ion_counts, place_ions, replace_with_ions
+    from mmic_optim_gmx.util.gro import read_gro_coordinates
+    import numpy
+
+    # 1 M of salt in 10 nm**3 plus the ions neutralizing a charge of -2
+    assert ion_counts(-2.0, 10.0, 1.0) == {"NA": 8, "CL": 6}
+
+    # A solute atom at the origin and a line of waters along x
+    lines = ["    1LIG     C1    1   0.000   0.000   0.000\n"]
+    for i in range(10):
+        x = 0.3 * (i + 1)
+        lines += [
+            f"{i + 2:5d}SOL     OW{0:5d}{x:8.3f}   1.000   1.000\n",
+            f"{i + 2:5d}SOL    HW1{0:5d}{x:8.3f}   1.100   1.000\n",
+            f"{i + 2:5d}SOL    HW2{0:5d}{x:8.3f}   1.000   1.100\n",
+        ]
+    gro_file = tmp_path / "solvated.gro"
+    gro_file.write_text(
+        "box\n" + f"{len(lines):5d}\n" + "".join(lines) + "   6.0 6.0 6.0\n"
+    )
+
+    coords, box = read_gro_coordinates(str(gro_file))
+    picked = place_ions(coords, box, 1, 10, 3, 2, min_distance=0.6)
+    assert len(set(picked)) == 2
+    oxygens = coords[1::3]
+    assert all(numpy.linalg.norm(oxygens[i]) >= 0.6 for i in picked)
+    assert abs(oxygens[picked[0], 0] - oxygens[picked[1], 0]) >= 0.6
+
+    out_file = tmp_path / "ions.gro"
+    replace_with_ions(str(gro_file), str(out_file), 1, 3, picked, ["NA", "CL"])
+    out, _ = read_gro_coordinates(str(out_file))
+    assert len(out) == 1 + 8 * 3 + 2
+    assert out_file.read_text().splitlines()[-3][5:10].strip() == "NA"
+
+
+def test_single_flight():
+    from concurrent.futures import ThreadPoolExecutor
+    from mmic_optim_gmx.util.singleflight import SingleFlight, request_key
+    import threading
+
+    assert request_key(water_inputs()) == request_key(water_inputs())
+    assert request_key(water_inputs()) != request_key(water_inputs(preset="fast"))
+
+    flight, calls, release = SingleFlight(), [], threading.Event()
+
+    def work():
+        calls.append(1)
+        release.wait()
+        return object()
+
+    with ThreadPoolExecutor(8) as pool:
+        futures = [pool.submit(flight.do, "key", work) for _ in range(8)]
+        while flight._calls["key"].waiters < 7:
+            pass
+        release.set()
+        results = [future.result() for future in futures]
+
+    assert len(calls) == 1
+    assert len({id(result) for result, _ in results}) == 1
+    assert sum(shared for _, shared in results) == 7
+
+    # The key follows the coordinates of the system
+    inputs = water_inputs()
+    mol, ff = next(iter(inputs.system.items()))
+    moved = mol.copy(update={"geometry": mol.geometry + 0.1})
+    assert request_key(inputs) != request_key(
+        inputs.copy(update={"system": {moved: ff}})
+    )
+
+
+def test_single_flight_component():
+    """Opt-in, every caller of a shared execution gets its own output"""
+    from concurrent.futures import ThreadPoolExecutor
+    from unittest import mock
+    from mmic.components.blueprints import TacticComponent
+    from mmic_optim_gmx.components.gmx_optim_component import _inflight
+    from mmic_optim_gmx.models import OutputOptimGmx
+    import numpy
+    import threading
+
+    assert not OptimGmxComponent.single_flight
+
+    calls, release = [], threading.Event()
+
+    def compute(cls, inputs):
+        calls.append(1)
+        release.wait()
+        return OutputOptimGmx(
+            proc_input=inputs,
+            molecule=list(inputs.system),
+            trajectory={},
+            schema_name=inputs.schema_name,
+            schema_version=inputs.schema_version,
+            success=True,
+        )
+
+    with mock.patch.object(
+        TacticComponent, "compute", classmethod(compute)
+    ), mock.patch.object(OptimGmxComponent, "single_flight", True):
+        with ThreadPoolExecutor(4) as pool:
+            futures = [
+                pool.submit(OptimGmxComponent.compute, water_inputs()) for _ in range(4)
+            ]
+            while sum(call.waiters for call in _inflight._calls.values()) < 3:
+                pass
+            release.set()
+            outputs = [future.result() for future in futures]
+
+    assert len(calls) == 1
+    assert len({id(output) for output in outputs}) == 4
+
+    # Changing the molecules of one output leaves the others untouched
+    before = outputs[0].molecule[0].geometry.copy()
+    for output in outputs[1:]:
+        output.molecule[0].geometry[0] += 1.0
+    assert numpy.array_equal(outputs[0].molecule[0].geometry, before)
+    assert numpy.array_equal(outputs[1].molecule[0].geometry[1:], before[1:])
+
+
+def test_cost_model():
+    from mmic_optim_gmx.util.cost import CostModel, feature_names, job_features
+    import numpy
+
+    small, big = job_features(water_inputs()), job_features(
+        water_inputs(max_steps=5000)
+    )
+    assert (
+        big[feature_names.index("steep_atom_steps")]
+        > small[feature_names.index("steep_atom_steps")]
+    )
+
+    coef = numpy.array([0.5, 1e-4, 1e-6, 2e-6, 3e-6, 1e-7])
+    rng = numpy.random.default_rng(0)
+    model = CostModel(min_samples=20)
+    for _ in range(40):
+        features = rng.uniform(0, 1, 6) * [1, 1e4, 1e7, 1e7, 1e7, 1e8]
+        features[0] = 1
+        model.observe(features, float(features @ coef))
+    assert numpy.allclose(model.coef, coef, rtol=1e-6)
+    assert model.errors()["max"] < 1e-6
+
+    # Only the latest timings are kept and refitted every refit_interval
+    model = CostModel(min_samples=5, max_samples=10, refit_interval=5)
+    for _ in range(4):
+        model.observe(features, 1.0)
+    assert model.coef.tolist() == list(CostModel().coef)
+    model.observe(features, 1.0)
+    for _ in range(21):
+        model.observe(features, 1.0)
+    assert len(model.samples) == 10
+    assert model._unfit == 1
+
+
+def test_scheduler():
+    from mmic_optim_gmx.scheduler import Scheduler
+    import threading
+
+    order, threads, release = [], [], threading.Event()
+
+    def runner(inputs):
+        order.append(inputs.max_steps)
+        threads.append(inputs.keywords["-nt"])
+        release.wait()
+        return inputs.max_steps
+
+    with Scheduler(slots=1, aging=0.0, runner=runner) as scheduler:
+        futures = [
+            scheduler.submit(water_inputs(max_steps=steps))
+            for steps in (10, 3000, 1000, 2000)
+        ]
+        release.set()
+        assert [future.result() for future in futures] == [10, 3000, 1000, 2000]
+
+    # Shortest first once the first job holds the only slot
+    assert order == [10, 1000, 2000, 3000]
+    # mdrun runs on the cores of the job
+    assert threads == ["1"] * 4
+    report = scheduler.report()
+    assert all(job["actual"] is not None for job in report)
+    assert scheduler.summary()["finished"] == 4
+
+
+def test_preemption(tmp_path):
+    from mmic_optim_gmx.scheduler import Scheduler
+    from mmic_optim_gmx.util.cmd import ProcessControl, pause_point, run_gmx
+    from mmic_optim_gmx.util.errors import GmxPreemptedError
+    import shutil
+    import threading
+    import time
+
+    for preempt in ("requeue", "suspend"):
+        calls, started = [], threading.Event()
+
+        def runner(inputs):
+            calls.append(inputs.max_steps)
+            if calls.count(10) == 1 and inputs.max_steps == 10:
+                started.set()
+                # Stands in for a long mdrun
+                rvalue = run_gmx("mdrun", {"command": ["sleep", "2"], "outfiles": []})
+                shutil.rmtree(rvalue.scratch_directory)
+            return time.time()
+
+        with Scheduler(slots=1, runner=runner, preempt=preempt) as scheduler:
+            batch = scheduler.submit(water_inputs(), priority="batch")
+            started.wait()
+            interactive = scheduler.submit(
+                water_inputs(max_steps=20), priority="interactive"
+            )
+            assert interactive.result() < batch.result()
+
+        report = {job["priority"]: job for job in scheduler.report()}
+        assert report["batch"]["preemptions"] == 1
+        assert calls == ([10, 20, 10] if preempt == "requeue" else [10, 20])
+
+    # A stopped job holds its cores until its program has exited
+    times, marker = {}, tmp_path / "trapped"
+    script = f"trap 'sleep 1; exit 143' TERM; touch {marker}; sleep 5 & wait"
+
+    def runner(inputs):
+        times.setdefault(inputs.max_steps, time.time())
+        if inputs.max_steps == 10 and "stopped" not in times:
+            try:
+                run_gmx("mdrun", {"command": ["sh", "-c", script], "outfiles": []})
+            finally:
+                times["stopped"] = time.time()
+        return time.time()
+
+    with Scheduler(slots=1, runner=runner, preempt="requeue") as scheduler:
+        scheduler.submit(water_inputs(), priority="batch")
+        while not marker.exists():
+            time.sleep(0.01)
+        scheduler.submit(water_inputs(max_steps=20), priority="interactive").result()
+    assert times["stopped"] - times[10] >= 1
+    assert times[20] >= times["stopped"]
+
+    # Suspended jobs wait at the next stage
+    control, passed = ProcessControl(), threading.Event()
+
+    def stage():
+        with control:
+            pause_point("post")
+            passed.set()
+
+    control.suspend()
+    thread = threading.Thread(target=stage)
+    thread.start()
+    assert not passed.wait(0.2)
+    control.resume()
+    assert passed.wait(5)
+    thread.join()
+
+    control.stop()
+    with control, pytest.raises(GmxPreemptedError):
+        pause_point("post")
+
+
+def test_binary_output():
+    """
+    Compares the binary serialization of a 100k atom output to JSON
+    """
+    from mmic_optim_gmx.util.serialize import dumps_output, loads_output
+    import numpy
+    import time
+
+    natoms = 100000
+    rng = numpy.random.default_rng(0)
+    big = Molecule(
+        symbols=["O"] * natoms, geometry=rng.uniform(0, 10, 3 * natoms).round(8)
+    )
+    outputs = OptimGmxComponent.compute(water_inputs())
+    outputs = outputs.copy(update={"molecule": [big]})
+
+    start = time.perf_counter()
+    data = dumps_output(outputs)
+    loaded = loads_output(data)
+    binary = time.perf_counter() - start
+
+    start = time.perf_counter()
+    text = outputs.json(exclude={"proc_input"})
+    Molecule(**json.loads(text)["molecule"][0])
+    text_time = time.perf_counter() - start
+    print(
+        f"Output round trip: {len(data) / 1e6:.1f} MB in {binary:.3f} s (npz) "
+        f"vs {len(text) / 1e6:.1f} MB in {text_time:.3f} s (JSON)"
+    )
+
+    assert type(loaded) is type(outputs)
+    assert numpy.array_equal(loaded.molecule[0].geometry, big.geometry)
+    assert list(loaded.proc_input.system) == list(outputs.proc_input.system)
+    assert len(data) < len(text) / 2
+
+
+def test_binary_output_untrusted():
+    """Files naming anything but a model of a trusted package are rejected"""
+    from mmic_optim_gmx.models import OutputOptimGmx
+    from mmic_optim_gmx.util.serialize import loads_output
+    import io
+    import numpy
+
+    def npz(meta):
+        buffer = io.BytesIO()
+        numpy.savez(
+            buffer, meta=numpy.frombuffer(json.dumps(meta).encode(), dtype=numpy.uint8)
+        )
+        return buffer.getvalue()
+
+    for path in ("os:system", "mmic_optim_gmx.util.cost:CostModel"):
+        with pytest.raises(ValueError):
+            loads_output(
+                npz({"version": 1, "model": path, "data": {"command": "true"}})
+            )
+
+    # Dict key models come from the fields of the given model, not from the file
+    data = npz(
+        {
+            "version": 1,
+            "model": "os:system",
+            "data": {"system": {"__pairs__": [[{}, {}]], "__key_model__": "os:system"}},
+        }
+    )
+    with pytest.raises(ValueError):
+        loads_output(data, OutputOptimGmx)
+
+
+def test_by_reference(tmp_path):
+    import numpy
+
+    eager = OptimGmxComponent.compute(water_inputs())
+    outputs = OptimGmxComponent.compute(
+        water_inputs(by_reference=True, results_dir=str(tmp_path))
+    )
+
+    assert not outputs.molecule and not outputs.trajectory
+    assert set(outputs.files) == {"molecule", "trajectory", "energy"}
+    for ref in outputs.files.values():
+        assert os.path.dirname(ref.path) == str(tmp_path)
+        assert os.path.basename(ref.path).startswith(ref.sha256)
+        assert ref.verify()
+
+    mols = outputs.load_molecules()
+    assert numpy.allclose(mols[0].geometry, eager.molecule[0].geometry)
+    assert outputs.load_trajectory().nframes > 0
+
+    with pytest.raises(ValueError):
+        water_inputs(by_reference=True)
+
+
+def test_by_reference_lowest_energy(tmp_path):
+    from mmic_optim_gmx.util.gro import read_gro_coordinates
+    import numpy
+
+    eager = OptimGmxComponent.compute(water_inputs(lowest_energy=True))
+    outputs = OptimGmxComponent.compute(
+        water_inputs(lowest_energy=True, by_reference=True, results_dir=str(tmp_path))
+    )
+
+    assert outputs.lowest_energy_step == eager.lowest_energy_step
+    assert outputs.lowest_energy == pytest.approx(eager.lowest_energy)
+    coords, box = read_gro_coordinates(outputs.files["molecule"].path)
+    assert box.shape == (3,)
+    mols = outputs.load_molecules()
+    assert numpy.allclose(mols[0].geometry, eager.molecule[0].geometry, atol=1e-3)
+
+
+def test_stage_validation():
+    """
+    Compares the validation done by compute() between two stages to the
+    models passed by the pipeline, for a 100k atom system
+    """
+    from mmic_optim_gmx.models import InputComputeGmx
+    from unittest import mock
+    import numpy
+    import pydantic
+    import time
+
+    natoms = 100000
+    rng = numpy.random.default_rng(0)
+    big = Molecule(
+        symbols=["O"] * natoms, geometry=rng.uniform(0, 10, 3 * natoms).round(8)
+    )
+    inputs = water_inputs()
+    ff = next(iter(inputs.system.values()))
+    inputs = inputs.copy(update={"system": {big: ff}})
+    fields = dict(
+        proc_input=inputs,
+        schema_name=inputs.schema_name,
+        schema_version=inputs.schema_version,
+        mdp_file="em.mdp",
+        forcefield="topol.top",
+        molecule="conf.gro",
+        scratch_dir="scratch",
+    )
+
+    start = time.perf_counter()
+    validated = InputComputeGmx(**fields)
+    InputComputeGmx(**validated.dict())
+    full = time.perf_counter() - start
+
+    start = time.perf_counter()
+    trusted = InputComputeGmx.construct(**fields)
+    fast = time.perf_counter() - start
+    print(f"Stage models: {fast:.4f} s (trusted) vs {full:.4f} s (validated)")
+
+    # Nothing is validated or copied on the trusted path
+    assert trusted.proc_input is inputs and trusted.stage == 0
+    with pytest.raises(pydantic.ValidationError):
+        InputComputeGmx(**fields, stage="first")
+    assert InputComputeGmx.construct(**fields, stage="first").stage == "first"
+
+    # The pipeline does not go through the validating compute() of the stages
+    with mock.patch.object(
+        PrepGmxComponent, "compute", side_effect=AssertionError("validated")
+    ):
+        outputs = OptimGmxComponent.compute(water_inputs())
+    OptimGmxComponent.validate_stages = True
+    try:
+        validated = OptimGmxComponent.compute(water_inputs(max_steps=11))
+    finally:
+        OptimGmxComponent.validate_stages = False
+    assert len(outputs.molecule) == len(validated.molecule) == 1
+
+
 def test_cleaner():
     """
     This test will figure out if all the files are
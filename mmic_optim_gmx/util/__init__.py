@@ -0,0 +1,3 @@
+from .methods import translate_method, supported_methods
+
+__all__ = ["translate_method", "supported_methods"]
@@ -0,0 +1,127 @@
+"""
+Checkpoints of the minimization stages kept in a persistent job directory.
+
+mdrun writes no .cpt checkpoint for energy minimizations, so the state of
+a stage is its coordinates: frames are written to the stage .trr every few
+steps and the final .gro is copied once the stage finishes. A rerun of the
+job skips the finished stages and restarts the interrupted one from the
+last complete frame of its .trr.
+"""
+from typing import Optional, Tuple
+import glob
+import json
+import os
+import shutil
+import tempfile
+import numpy
+
+__all__ = ["Checkpoint"]
+
+_prefix = "mmic_stage"
+
+
+class Checkpoint:
+    """
+    Files of one stage in the job directory: the .trr written by mdrun,
+    the final .gro (the stage is done once it exists), and the .gro the
+    current .trr started from along with the number of steps run before.
+    """
+
+    def __init__(self, directory: str, stage: int):
+        self.directory = directory
+        self.stage = stage
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, ext: str) -> str:
+        return os.path.join(self.directory, f"{_prefix}{self.stage}.{ext}")
+
+    def _tmp_file(self) -> str:
+        # Written then renamed over the checkpoint files, removed by clear()
+        fd, path = tempfile.mkstemp(prefix=_prefix, suffix=".tmp", dir=self.directory)
+        os.close(fd)
+        return path
+
+    @property
+    def trajectory(self) -> str:
+        return self._path("trr")
+
+    @property
+    def confout(self) -> str:
+        return self._path("gro")
+
+    @property
+    def start(self) -> str:
+        return self._path("start.gro")
+
+    @property
+    def state(self) -> str:
+        return self._path("json")
+
+    def done(self) -> bool:
+        """Whether the stage finished in a previous run."""
+        return os.path.isfile(self.confout)
+
+    def steps_done(self) -> int:
+        """Returns the number of steps run before the current .trr was started."""
+        if not os.path.isfile(self.state):
+            return 0
+        with open(self.state) as fp:
+            return json.load(fp)["steps"]
+
+    def restart(self, gro_file: str, steps: int):
+        """
+        Saves gro_file as the coordinates the stage restarts from, after
+        steps steps, and removes the .trr the coordinates were taken from.
+        """
+        tmp_file = self._tmp_file()
+        shutil.copyfile(gro_file, tmp_file)
+        os.replace(tmp_file, self.start)
+
+        tmp_file = self._tmp_file()
+        with open(tmp_file, "w") as fp:
+            json.dump({"steps": steps}, fp)
+        os.replace(tmp_file, self.state)
+
+        if os.path.isfile(self.trajectory):
+            os.remove(self.trajectory)
+
+    def last_frame(
+        self,
+    ) -> Optional[Tuple[int, numpy.ndarray, Optional[numpy.ndarray]]]:
+        """
+        Returns the step, the (natoms, 3) coordinates and the box (nm) of the
+        last complete frame of the stage .trr, None if there is none.
+        """
+        from .trajectory import TrajectoryIndex
+
+        if not os.path.isfile(self.trajectory):
+            return None
+        try:
+            index = TrajectoryIndex.build(self.trajectory, sidecar=False)
+        except ValueError:
+            return None
+
+        frame = None
+        for i in reversed(range(len(index))):
+            coords = index.positions(i)
+            if coords is not None and numpy.isfinite(coords).all():
+                frame = int(index.steps[i]), coords, index.box(i)
+                break
+        index.close()
+        return frame
+
+    def finish(self, gro_file: str):
+        """Marks the stage as done, gro_file being its final coordinates."""
+        tmp_file = self._tmp_file()
+        shutil.copyfile(gro_file, tmp_file)
+        os.replace(tmp_file, self.confout)
+
+    @staticmethod
+    def clear(directory: str):
+        """Removes the checkpoints of all the stages, and directory if it is then empty."""
+        for path in glob.glob(os.path.join(directory, f"{_prefix}*")):
+            os.remove(path)
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
@@ -0,0 +1,302 @@
+"""
+Execution of gmx programs, each in its own process group so that the
+whole group can be stopped when the run has a time limit or is under a
+ProcessControl. The exit status of every program is checked.
+"""
+from typing import Any, Dict, Optional, TYPE_CHECKING
+import contextvars
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+from .errors import (
+    GmxError,
+    GmxPreemptedError,
+    GmxTimeoutError,
+    MdrunError,
+    MissingOutputError,
+    SegmentationFaultError,
+    classify,
+)
+
+if TYPE_CHECKING:
+    from ..models import InputOptimGmx
+
+__all__ = ["run_gmx", "time_limit", "ProcessControl", "pause_point"]
+
+# Seconds given to gmx to stop after SIGTERM before it is killed
+_grace_period = 10.0
+
+# ProcessControl of the job running in the current thread
+_control = contextvars.ContextVar("mmic_optim_gmx_control", default=None)
+
+
+class ProcessControl:
+    """
+    Handle on the gmx programs of a job, used from another thread to
+    suspend, resume or stop them. Programs run by the job while the
+    handle is active are started in their own process group:
+
+        with control:
+            OptimGmxComponent.compute(inputs)
+
+    A suspended job does not start new programs until it is resumed. A
+    stopped job terminates its program and every run_gmx call of the job
+    raises a GmxPreemptedError. Only the gmx programs receive SIGSTOP, the
+    Python work of the job e.g. writing the topology or reading the results
+    goes on until the next program or pause_point.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._procs = set()
+        self._resumed = threading.Event()
+        self._resumed.set()
+        self._token = None
+        self.stopped = False
+
+    @property
+    def suspended(self) -> bool:
+        return not self._resumed.is_set()
+
+    def suspend(self):
+        """Pauses the running programs (SIGSTOP) and holds back new ones."""
+        with self._lock:
+            self._resumed.clear()
+            self._signal(signal.SIGSTOP)
+
+    def resume(self):
+        with self._lock:
+            self._signal(signal.SIGCONT)
+            self._resumed.set()
+
+    def stop(self):
+        """Stops the running programs, SIGTERM first so mdrun can stop cleanly."""
+        with self._lock:
+            self.stopped = True
+            self._signal(signal.SIGTERM)
+            self._signal(signal.SIGCONT)
+            self._resumed.set()
+
+    def _signal(self, sig: int):
+        for proc in self._procs:
+            try:
+                os.killpg(proc.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def _start(self, stage: str, start) -> subprocess.Popen:
+        while True:
+            self._resumed.wait()
+            with self._lock:
+                if self.stopped:
+                    raise GmxPreemptedError(f"{stage} was preempted.", stage=stage)
+                if self.suspended:
+                    continue
+                proc = start()
+                self._procs.add(proc)
+                return proc
+
+    def _finish(self, proc: subprocess.Popen) -> bool:
+        with self._lock:
+            self._procs.discard(proc)
+            return self.stopped
+
+    def __enter__(self) -> "ProcessControl":
+        self._token = _control.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        _control.reset(self._token)
+
+
+def pause_point(stage: str):
+    """
+    Blocks the job running in the current thread while its ProcessControl
+    is suspended, and raises a GmxPreemptedError once it is stopped. Called
+    between the stages of a job.
+    """
+    control = _control.get()
+    if control is not None:
+        control._resumed.wait()
+        if control.stopped:
+            raise GmxPreemptedError(f"{stage} was preempted.", stage=stage)
+
+
+class CmdResult:
+    """Output of a gmx program: stdout, stderr, output files, scratch directory and exit status."""
+
+    def __init__(
+        self,
+        stdout: str,
+        stderr: str,
+        outfiles: Dict[str, Any],
+        scratch_directory: str,
+        returncode: int = 0,
+    ):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.outfiles = outfiles
+        self.scratch_directory = scratch_directory
+        self.returncode = returncode
+
+    def dict(self) -> Dict[str, Any]:
+        return {
+            "stdout": self.stdout,
+            "stderr": self.stderr,
+            "outfiles": self.outfiles,
+            "scratch_directory": self.scratch_directory,
+        }
+
+
+def time_limit(
+    inputs: "InputOptimGmx", deadline: Optional[float] = None
+) -> Optional[float]:
+    """
+    Returns the number of seconds a gmx program of the job may run: the
+    smallest of inputs.stage_timeout and the time left before inputs.deadline
+    and deadline (both given as time.time() values). None means no limit.
+    """
+    limits = [inputs.stage_timeout] if inputs.stage_timeout is not None else []
+    for end in (inputs.deadline, deadline):
+        if end is not None:
+            limits.append(end - time.time())
+    return min(limits) if limits else None
+
+
+def run_gmx(
+    stage: str, cmd_input: Dict[str, Any], timeout: Optional[float] = None
+) -> Any:
+    """
+    Runs a gmx program and checks its exit status and output. Raises a
+    GmxError subclass describing the failure if the program crashed,
+    exited with an error or did not write all its output files.
+
+    Parameters
+    ----------
+    stage : str
+        Name of the gmx program e.g. grompp or mdrun, used to classify errors.
+    cmd_input : Dict[str, Any]
+        Command, files and environment of the program, see the build_input methods of the components.
+    timeout : float, Optional
+        Max run time in seconds. The process group of the program is
+        terminated when the time is up and a GmxTimeoutError is raised.
+        A job under a ProcessControl raises a GmxPreemptedError once stopped.
+    """
+    rvalue = _run_with_timeout(stage, cmd_input, timeout)
+
+    text = (rvalue.stdout or "") + (rvalue.stderr or "")
+    error = _exit_error(stage, rvalue.returncode, text) or classify(stage, text)
+    if error is None and rvalue.returncode != 0:
+        error = (MdrunError if stage == "mdrun" else GmxError)(
+            f"{stage} exited with code {rvalue.returncode}.",
+            stage=stage,
+            details=text[-2000:] or None,
+        )
+    if error is None:
+        missing = [file for file in cmd_input["outfiles"] if not os.path.isfile(file)]
+        if missing:
+            error = MissingOutputError(
+                f"{stage} did not write {', '.join(missing)}", stage=stage
+            )
+    if error is not None:
+        shutil.rmtree(rvalue.scratch_directory, ignore_errors=True)
+        raise error
+
+    return rvalue
+
+
+def _exit_error(stage: str, returncode: int, text: str) -> Optional[GmxError]:
+    """Returns the error of a program killed by a signal, None otherwise."""
+    # A shell wrapper reports a signal as 128 + its number
+    if returncode in (-signal.SIGSEGV, 128 + signal.SIGSEGV):
+        return SegmentationFaultError(
+            f"{stage} crashed with a segmentation fault.",
+            stage=stage,
+            details=text[-2000:] or None,
+        )
+    if returncode < 0:
+        name = signal.Signals(-returncode).name
+        return classify(stage, text) or GmxError(
+            f"{stage} was killed by {name}.", stage=stage, details=text[-2000:] or None
+        )
+    return None
+
+
+def _run_with_timeout(
+    stage: str, cmd_input: Dict[str, Any], timeout: Optional[float]
+) -> CmdResult:
+    if timeout is not None and timeout <= 0:
+        raise GmxTimeoutError(
+            f"No time left to run {stage}.", stage=stage, timeout=timeout
+        )
+
+    scratch_dir = tempfile.mkdtemp(dir=cmd_input.get("scratch_directory"))
+
+    def start() -> subprocess.Popen:
+        return subprocess.Popen(
+            cmd_input["command"],
+            cwd=scratch_dir,
+            env=cmd_input.get("environment"),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            start_new_session=True,  # gmx and its children get their own group
+        )
+
+    control = _control.get()
+    try:
+        proc = control._start(stage, start) if control else start()
+    except OSError as e:  # e.g. the engine or the MPI launcher is not installed
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        raise GmxError(f"{stage} could not be started: {e}", stage=stage) from e
+    except BaseException:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        raise
+    try:
+        stdout, stderr = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _terminate(proc)
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        raise GmxTimeoutError(
+            f"{stage} did not finish within {timeout:.1f} s.",
+            stage=stage,
+            timeout=timeout,
+        )
+    except BaseException:
+        _terminate(proc)
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        raise
+    finally:
+        stopped = control._finish(proc) if control else False
+    if stopped:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        raise GmxPreemptedError(f"{stage} was preempted.", stage=stage)
+
+    return CmdResult(
+        stdout,
+        stderr,
+        {file: None for file in cmd_input["outfiles"]},
+        scratch_dir,
+        proc.returncode,
+    )
+
+
+def _terminate(proc: subprocess.Popen):
+    """Stops the process group of proc, SIGTERM first so mdrun can stop cleanly."""
+    for sig, wait in ((signal.SIGTERM, _grace_period), (signal.SIGKILL, None)):
+        try:
+            os.killpg(proc.pid, sig)
+            # A suspended group only handles SIGTERM once continued
+            os.killpg(proc.pid, signal.SIGCONT)
+        except ProcessLookupError:
+            break
+        try:
+            proc.communicate(timeout=wait)
+            break
+        except subprocess.TimeoutExpired:
+            continue
@@ -0,0 +1,207 @@
+"""
+Model of the wall time of an energy minimization job.
+
+The cost is linear in features of the job: a fixed overhead, the number
+of atoms (prep, grompp and post work), atom-steps per integrator and the
+PME grid work per step. The coefficients start from rough defaults and
+are refitted from the timings of the latest finished jobs.
+"""
+from collections import deque
+from typing import Deque, Dict, List, Optional, Sequence, Tuple, TYPE_CHECKING
+import json
+import math
+import os
+import tempfile
+import threading
+import numpy
+
+if TYPE_CHECKING:
+    from ..models import InputOptimGmx
+
+__all__ = ["CostModel", "job_features", "feature_names"]
+
+feature_names = (
+    "overhead",
+    "atoms",
+    "steep_atom_steps",
+    "cg_atom_steps",
+    "l-bfgs_atom_steps",
+    "pme_grid_steps",
+)
+
+# Seconds per unit of each feature, used until enough jobs are timed
+_default_coef = (1.0, 1e-5, 2e-7, 3e-7, 4e-7, 5e-8)
+
+# Steps assumed for a stage without a step limit (nsteps = -1)
+_unlimited_steps = 50000
+# Space left by editconf around the solute (nm), see PrepGmxComponent
+_box_margin = 2.0
+# Water atoms per nm**3 added by the solvation stage
+_solvent_density = 100.0
+# Default gmx fourierspacing (nm)
+_fourier_spacing = 0.12
+
+
+def job_features(inputs: "InputOptimGmx") -> numpy.ndarray:
+    """Returns the features of a job, in the order of feature_names."""
+    from ..components.gmx_prep_component import PrepGmxComponent
+    from .gro import length_factor
+
+    coords = [
+        numpy.reshape(mol.geometry, (-1, 3)) / length_factor(mol.geometry_units)
+        for mol in inputs.system
+        if mol.geometry is not None
+    ]
+    coords = numpy.concatenate(coords) if coords else numpy.zeros((1, 3))
+    box = numpy.ptp(coords, axis=0) + 2 * _box_margin
+    natoms = sum(len(mol.symbols) for mol in inputs.system)
+    if inputs.solvent:
+        natoms += _solvent_density * box.prod()
+
+    features = numpy.zeros(len(feature_names))
+    features[0] = 1.0
+    features[1] = natoms
+    for stage in inputs.stages():
+        mdp = PrepGmxComponent.build_mdp(inputs, stage)
+        steps = mdp.nsteps if mdp.nsteps >= 0 else _unlimited_steps
+        features[feature_names.index(f"{mdp.integrator}_atom_steps")] += steps * natoms
+        if (mdp.coulombtype or "").lower() == "pme":
+            spacing = mdp.fourierspacing or _fourier_spacing
+            grid = numpy.ceil(box / spacing).prod()
+            features[-1] += steps * grid * math.log2(grid)
+    return features
+
+
+class CostModel:
+    """
+    Predicts the wall time (s) of jobs and learns from their timings.
+    Thread-safe, can be saved to and loaded from a JSON file.
+
+    Parameters
+    ----------
+    coef : Sequence[float], Optional
+        Seconds per unit of each feature, the defaults if None.
+    min_samples : int
+        Number of timed jobs needed before the coefficients are refitted.
+    max_samples : int
+        Number of latest timings kept, older ones are dropped.
+    refit_interval : int
+        Number of timings recorded between two refits of the coefficients.
+    """
+
+    def __init__(
+        self,
+        coef: Optional[Sequence[float]] = None,
+        min_samples: int = 10,
+        max_samples: int = 1000,
+        refit_interval: int = 10,
+    ):
+        if not 1 <= min_samples <= max_samples:
+            raise ValueError("min_samples must be between 1 and max_samples.")
+        self.coef = numpy.array(coef if coef is not None else _default_coef, float)
+        self.min_samples = min_samples
+        self.refit_interval = refit_interval
+        self.samples: Deque[Tuple[List[float], float]] = deque(maxlen=max_samples)
+        self._unfit = 0  # Timings recorded since the last refit
+        self._lock = threading.Lock()
+
+    def predict(self, inputs: "InputOptimGmx") -> float:
+        """Returns the predicted wall time of a job in seconds."""
+        return self.predict_features(job_features(inputs))
+
+    def predict_features(self, features: numpy.ndarray) -> float:
+        with self._lock:
+            return float(features @ self.coef)
+
+    def observe(self, features: numpy.ndarray, wall_time: float, refit: bool = True):
+        """
+        Records the wall time of a finished job with the given features.
+        If refit, the coefficients are refitted once min_samples timings are
+        recorded and then every refit_interval timings.
+        """
+        with self._lock:
+            self.samples.append(([float(x) for x in features], float(wall_time)))
+            self._unfit += 1
+            due = (
+                self._unfit >= self.refit_interval
+                or len(self.samples) == self.min_samples
+            )
+        if refit and due:
+            self.fit()
+
+    def fit(self) -> bool:
+        """
+        Refits the coefficients to the recorded timings, minimizing the
+        relative error under non-negative coefficients. Returns False if
+        there are fewer than min_samples timings.
+        """
+        with self._lock:
+            if len(self.samples) < self.min_samples:
+                return False
+            features = numpy.array([x for x, _ in self.samples])
+            times = numpy.array([t for _, t in self.samples])
+            self._unfit = 0
+
+        # Rows weighted by 1/time so that short jobs count as much as long ones
+        weights = 1.0 / numpy.maximum(times, 1e-3)
+        a = features * weights[:, None]
+        b = times * weights
+        scale = numpy.linalg.norm(a, axis=0)
+        active = scale > 0
+        coef = numpy.zeros(len(feature_names))
+        # Features with a negative coefficient are dropped and the rest refitted
+        while active.any():
+            sol = (
+                numpy.linalg.lstsq(a[:, active] / scale[active], b, rcond=None)[0]
+                / scale[active]
+            )
+            if (sol >= 0).all():
+                coef[active] = sol
+                break
+            active[numpy.flatnonzero(active)[sol < 0]] = False
+
+        with self._lock:
+            self.coef = coef
+        return True
+
+    def errors(self) -> Dict[str, float]:
+        """Returns the mean and max relative error of the model on the recorded timings."""
+        with self._lock:
+            if not self.samples:
+                return {"mean": 0.0, "max": 0.0}
+            features = numpy.array([x for x, _ in self.samples])
+            times = numpy.array([t for _, t in self.samples])
+            rel = numpy.abs(features @ self.coef - times) / numpy.maximum(times, 1e-3)
+        return {"mean": float(rel.mean()), "max": float(rel.max())}
+
+    def save(self, path: str):
+        """Writes the coefficients and timings to a JSON file."""
+        with self._lock:
+            data = {
+                "features": feature_names,
+                "coef": self.coef.tolist(),
+                "min_samples": self.min_samples,
+                "max_samples": self.samples.maxlen,
+                "refit_interval": self.refit_interval,
+                "samples": list(self.samples),
+            }
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, "w") as fp:
+            json.dump(data, fp)
+        os.replace(tmp_file, path)
+
+    @classmethod
+    def load(cls, path: str) -> "CostModel":
+        """Reads a model written by save."""
+        with open(path) as fp:
+            data = json.load(fp)
+        if tuple(data["features"]) != feature_names:
+            raise ValueError(f"{path} was written for other features.")
+        model = cls(
+            data["coef"],
+            data["min_samples"],
+            data.get("max_samples", 1000),
+            data.get("refit_interval", 10),
+        )
+        model.samples.extend((list(x), t) for x, t in data["samples"])
+        return model
@@ -0,0 +1,32 @@
+"""
+Reader for gmx energy (.edr) files.
+"""
+from typing import Tuple
+import numpy
+
+__all__ = ["read_energy"]
+
+
+def read_energy(
+    edr_file: str, term: str = "Potential"
+) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Reads one energy term from an .edr file. During a minimization gmx
+    writes the step number as the time of each energy frame.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, numpy.ndarray]
+        The times and the values (kJ/mol) of the energy term.
+    """
+    try:
+        import pyedr
+    except ImportError:  # pragma: no cover
+        raise ImportError(
+            "pyedr is required to read .edr files, install it with `pip install pyedr`."
+        )
+
+    energies = pyedr.edr_to_dict(edr_file)
+    if term not in energies:
+        raise KeyError(f"No {term} energy term in {edr_file}.")
+    return numpy.asarray(energies["Time"]), numpy.asarray(energies[term])
@@ -0,0 +1,214 @@
+"""
+Typed errors for failed gmx runs and the parser classifying the
+output of grompp and mdrun.
+"""
+from typing import List, Optional
+import re
+
+__all__ = [
+    "GmxError",
+    "GromppError",
+    "MdrunError",
+    "NonFiniteForceError",
+    "ConstraintError",
+    "SegmentationFaultError",
+    "MissingOutputError",
+    "GmxTimeoutError",
+    "GmxPreemptedError",
+    "parse_messages",
+    "classify",
+]
+
+
+class GmxError(RuntimeError):
+    """
+    Base class of the gmx failures.
+
+    Attributes
+    ----------
+    stage : str
+        The gmx program that failed e.g. grompp or mdrun.
+    category : str
+        Short name of the failure, used to pick a retry strategy.
+    retryable : bool
+        Whether rerunning with adjusted parameters may succeed.
+    details : str
+        The relevant part of the gmx output.
+    """
+
+    category = "gmx"
+    retryable = False
+
+    def __init__(
+        self,
+        message: str,
+        stage: Optional[str] = None,
+        details: Optional[str] = None,
+        warnings: Optional[List[str]] = None,
+    ):
+        super().__init__(message)
+        self.stage = stage
+        self.details = details
+        self.warnings = warnings or []
+
+
+class GromppError(GmxError):
+    """grompp rejected the input e.g. a broken topology or .mdp."""
+
+    category = "grompp"
+
+
+class MdrunError(GmxError):
+    """mdrun stopped with a fatal error."""
+
+    category = "mdrun"
+
+
+class NonFiniteForceError(MdrunError):
+    """The force on at least one atom is not finite, usually overlapping atoms."""
+
+    category = "non_finite_force"
+    retryable = True
+
+
+class ConstraintError(MdrunError):
+    """LINCS, SHAKE or SETTLE could not satisfy the constraints."""
+
+    category = "constraints"
+    retryable = True
+
+
+class SegmentationFaultError(MdrunError):
+    """mdrun crashed."""
+
+    category = "segfault"
+    retryable = True
+
+
+class MissingOutputError(GmxError):
+    """A gmx program finished without writing its output files."""
+
+    category = "missing_output"
+
+
+class GmxTimeoutError(GmxError, TimeoutError):
+    """
+    A gmx program was stopped because the job ran out of time.
+
+    Attributes
+    ----------
+    timeout : float
+        The time limit of the program in seconds.
+    """
+
+    category = "timeout"
+
+    def __init__(self, message: str, stage: Optional[str] = None, timeout: float = 0.0):
+        super().__init__(message, stage=stage)
+        self.timeout = timeout
+
+
+class GmxPreemptedError(GmxError):
+    """A gmx program was stopped to free its cores for a job of higher priority."""
+
+    category = "preempted"
+
+
+# Start of a grompp message e.g. "WARNING 1 [file topol.top, line 12]:"
+_message = re.compile(r"^(ERROR|WARNING|NOTE)\s+\d+\s*(\[.*\])?\s*:\s*$")
+_fatal = re.compile(r"^Fatal error:\s*$", re.MULTILINE)
+
+_mdrun_errors = (
+    (
+        NonFiniteForceError,
+        re.compile(r"force on at least one atom is not finite", re.IGNORECASE),
+    ),
+    (
+        ConstraintError,
+        re.compile(
+            r"Too many LINCS warnings|SHAKE did not converge|"
+            r"can not be settled|constraint.*did not converge",
+            re.IGNORECASE,
+        ),
+    ),
+    (
+        SegmentationFaultError,
+        re.compile(r"Segmentation fault|signal 11|SIGSEGV", re.IGNORECASE),
+    ),
+)
+
+
+def parse_messages(text: str, kind: str) -> List[str]:
+    """
+    Returns the messages of a given kind (ERROR, WARNING or NOTE) printed by
+    grompp, each one with its location and text.
+    """
+    messages, current = [], None
+    for line in text.splitlines():
+        match = _message.match(line.strip())
+        if match:
+            current = [line.strip()] if match.group(1) == kind else None
+            if current is not None:
+                messages.append(current)
+        elif current is not None:
+            if line.strip():
+                current.append(line.strip())
+            else:
+                current = None
+    return ["\n".join(message) for message in messages]
+
+
+def _fatal_error(text: str) -> Optional[str]:
+    match = _fatal.search(text)
+    if match is None:
+        return None
+    lines = []
+    for line in text[match.end() :].splitlines():
+        if line.startswith("For more information") or line.startswith("-----"):
+            break
+        if line.strip():
+            lines.append(line.strip())
+    return "\n".join(lines)
+
+
+def classify(stage: str, text: str) -> Optional[GmxError]:
+    """
+    Classifies the output (stdout and stderr) of a gmx program.
+
+    Returns
+    -------
+    GmxError, Optional
+        The error to raise, None if the output shows no failure.
+    """
+    fatal = _fatal_error(text)
+
+    if stage == "grompp":
+        errors = parse_messages(text, "ERROR")
+        warnings = parse_messages(text, "WARNING")
+        if errors or fatal:
+            message = "\n\n".join(errors) or fatal
+            return GromppError(
+                f"grompp failed: {message}",
+                stage=stage,
+                details=fatal,
+                warnings=warnings,
+            )
+        return None
+
+    if stage != "mdrun":
+        if fatal:
+            return GmxError(f"{stage} failed: {fatal}", stage=stage, details=fatal)
+        return None
+
+    for error, pattern in _mdrun_errors:
+        match = pattern.search(text)
+        if match:
+            return error(
+                f"{stage} failed: {fatal or match.group(0)}",
+                stage=stage,
+                details=fatal,
+            )
+
+    if fatal:
+        return MdrunError(f"{stage} failed: {fatal}", stage=stage, details=fatal)
+    return None
@@ -0,0 +1,45 @@
+"""
+Probing of the gmx installation.
+"""
+from typing import Any, Dict
+import functools
+import shutil
+import subprocess
+
+__all__ = ["probe_gmx"]
+
+# Lines of `gmx --version` worth keeping, mapped to the returned keys
+_version_keys = {
+    "GROMACS version": "version",
+    "Precision": "precision",
+    "MPI library": "mpi",
+    "OpenMP support": "openmp",
+    "GPU support": "gpu",
+    "SIMD instructions": "simd",
+}
+
+
+@functools.lru_cache(maxsize=None)
+def probe_gmx(engine: str = "gmx") -> Dict[str, Any]:
+    """
+    Runs `engine --version` once per process and returns the capabilities of
+    the gmx build e.g. {"found": True, "version": "2021.4", "mpi": "thread_mpi", ...}.
+    If the executable cannot be found or run, {"found": False} is returned.
+    """
+    path = shutil.which(engine)
+    if path is None:
+        return {"found": False}
+
+    try:
+        proc = subprocess.run(
+            [path, "--version"], capture_output=True, text=True, timeout=60
+        )
+    except (OSError, subprocess.SubprocessError):
+        return {"found": False}
+
+    info = {"found": proc.returncode == 0, "path": path}
+    for line in (proc.stdout + proc.stderr).splitlines():
+        key, sep, val = line.partition(":")
+        if sep and key.strip() in _version_keys:
+            info[_version_keys[key.strip()]] = val.strip()
+    return info
@@ -0,0 +1,148 @@
+"""
+Fast readers for gmx coordinate (.gro) files.
+"""
+from typing import List, Optional, Tuple
+import numpy
+
+__all__ = [
+    "read_gro_coordinates",
+    "write_gro_coordinates",
+    "merge_gro",
+    "length_factor",
+]
+
+# Conversion factors from nm, the gmx length unit
+_length_units = {
+    "nm": 1.0,
+    "nanometer": 1.0,
+    "angstrom": 10.0,
+    "a": 10.0,
+    "pm": 1000.0,
+    "picometer": 1000.0,
+}
+
+
+def length_factor(units: str) -> float:
+    """Returns the factor converting nm to the given length units."""
+    try:
+        return _length_units[units.lower()]
+    except KeyError:
+        raise ValueError(f"Length units {units!r} are not supported.")
+
+
+def read_gro_coordinates(gro_file: str) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Reads only the coordinates and the box of a .gro file, skipping the
+    atom and residue records.
+
+    Parameters
+    ----------
+    gro_file : str
+        Path of the .gro file.
+
+    Returns
+    -------
+    Tuple[numpy.ndarray, numpy.ndarray]
+        The (natoms, 3) coordinates and the box vectors, both in nm.
+    """
+    with open(gro_file) as fp:
+        fp.readline()
+        natoms = int(fp.readline())
+        lines = [fp.readline() for _ in range(natoms)]
+        box = numpy.array(fp.readline().split(), dtype=float)
+
+    if not natoms:
+        return numpy.empty((0, 3)), box
+
+    # The field width depends on the precision the file was written
+    # with, it is the distance between two decimal points
+    first = lines[0]
+    dot = first.index(".", 20)
+    width = first.index(".", dot + 1) - dot
+    stop = 20 + 3 * width
+    fields = "".join(line[20:stop] for line in lines).encode()
+    coords = numpy.frombuffer(fields, dtype=f"S{width}").astype(float)
+    return coords.reshape(natoms, 3), box
+
+
+def write_gro_coordinates(
+    template_file: str,
+    gro_file: str,
+    coords: numpy.ndarray,
+    box: Optional[numpy.ndarray] = None,
+):
+    """
+    Writes a .gro file with the atom and residue records of template_file
+    and new coordinates, e.g. a frame read from a trajectory. Velocities
+    are not written.
+
+    Parameters
+    ----------
+    template_file : str
+        Path of a .gro file of the same system.
+    gro_file : str
+        Path of the .gro file to write, may be template_file.
+    coords : numpy.ndarray
+        The (natoms, 3) coordinates in nm.
+    box : numpy.ndarray, Optional
+        The (3, 3) box vectors in nm. Defaults to the box of template_file.
+    """
+    with open(template_file) as fp:
+        title = fp.readline()
+        natoms = int(fp.readline())
+        atoms = [fp.readline()[:20] for _ in range(natoms)]
+        box_line = fp.readline()
+
+    if coords.shape != (natoms, 3):
+        raise ValueError(
+            f"Coordinates of shape {coords.shape} do not match the {natoms} atoms of {template_file}."
+        )
+
+    if box is not None:
+        # gmx order: v1(x) v2(y) v3(z) v1(y) v1(z) v2(x) v2(z) v3(x) v3(y)
+        vectors = [box[0, 0], box[1, 1], box[2, 2]]
+        off_diagonal = [
+            box[0, 1],
+            box[0, 2],
+            box[1, 0],
+            box[1, 2],
+            box[2, 0],
+            box[2, 1],
+        ]
+        if any(off_diagonal):
+            vectors += off_diagonal
+        box_line = "".join(f"{val:10.5f}" for val in vectors) + "\n"
+
+    with open(gro_file, "w") as fp:
+        fp.write(title)
+        fp.write(f"{natoms:5d}\n")
+        fp.writelines(
+            f"{atom}{x:8.3f}{y:8.3f}{z:8.3f}\n"
+            for atom, (x, y, z) in zip(atoms, coords)
+        )
+        fp.write(box_line)
+
+
+def merge_gro(gro_files: List[str], out_file: str, title: str = "mmic system"):
+    """
+    Concatenates the atoms of several .gro files, in order, into out_file.
+    The atoms are renumbered and the box is a rectangular box holding the
+    boxes of all the files.
+    """
+    atoms, box = [], None
+    for gro_file in gro_files:
+        with open(gro_file) as fp:
+            fp.readline()
+            natoms = int(fp.readline())
+            atoms.extend(fp.readline() for _ in range(natoms))
+            # Only the box lengths are kept
+            file_box = numpy.array(fp.readline().split()[:3], dtype=float)
+        box = file_box if box is None else numpy.maximum(box, file_box)
+
+    with open(out_file, "w") as fp:
+        fp.write(f"{title}\n{len(atoms):5d}\n")
+        fp.writelines(
+            f"{line[:15]}{(i + 1) % 100000:5d}{line[20:]}"
+            for i, line in enumerate(atoms)
+        )
+        fp.write("".join(f"{val:10.5f}" for val in box) + "\n")
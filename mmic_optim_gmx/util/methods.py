@@ -0,0 +1,68 @@
+"""
+Registry of the energy minimization methods supported by gmx.
+Maps mmic_optim method names to gmx integrators and the .mdp
+parameters that go along with them.
+"""
+from typing import Any, Dict, Optional, Tuple
+
+__all__ = ["translate_method", "supported_methods"]
+
+# gmx integrator -> default .mdp parameters specific to that integrator
+_integrators = {
+    "steep": {},
+    # Do a steepest descent step every nstcgsteep steps to keep cg stable
+    "cg": {"nstcgsteep": 1000},
+    # Number of correction steps used in the L-BFGS approximation
+    "l-bfgs": {"nbfgscorr": 10},
+}
+
+# mmic_optim method name -> gmx integrator
+_aliases = {
+    "steep": "steep",
+    "steepest": "steep",
+    "steepest descent": "steep",
+    "steepest descents": "steep",
+    "sd": "steep",
+    "cg": "cg",
+    "conjugate": "cg",
+    "conjugate gradient": "cg",
+    "conjugate gradients": "cg",
+    "l-bfgs": "l-bfgs",
+    "lbfgs": "l-bfgs",
+    "limited memory bfgs": "l-bfgs",
+    "limited-memory bfgs": "l-bfgs",
+}
+
+
+def supported_methods() -> Tuple[str, ...]:
+    """Returns the method names that can be translated to a gmx integrator."""
+    return tuple(_aliases)
+
+
+def translate_method(method: Optional[str]) -> Dict[str, Any]:
+    """
+    Translates an mmic_optim method name to gmx .mdp parameters.
+
+    Parameters
+    ----------
+    method : str, Optional
+        Name of the minimization algorithm e.g. "steepest descent", "cg" or "l-bfgs".
+        Case and "_" vs " " are ignored. Defaults to steepest descent if None.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The integrator and its related .mdp parameters.
+    """
+    if method is None:
+        return {"integrator": "steep"}
+
+    key = " ".join(method.strip().lower().replace("_", " ").split())
+    if key not in _aliases:
+        raise ValueError(
+            f"Minimization method {method!r} is not supported by gmx. "
+            f"Supported methods: {', '.join(supported_methods())}"
+        )
+
+    integrator = _aliases[key]
+    return {"integrator": integrator, **_integrators[integrator]}
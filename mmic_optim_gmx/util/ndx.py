@@ -0,0 +1,28 @@
+"""
+Writer for gmx index (.ndx) files.
+"""
+from typing import Dict, Iterable
+
+__all__ = ["write_ndx"]
+
+
+def write_ndx(ndx_file: str, groups: Dict[str, Iterable[int]], width: int = 15):
+    """
+    Writes atom groups to a gmx index file.
+
+    Parameters
+    ----------
+    ndx_file : str
+        Path of the .ndx file to write.
+    groups : Dict[str, Iterable[int]]
+        Group names mapped to 0-based atom indices. gmx uses 1-based indices,
+        the conversion is done here.
+    width : int, Optional, default: 15
+        Number of indices per line, 15 is what gmx itself writes.
+    """
+    with open(ndx_file, "w") as fp:
+        for name, indices in groups.items():
+            fp.write(f"[ {name} ]\n")
+            indices = [str(i + 1) for i in indices]
+            for i in range(0, len(indices), width):
+                fp.write(" ".join(indices[i : i + width]) + "\n")
@@ -0,0 +1,50 @@
+"""
+Content-addressed storage of the result files returned by reference.
+
+A file is stored as <sha256><extension> in the results directory, so
+identical results are stored once and a stored file never changes.
+"""
+from typing import Tuple
+import hashlib
+import os
+import shutil
+import tempfile
+
+__all__ = ["file_digest", "store_file"]
+
+
+def file_digest(path: str) -> str:
+    """Returns the sha256 hex digest of the content of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def store_file(path: str, results_dir: str) -> Tuple[str, str, int]:
+    """
+    Moves a file to results_dir under its content hash, or removes it if
+    a file with the same content is already stored.
+
+    Returns
+    -------
+    Tuple[str, str, int]
+        The path of the stored file, its sha256 digest and its size in bytes.
+    """
+    os.makedirs(results_dir, exist_ok=True)
+    digest = file_digest(path)
+    size = os.path.getsize(path)
+    stored = os.path.join(
+        os.path.abspath(results_dir), digest + os.path.splitext(path)[1]
+    )
+
+    if os.path.isfile(stored):
+        os.remove(path)
+    else:
+        # Moved under a temp name first, readers never see a partial file
+        fd, tmp_file = tempfile.mkstemp(suffix=".tmp", dir=results_dir)
+        os.close(fd)
+        shutil.move(path, tmp_file)
+        os.replace(tmp_file, stored)
+    return stored, digest, size
@@ -0,0 +1,211 @@
+"""
+Compact binary serialization of output models, e.g. OutputOptimGmx.
+
+The model is written as a NumPy .npz archive: every array field, e.g. the
+geometry of the molecules and trajectories, is stored as a raw (optionally
+compressed) array and the rest of the model as a small JSON document. This
+avoids writing coordinates as JSON text, which dominates the size and the
+time of the JSON serialization of large systems.
+
+    data = dumps_output(outputs)
+    outputs = loads_output(data)
+
+Only models of the packages in _trusted_packages are instantiated when a
+file is read, so that a crafted file cannot call arbitrary functions.
+"""
+from typing import Any, BinaryIO, Dict, List, Optional, Set, Type, Union
+from enum import Enum
+import importlib
+import io
+import json
+import numpy
+
+from pydantic import BaseModel
+from pydantic.json import pydantic_encoder
+
+__all__ = ["dump_output", "load_output", "dumps_output", "loads_output"]
+
+_format_version = 1
+# Keys marking the encoded values in the JSON document
+_array = "__ndarray__"
+_pairs = "__pairs__"
+_key_model = "__key_model__"
+# Packages whose models may be named by a file
+_trusted_packages = ("mmelemental", "mmic_optim", "mmic_optim_gmx")
+
+
+def _model_path(cls: Type[BaseModel]) -> str:
+    return f"{cls.__module__}:{cls.__qualname__}"
+
+
+def _import_model(path: str) -> Type[BaseModel]:
+    """Imports the model named by path, which must be a model of a trusted package."""
+    module, _, qualname = path.partition(":")
+    if not any(
+        module == package or module.startswith(package + ".")
+        for package in _trusted_packages
+    ):
+        raise ValueError(f"{path!r} is not a model of a trusted package.")
+    obj = importlib.import_module(module)
+    for name in qualname.split("."):
+        obj = getattr(obj, name, None)
+    if not (isinstance(obj, type) and issubclass(obj, BaseModel)):
+        raise ValueError(f"{path!r} is not a model.")
+    return obj
+
+
+def _key_models(
+    model: Type[BaseModel], seen: Optional[Set[type]] = None
+) -> Dict[str, Type[BaseModel]]:
+    """Returns the models used as dict keys in the fields of model, by path."""
+    seen = set() if seen is None else seen
+    seen.add(model)
+    found = {}
+
+    def visit(field):
+        for sub in (field.key_field, *(field.sub_fields or ())):
+            if sub is not None:
+                visit(sub)
+        if field.key_field is not None and isinstance(field.key_field.type_, type):
+            if issubclass(field.key_field.type_, BaseModel):
+                found[_model_path(field.key_field.type_)] = field.key_field.type_
+        if (
+            isinstance(field.type_, type)
+            and issubclass(field.type_, BaseModel)
+            and field.type_ not in seen
+        ):
+            found.update(_key_models(field.type_, seen))
+
+    for field in model.__fields__.values():
+        visit(field)
+    return found
+
+
+def _encode(obj: Any, arrays: List[numpy.ndarray]) -> Any:
+    if isinstance(obj, numpy.ndarray):
+        if obj.dtype == object:  # Not stored without pickle
+            return [_encode(item, arrays) for item in obj.tolist()]
+        arrays.append(obj)
+        return {_array: len(arrays) - 1}
+    if isinstance(obj, BaseModel):
+        return {
+            field.alias: _encode(getattr(obj, name), arrays)
+            for name, field in obj.__fields__.items()
+        }
+    if isinstance(obj, dict):
+        if all(isinstance(key, str) for key in obj):
+            return {key: _encode(val, arrays) for key, val in obj.items()}
+        # e.g. the {Molecule: ForceField} system of the inputs
+        keys = {type(key) for key in obj}
+        encoded = {
+            _pairs: [[_encode(k, arrays), _encode(v, arrays)] for k, v in obj.items()]
+        }
+        if len(keys) == 1 and issubclass(keys.pop(), BaseModel):
+            encoded[_key_model] = _model_path(type(next(iter(obj))))
+        return encoded
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return [_encode(item, arrays) for item in obj]
+    if isinstance(obj, numpy.generic):
+        return obj.item()
+    if isinstance(obj, Enum):
+        return obj.value
+    if obj is None or isinstance(obj, (str, int, float, bool)):
+        return obj
+    return pydantic_encoder(obj)
+
+
+def _decode(
+    obj: Any,
+    arrays: Dict[str, numpy.ndarray],
+    key_models: Optional[Dict[str, Type[BaseModel]]] = None,
+) -> Any:
+    """
+    Decodes the JSON document. If key_models is given, the models of dict
+    keys are taken from it instead of being imported from their path.
+    """
+    if isinstance(obj, list):
+        return [_decode(item, arrays, key_models) for item in obj]
+    if not isinstance(obj, dict):
+        return obj
+    if _array in obj:
+        return arrays[f"a{obj[_array]}"]
+    if _pairs in obj:
+        key_model = None
+        if _key_model in obj:
+            if key_models is None:
+                key_model = _import_model(obj[_key_model])
+            elif obj[_key_model] in key_models:
+                key_model = key_models[obj[_key_model]]
+            else:
+                raise ValueError(
+                    f"{obj[_key_model]!r} is not a key model of the fields of the model."
+                )
+        pairs = {}
+        for key, val in obj[_pairs]:
+            key = _decode(key, arrays, key_models)
+            if key_model is not None:
+                key = key_model(**key)
+            elif isinstance(key, list):
+                key = tuple(key)
+            pairs[key] = _decode(val, arrays, key_models)
+        return pairs
+    return {key: _decode(val, arrays, key_models) for key, val in obj.items()}
+
+
+def dump_output(
+    output: BaseModel, file: Union[str, BinaryIO], compressed: bool = False
+):
+    """
+    Writes a model to a .npz file or a binary file object.
+
+    Parameters
+    ----------
+    output : BaseModel
+        The model e.g. an OutputOptimGmx.
+    file : str or BinaryIO
+        Path or file object, numpy appends .npz to paths without it.
+    compressed : bool
+        Whether to deflate the arrays, smaller but slower to write and read.
+    """
+    arrays = []
+    meta = {
+        "version": _format_version,
+        "model": _model_path(type(output)),
+        "data": _encode(output, arrays),
+    }
+    meta = numpy.frombuffer(json.dumps(meta).encode(), dtype=numpy.uint8)
+    save = numpy.savez_compressed if compressed else numpy.savez
+    save(file, meta=meta, **{f"a{i}": array for i, array in enumerate(arrays)})
+
+
+def load_output(
+    file: Union[str, BinaryIO], model: Optional[Type[BaseModel]] = None
+) -> BaseModel:
+    """
+    Reads a model written by dump_output. The model class is the one
+    recorded in the file unless model is given, in which case the models
+    of dict keys are also taken from the field types of model. Raises
+    ValueError if the file names a class which is not a trusted model.
+    """
+    with numpy.load(file, allow_pickle=False) as npz:
+        meta = json.loads(npz["meta"].tobytes())
+        if meta["version"] > _format_version:
+            raise ValueError(
+                f"Serialization format {meta['version']} is newer than the supported {_format_version}."
+            )
+        arrays = {name: npz[name] for name in npz.files if name != "meta"}
+    if model is None:
+        return _import_model(meta["model"])(**_decode(meta["data"], arrays))
+    return model(**_decode(meta["data"], arrays, _key_models(model)))
+
+
+def dumps_output(output: BaseModel, compressed: bool = False) -> bytes:
+    """Returns the model serialized by dump_output."""
+    buffer = io.BytesIO()
+    dump_output(output, buffer, compressed)
+    return buffer.getvalue()
+
+
+def loads_output(data: bytes, model: Optional[Type[BaseModel]] = None) -> BaseModel:
+    """Reads a model from the bytes of dumps_output."""
+    return load_output(io.BytesIO(data), model)
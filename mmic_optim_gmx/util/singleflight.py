@@ -0,0 +1,109 @@
+"""
+Deduplication of identical concurrent requests.
+
+The first caller of a key runs the computation, callers arriving with the
+same key while it runs wait for it and get its result, or its exception.
+"""
+from typing import Any, Callable, Dict, Tuple, TYPE_CHECKING
+import hashlib
+import json
+import threading
+import numpy
+
+if TYPE_CHECKING:
+    from ..models import InputOptimGmx
+
+__all__ = ["SingleFlight", "request_key"]
+
+# Fields set per run, which do not change the result of a job
+_run_fields = {"system", "deadline", "work_dir"}
+
+
+def _update(digest: "hashlib._Hash", value: Any):
+    """Hashes a field value, arrays by their raw bytes instead of as JSON text."""
+    if isinstance(value, numpy.ndarray) and value.dtype != object:
+        digest.update(f"a{value.dtype}{value.shape}".encode())
+        digest.update(numpy.ascontiguousarray(value).tobytes())
+    elif hasattr(value, "__fields__"):  # Models e.g. Molecule
+        digest.update(f"m{type(value).__name__}".encode())
+        for name in value.__fields__:
+            digest.update(f"\0{name}=".encode())
+            _update(digest, getattr(value, name))
+    elif isinstance(value, dict):
+        digest.update(f"d{len(value)}".encode())
+        for key, val in value.items():
+            _update(digest, key)
+            _update(digest, val)
+    elif isinstance(value, (list, tuple, numpy.ndarray)):
+        if all(isinstance(item, str) for item in value):  # e.g. atom names
+            digest.update(f"s{len(value)}".encode() + "\0".join(value).encode())
+        else:
+            digest.update(f"l{len(value)}".encode())
+            for item in value:
+                _update(digest, item)
+    else:
+        digest.update(f"v{value!r}".encode())
+
+
+def request_key(inputs: "InputOptimGmx") -> str:
+    """Returns a hash of everything the result of a job depends on."""
+    digest = hashlib.sha256(
+        json.dumps(
+            json.loads(inputs.json(exclude=_run_fields)), sort_keys=True
+        ).encode()
+    )
+    for mol, ff in inputs.system.items():
+        _update(digest, mol)
+        _update(digest, ff)
+    return digest.hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time, concurrent calls share it."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+
+    def do(self, key: str, func: Callable, *args, **kwargs) -> Tuple[Any, bool]:
+        """
+        Returns func(*args, **kwargs), or the result of the call of key
+        already running, and whether the result is shared with that call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def inflight(self) -> int:
+        """Returns the number of calls running."""
+        with self._lock:
+            return len(self._calls)
@@ -0,0 +1,266 @@
+"""
+Water models and ions used to solvate a system before the minimization.
+
+The molecule types are written inline so the topology stays
+self-contained. The parameters are given as sigma/epsilon and need a
+[ defaults ] combination rule of 2 or 3, e.g. AMBER or OPLS force fields.
+Ions replace water molecules far enough from the solute and from each
+other, in place of a grompp/genion round trip.
+"""
+from typing import Dict, List, Optional, Tuple
+import numpy
+
+from .topology import _data, _directive
+
+__all__ = [
+    "solvent_models",
+    "solvent_topology",
+    "ion_counts",
+    "place_ions",
+    "replace_with_ions",
+]
+
+# Ion parameters (AMBER, Aqvist / Dang), name -> (atomtype line, charge)
+_ions = {
+    "NA": ("Na_mmic  11  22.9900  0.0  A  0.332840  0.0115980", 1.0),
+    "CL": ("Cl_mmic  17  35.4500  0.0  A  0.440104  0.4184000", -1.0),
+}
+
+_water_exclusions = """
+[ exclusions ]
+1 2 3
+2 1 3
+3 1 2
+"""
+
+# Water model -> solvent box shipped with gmx, atoms per molecule,
+# atomtype lines and [ moleculetype ] block
+_waters = {
+    "spc": {
+        "box": "spc216.gro",
+        "natoms": 3,
+        "atomtypes": [
+            "OW_spc    8  15.9994  0.0  A  0.316557  0.650194",
+            "HW_spc    1   1.0080  0.0  A  0.0  0.0",
+        ],
+        "moltype": """[ moleculetype ]
+SOL  2
+
+[ atoms ]
+1  OW_spc  1  SOL  OW   1  -0.82  15.9994
+2  HW_spc  1  SOL  HW1  1   0.41   1.0080
+3  HW_spc  1  SOL  HW2  1   0.41   1.0080
+
+[ settles ]
+1  1  0.1  0.16330
+"""
+        + _water_exclusions,
+    },
+    "tip3p": {
+        "box": "spc216.gro",
+        "natoms": 3,
+        "atomtypes": [
+            "OW_tip3p  8  15.9994  0.0  A  0.315061  0.636386",
+            "HW_tip3p  1   1.0080  0.0  A  0.0  0.0",
+        ],
+        "moltype": """[ moleculetype ]
+SOL  2
+
+[ atoms ]
+1  OW_tip3p  1  SOL  OW   1  -0.834  15.9994
+2  HW_tip3p  1  SOL  HW1  1   0.417   1.0080
+3  HW_tip3p  1  SOL  HW2  1   0.417   1.0080
+
+[ settles ]
+1  1  0.09572  0.15139
+"""
+        + _water_exclusions,
+    },
+    "tip4p": {
+        "box": "tip4p.gro",
+        "natoms": 4,
+        "atomtypes": [
+            "OW_tip4p  8  15.9994  0.0  A  0.315365  0.648520",
+            "HW_tip4p  1   1.0080  0.0  A  0.0  0.0",
+            "MW_tip4p  0   0.0000  0.0  D  0.0  0.0",
+        ],
+        "moltype": """[ moleculetype ]
+SOL  2
+
+[ atoms ]
+1  OW_tip4p  1  SOL  OW   1   0.0   15.9994
+2  HW_tip4p  1  SOL  HW1  1   0.52   1.0080
+3  HW_tip4p  1  SOL  HW2  1   0.52   1.0080
+4  MW_tip4p  1  SOL  MW   1  -1.04   0.0
+
+[ settles ]
+1  1  0.09572  0.15139
+
+[ virtual_sites3 ]
+4  1  2  3  1  0.128012065  0.128012065
+
+[ exclusions ]
+1 2 3 4
+2 1 3 4
+3 1 2 4
+4 1 2 3
+""",
+    },
+}
+
+
+def solvent_models() -> Tuple[str, ...]:
+    """Returns the supported water models."""
+    return tuple(_waters)
+
+
+def solvent_topology(
+    solvent: str, top_file: str
+) -> Tuple[str, int, List[str], List[str]]:
+    """
+    Returns the gmx solvent box, the atoms per water molecule, the atom
+    types and the [ moleculetype ] blocks (water then ions) of a water model.
+    Raises a ValueError if top_file uses a combination rule the parameters
+    cannot be written in.
+    """
+    if solvent not in _waters:
+        raise ValueError(
+            f"Solvent {solvent!r} is not supported. Supported solvents: {', '.join(_waters)}"
+        )
+
+    directive = None
+    with open(top_file) as fp:
+        for line in fp:
+            name = _directive(line)
+            if name:
+                directive = name
+            elif directive == "defaults" and _data(line):
+                if int(_data(line)[1]) not in (2, 3):
+                    raise ValueError(
+                        "Solvation needs a force field with a sigma/epsilon combination rule (2 or 3)."
+                    )
+            elif directive == "moleculetype" and _data(line)[:1] == ["SOL"]:
+                raise ValueError("The system already has a SOL molecule type.")
+
+    water = _waters[solvent]
+    atomtypes = water["atomtypes"] + [line for line, _ in _ions.values()]
+    moltypes = [water["moltype"]] + [
+        f"[ moleculetype ]\n{name}  1\n\n[ atoms ]\n"
+        f"1  {line.split()[0]}  1  {name}  {name}  1  {charge}  {line.split()[2]}\n"
+        for name, (line, charge) in _ions.items()
+    ]
+    return water["box"], water["natoms"], atomtypes, moltypes
+
+
+def ion_counts(charge: float, volume: float, concentration: float) -> Dict[str, int]:
+    """
+    Returns the number of NA and CL ions neutralizing a system of the given
+    net charge and adding concentration (mol/L) of salt to volume (nm**3).
+    """
+    charge = int(round(charge))
+    pairs = int(round(concentration * volume * 0.6022140857))
+    return {"NA": pairs + max(-charge, 0), "CL": pairs + max(charge, 0)}
+
+
+def place_ions(
+    coords: numpy.ndarray,
+    box: numpy.ndarray,
+    solute: int,
+    waters: int,
+    natoms_water: int,
+    nions: int,
+    min_distance: float = 0.6,
+    seed: Optional[int] = 0,
+) -> List[int]:
+    """
+    Picks the water molecules to replace with ions, at least min_distance
+    (nm) away from the solute and from each other, in a random order.
+
+    Parameters
+    ----------
+    coords : numpy.ndarray
+        (natoms, 3) coordinates of the solvated system: solute then waters.
+    box : numpy.ndarray
+        Rectangular box lengths (nm) for the periodic distances.
+    solute : int
+        Number of solute atoms.
+    waters : int
+        Number of water molecules.
+    natoms_water : int
+        Atoms per water molecule, the first one being the oxygen.
+    nions : int
+        Number of water molecules to pick.
+
+    Returns
+    -------
+    List[int]
+        0-based indices of the picked water molecules.
+    """
+    if nions > waters:
+        raise ValueError(f"Cannot place {nions} ions with {waters} water molecules.")
+
+    box = numpy.asarray(box[:3], dtype=float)
+    oxygens = coords[solute : solute + waters * natoms_water : natoms_water]
+    taken = coords[:solute]
+    min_sq = min_distance**2
+
+    picked = []
+    for water in numpy.random.default_rng(seed).permutation(waters):
+        if len(picked) == nions:
+            break
+        if len(taken):
+            delta = taken - oxygens[water]
+            delta -= box * numpy.round(delta / box)
+            if numpy.einsum("ij,ij->i", delta, delta).min() < min_sq:
+                continue
+        picked.append(int(water))
+        taken = numpy.vstack((taken, oxygens[water]))
+
+    if len(picked) < nions:
+        raise ValueError(
+            f"Only {len(picked)} of {nions} ions fit {min_distance} nm away from the solute and each other."
+        )
+    return picked
+
+
+def replace_with_ions(
+    gro_file: str,
+    out_file: str,
+    solute: int,
+    natoms_water: int,
+    picked: List[int],
+    names: List[str],
+):
+    """
+    Writes gro_file to out_file with the picked water molecules replaced by
+    ions, names[i] being put at the oxygen of picked[i]. The ions follow the
+    remaining waters, grouped by name in the order of names.
+    """
+    with open(gro_file) as fp:
+        title = fp.readline()
+        natoms = int(fp.readline())
+        lines = [fp.readline() for _ in range(natoms)]
+        box_line = fp.readline()
+
+    removed = set()
+    ions = []
+    for water, name in zip(picked, names):
+        first = solute + water * natoms_water
+        removed.update(range(first, first + natoms_water))
+        ions.append((name, lines[first][20:44]))
+    ions.sort(key=lambda ion: names.index(ion[0]))
+
+    atoms = [line for i, line in enumerate(lines) if i not in removed]
+    resnr = int(atoms[-1][:5]) if atoms else 0
+    for name, xyz in ions:
+        resnr += 1
+        atoms.append(f"{resnr % 100000:5d}{name:<5s}{name:>5s}{0:5d}{xyz}\n")
+
+    with open(out_file, "w") as fp:
+        fp.write(title)
+        fp.write(f"{len(atoms):5d}\n")
+        fp.writelines(
+            f"{line[:15]}{(i + 1) % 100000:5d}{line[20:]}"
+            for i, line in enumerate(atoms)
+        )
+        fp.write(box_line)
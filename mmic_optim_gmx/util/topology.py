@@ -0,0 +1,330 @@
+"""
+Helpers for reading and editing gmx topology (.top) files.
+"""
+from typing import Dict, Iterable, List, Tuple
+import collections
+
+__all__ = [
+    "read_molecules",
+    "system_charge",
+    "add_position_restraints",
+    "merge_topologies",
+    "add_molecule_types",
+]
+
+# System wide parameter directives, shared by all the molecule types
+_global_directives = (
+    "defaults",
+    "atomtypes",
+    "bondtypes",
+    "pairtypes",
+    "angletypes",
+    "constrainttypes",
+    "dihedraltypes",
+    "nonbond_params",
+    "cmaptypes",
+)
+
+
+def _directive(line: str):
+    line = line.split(";")[0].strip()
+    if line.startswith("[") and line.endswith("]"):
+        return line[1:-1].strip().lower()
+    return None
+
+
+def _data(line: str) -> List[str]:
+    line = line.split(";")[0].strip()
+    if not line or line.startswith("#"):
+        return []
+    return line.split()
+
+
+def read_molecules(top_file: str) -> Tuple[Dict[str, int], List[Tuple[str, int]]]:
+    """
+    Reads the molecule types of a self-contained .top file.
+
+    Returns
+    -------
+    Tuple[Dict[str, int], List[Tuple[str, int]]]
+        The number of atoms of each [ moleculetype ] and the
+        (name, count) entries of [ molecules ], in order.
+    """
+    natoms, molecules = {}, []
+    directive, moltype = None, None
+
+    with open(top_file) as fp:
+        for line in fp:
+            name = _directive(line)
+            if name:
+                directive = name
+                continue
+            data = _data(line)
+            if not data:
+                continue
+            if directive == "moleculetype":
+                moltype = data[0]
+                natoms[moltype] = 0
+            elif directive == "atoms":
+                natoms[moltype] += 1
+            elif directive == "molecules":
+                molecules.append((data[0], int(data[1])))
+
+    return natoms, molecules
+
+
+def system_charge(top_file: str) -> float:
+    """Returns the net charge of the system of a self-contained .top file."""
+    charges, molecules = {}, []
+    directive, moltype = None, None
+
+    with open(top_file) as fp:
+        for line in fp:
+            name = _directive(line)
+            if name:
+                directive = name
+                continue
+            data = _data(line)
+            if not data:
+                continue
+            if directive == "moleculetype":
+                moltype = data[0]
+                charges[moltype] = 0.0
+            elif directive == "atoms":
+                charges[moltype] += float(data[6])
+            elif directive == "molecules":
+                molecules.append((data[0], int(data[1])))
+
+    return sum(charges[moltype] * count for moltype, count in molecules)
+
+
+def add_molecule_types(
+    top_file: str,
+    atomtypes: List[str],
+    moltypes: List[str],
+    molecules: List[Tuple[str, int]],
+):
+    """
+    Adds atom types, [ moleculetype ] blocks and [ molecules ] entries,
+    e.g. of a solvent, to a self-contained .top file.
+
+    Parameters
+    ----------
+    atomtypes : List[str]
+        Lines of [ atomtypes ].
+    moltypes : List[str]
+        [ moleculetype ] blocks, each one a string.
+    molecules : List[Tuple[str, int]]
+        (name, count) entries appended to [ molecules ].
+    """
+    with open(top_file) as fp:
+        lines = fp.readlines()
+
+    # A topology without [ atomtypes ] gets one right after [ defaults ]
+    missing = bool(atomtypes) and not any(
+        _directive(line) == "atomtypes" for line in lines
+    )
+
+    out, directive = [], None
+    for line in lines:
+        name = _directive(line)
+        if missing and name and name != "defaults":
+            out.append("[ atomtypes ]\n")
+            out.extend(atomtype + "\n" for atomtype in atomtypes)
+            out.append("\n")
+            missing = False
+        if name == "system":
+            out.extend(block + "\n" for block in moltypes)
+        out.append(line)
+        if name:
+            directive = name
+            if name == "atomtypes":
+                out.extend(atomtype + "\n" for atomtype in atomtypes)
+
+    if out and not out[-1].endswith("\n"):
+        out[-1] += "\n"
+    out.extend(f"{name:<16s}{count:>8d}\n" for name, count in molecules if count)
+
+    with open(top_file, "w") as fp:
+        fp.writelines(out)
+
+
+def add_position_restraints(
+    top_file: str,
+    indices: Iterable[int],
+    fc: float,
+    define: str = "POSRES_MMIC",
+):
+    """
+    Adds position restraints on the atoms with the given 0-based system
+    indices to the corresponding molecule types of top_file. The restraints
+    are only active if define is set in the .mdp file. Restrained atoms must
+    belong to molecules that appear once in the system, otherwise all the
+    copies would be restrained.
+    """
+    natoms, molecules = read_molecules(top_file)
+
+    restraints, start = {}, 0
+    indices = sorted(set(indices))
+    copies = collections.Counter()
+    for moltype, count in molecules:
+        copies[moltype] += count
+    for moltype, count in molecules:
+        stop = start + natoms[moltype] * count
+        local = [i - start for i in indices if start <= i < stop]
+        if local:
+            if copies[moltype] > 1:
+                raise ValueError(
+                    f"Cannot restrain atoms of {moltype!r}, it appears {copies[moltype]} times in the system."
+                )
+            restraints[moltype] = local
+        start = stop
+
+    if indices and indices[-1] >= start:
+        raise ValueError(
+            f"Atom index {indices[-1]} is out of range for a system of {start} atoms."
+        )
+
+    def block(local):
+        lines = [f"\n#ifdef {define}\n", "[ position_restraints ]\n"]
+        lines += [f"{i + 1:6d}     1 {fc} {fc} {fc}\n" for i in local]
+        lines.append("#endif\n\n")
+        return lines
+
+    with open(top_file) as fp:
+        lines = fp.readlines()
+
+    # Restraints go at the end of their [ moleculetype ] i.e. right before
+    # the next moleculetype or the [ system ] directive
+    out, moltype, directive = [], None, None
+    for line in lines:
+        name = _directive(line)
+        if name in ("moleculetype", "system") and moltype in restraints:
+            out.extend(block(restraints.pop(moltype)))
+        if name:
+            directive = name
+        elif directive == "moleculetype" and _data(line):
+            moltype = _data(line)[0]
+        out.append(line)
+
+    with open(top_file, "w") as fp:
+        fp.writelines(out)
+
+
+def _read_sections(top_file: str):
+    """
+    Splits a self-contained .top file into its system wide parameters
+    {directive: [lines]}, its [ moleculetype ] blocks [(name, lines)] and
+    the (name, count) entries of [ molecules ].
+    """
+    params = collections.OrderedDict()
+    moltypes, molecules = [], []
+    directive, block = None, None
+
+    with open(top_file) as fp:
+        for line in fp:
+            name = _directive(line)
+            if name:
+                directive = name
+                if name == "moleculetype":
+                    block = [line]
+                    moltypes.append([None, block])
+                    continue
+                if name in _global_directives or name in ("system", "molecules"):
+                    block = None
+                    continue
+            if block is not None:
+                if moltypes[-1][0] is None and directive == "moleculetype":
+                    data = _data(line)
+                    if data:
+                        moltypes[-1][0] = data[0]
+                block.append(line)
+                continue
+            data = _data(line)
+            if not data:
+                continue
+            if directive in _global_directives:
+                params.setdefault(directive, []).append(" ".join(data))
+            elif directive == "molecules":
+                molecules.append((data[0], int(data[1])))
+
+    return params, [tuple(moltype) for moltype in moltypes], molecules
+
+
+def merge_topologies(top_files: List[str], out_file: str, title: str = "mmic system"):
+    """
+    Merges the self-contained .top files of several molecules into one.
+    The system wide parameters must agree between the files, identical
+    molecule types are defined once and shared, and the [ molecules ]
+    entries follow the order of top_files.
+
+    Parameters
+    ----------
+    top_files : List[str]
+        The .top files, e.g. one per molecule of the system.
+    out_file : str
+        Path of the merged .top file.
+    title : str
+        Name of the [ system ].
+    """
+    params = collections.OrderedDict()
+    moltypes = collections.OrderedDict()  # name -> lines
+    molecules = []
+
+    for top_file in top_files:
+        file_params, file_moltypes, file_molecules = _read_sections(top_file)
+
+        for directive, lines in file_params.items():
+            merged = params.setdefault(directive, collections.OrderedDict())
+            for line in lines:
+                # Atom types must have the same parameters in every file
+                key = line.split()[0] if directive == "atomtypes" else line
+                if key in merged and merged[key] != line:
+                    raise ValueError(
+                        f"Conflicting [ {directive} ] entries for {key!r} in {top_file}."
+                    )
+                merged[key] = line
+        if len(params.get("defaults", {})) > 1:
+            raise ValueError(f"[ defaults ] of {top_file} differ from the other files.")
+
+        renamed = {}
+        for name, lines in file_moltypes:
+            new_name, k = name, 1
+            while new_name in moltypes and moltypes[new_name] != _rename(
+                lines, new_name
+            ):
+                k += 1
+                new_name = f"{name}_{k}"
+            moltypes[new_name] = _rename(lines, new_name)
+            renamed[name] = new_name
+
+        for name, count in file_molecules:
+            name = renamed.get(name, name)
+            if molecules and molecules[-1][0] == name:
+                molecules[-1] = (name, molecules[-1][1] + count)
+            else:
+                molecules.append((name, count))
+
+    with open(out_file, "w") as fp:
+        fp.write("; Topology assembled by mmic_optim_gmx\n\n")
+        for directive, lines in params.items():
+            fp.write(f"[ {directive} ]\n")
+            fp.writelines(line + "\n" for line in lines.values())
+            fp.write("\n")
+        for lines in moltypes.values():
+            fp.writelines(lines)
+            fp.write("\n")
+        fp.write(f"[ system ]\n{title}\n\n[ molecules ]\n")
+        fp.writelines(f"{name:<16s}{count:>8d}\n" for name, count in molecules)
+
+
+def _rename(lines: List[str], name: str) -> List[str]:
+    """Returns the lines of a [ moleculetype ] block with the molecule type renamed."""
+    out, done = [], False
+    for line in lines:
+        data = _data(line)
+        if not done and data and not _directive(line):
+            line = line.replace(data[0], name, 1)
+            done = True
+        out.append(line)
+    return out
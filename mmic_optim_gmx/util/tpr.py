@@ -0,0 +1,78 @@
+"""
+Cache of the run input (.tpr) files written by grompp.
+
+A cached .tpr is keyed by the content of all the grompp inputs except
+nsteps. A rerun of the same system which only changes the number of
+steps gets its .tpr from gmx convert-tpr instead of a full grompp.
+"""
+from typing import Iterable, Optional, Tuple
+import glob
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+
+__all__ = ["TprCache", "tpr_key"]
+
+_nsteps = re.compile(r"^\s*nsteps\s*=\s*(-?\d+)\s*$", re.MULTILINE)
+
+
+def tpr_key(
+    mdp_file: str, files: Iterable[Optional[str]], extra: str = ""
+) -> Tuple[str, Optional[int]]:
+    """
+    Returns the cache key of a grompp run and the nsteps of mdp_file.
+
+    Parameters
+    ----------
+    mdp_file : str
+        The .mdp file, hashed without its nsteps line.
+    files : Iterable[str]
+        The other input files e.g. .gro, .top and .ndx, None for a missing one.
+    extra : str
+        Anything else grompp depends on e.g. the gmx version.
+    """
+    with open(mdp_file) as fp:
+        mdp = fp.read()
+    match = _nsteps.search(mdp)
+    nsteps = int(match.group(1)) if match else None
+
+    digest = hashlib.sha256(_nsteps.sub("", mdp).encode())
+    for path in files:
+        digest.update(b"\0")
+        if path:
+            with open(path, "rb") as fp:
+                for chunk in iter(lambda: fp.read(1 << 20), b""):
+                    digest.update(chunk)
+    digest.update(b"\0" + extra.encode())
+    return digest.hexdigest(), nsteps
+
+
+class TprCache:
+    """Directory of .tpr files named after their key and nsteps."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str, nsteps: Optional[int]) -> str:
+        return os.path.join(self.directory, f"{key}.n{nsteps}.tpr")
+
+    def get(self, key: str, nsteps: Optional[int]) -> Tuple[Optional[str], bool]:
+        """
+        Returns a cached .tpr of key, None if there is none, and whether it
+        has the requested nsteps.
+        """
+        path = self._path(key, nsteps)
+        if os.path.isfile(path):
+            return path, True
+        others = glob.glob(os.path.join(self.directory, f"{key}.n*.tpr"))
+        return (others[0], False) if others else (None, False)
+
+    def put(self, key: str, nsteps: Optional[int], tpr_file: str):
+        """Adds a copy of tpr_file to the cache."""
+        fd, tmp_file = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        os.close(fd)
+        shutil.copyfile(tpr_file, tmp_file)
+        os.replace(tmp_file, self._path(key, nsteps))
@@ -0,0 +1,300 @@
+"""
+Frame index for gmx trajectories (.trr and .xtc).
+
+The frame headers are scanned once and the frame offsets are saved in a
+sidecar file next to the trajectory. Frames can then be accessed in O(1)
+without reading the rest of the file: .trr coordinates are mapped straight
+from a memory map of the file, compressed .xtc frames are decoded one at a
+time by MDAnalysis.
+"""
+from typing import Optional
+import os
+import struct
+import tempfile
+import numpy
+
+__all__ = ["TrajectoryIndex"]
+
+_TRR_MAGIC = 1993
+_XTC_MAGIC = 1995
+
+# Fields of a .trr frame header, after the version string
+_trr_fields = (
+    "ir_size",
+    "e_size",
+    "box_size",
+    "vir_size",
+    "pres_size",
+    "top_size",
+    "sym_size",
+    "x_size",
+    "v_size",
+    "f_size",
+    "natoms",
+    "step",
+    "nre",
+)
+
+
+def _pad4(n: int) -> int:
+    return (n + 3) // 4 * 4
+
+
+class TrajectoryIndex:
+    """
+    Random access to the frames of a .trr or .xtc file.
+
+    Use :meth:`TrajectoryIndex.build` to create it. The steps and times of
+    all the frames are available as arrays, coordinates and boxes are read
+    on demand, in nm.
+    """
+
+    _arrays = ("offsets", "steps", "times", "x_offsets", "box_offsets")
+
+    def __init__(
+        self,
+        traj_file: str,
+        fmt: str,
+        natoms: int,
+        precision: int,
+        offsets: numpy.ndarray,
+        steps: numpy.ndarray,
+        times: numpy.ndarray,
+        x_offsets: numpy.ndarray,
+        box_offsets: numpy.ndarray,
+    ):
+        self.traj_file = traj_file
+        self.format = fmt
+        self.natoms = natoms
+        self.precision = precision
+        self.offsets = offsets
+        self.steps = steps
+        self.times = times
+        self.x_offsets = x_offsets
+        self.box_offsets = box_offsets
+        self._mmap = None
+        self._xtc = None
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    @property
+    def _dtype(self) -> str:
+        return ">f4" if self.precision == 4 else ">f8"
+
+    @staticmethod
+    def sidecar(traj_file: str) -> str:
+        """Returns the path of the index file that goes with traj_file."""
+        dirname, basename = os.path.split(os.path.abspath(traj_file))
+        return os.path.join(dirname, f".{basename}.mmic_idx.npz")
+
+    @classmethod
+    def build(cls, traj_file: str, sidecar: bool = True) -> "TrajectoryIndex":
+        """
+        Returns the index of traj_file. If sidecar is True, the index is
+        loaded from the sidecar file when it is up to date, otherwise the
+        frame headers are scanned and the sidecar file is (re)written.
+        """
+        fmt = os.path.splitext(traj_file)[1].lower().lstrip(".")
+        if fmt not in ("trr", "xtc"):
+            raise ValueError(
+                f"Cannot index {traj_file}, only trr and xtc are supported."
+            )
+
+        stat = os.stat(traj_file)
+        idx_file = cls.sidecar(traj_file)
+
+        if sidecar and os.path.isfile(idx_file):
+            with numpy.load(idx_file) as data:
+                if (
+                    int(data["size"]) == stat.st_size
+                    and float(data["mtime"]) == stat.st_mtime
+                ):
+                    return cls(
+                        traj_file,
+                        fmt,
+                        int(data["natoms"]),
+                        int(data["precision"]),
+                        **{key: data[key] for key in cls._arrays},
+                    )
+
+        scan = cls._scan_trr if fmt == "trr" else cls._scan_xtc
+        index = scan(traj_file, stat.st_size)
+
+        if sidecar:
+            try:
+                index.save(idx_file, stat)
+            except OSError:
+                pass  # e.g. read-only directory, the index still works
+
+        return index
+
+    def save(self, idx_file: str, stat: Optional[os.stat_result] = None):
+        """Writes the index to idx_file."""
+        stat = stat or os.stat(self.traj_file)
+        fd, tmp_file = tempfile.mkstemp(
+            suffix=".tmp.npz", dir=os.path.dirname(idx_file)
+        )
+        with os.fdopen(fd, "wb") as fp:
+            numpy.savez(
+                fp,
+                size=stat.st_size,
+                mtime=stat.st_mtime,
+                natoms=self.natoms,
+                precision=self.precision,
+                **{key: getattr(self, key) for key in self._arrays},
+            )
+        os.replace(tmp_file, idx_file)
+
+    @classmethod
+    def _scan_trr(cls, traj_file: str, size: int) -> "TrajectoryIndex":
+        offsets, steps, times, x_offsets, box_offsets = [], [], [], [], []
+        natoms, precision = 0, 4
+
+        with open(traj_file, "rb") as fp:
+            offset = 0
+            while offset + 12 <= size:
+                fp.seek(offset)
+                magic, _, slen = struct.unpack(">iii", fp.read(12))
+                if magic != _TRR_MAGIC:
+                    raise ValueError(f"{traj_file} is not a valid trr file.")
+                fp.seek(_pad4(slen), os.SEEK_CUR)
+                header = fp.read(52)
+                if len(header) < 52:
+                    break
+                header = dict(zip(_trr_fields, struct.unpack(">13i", header)))
+
+                natoms = header["natoms"]
+                if header["box_size"]:
+                    precision = header["box_size"] // 9
+                elif header["x_size"]:
+                    precision = header["x_size"] // (3 * natoms)
+                elif header["v_size"]:
+                    precision = header["v_size"] // (3 * natoms)
+                elif header["f_size"]:
+                    precision = header["f_size"] // (3 * natoms)
+
+                real = "f" if precision == 4 else "d"
+                times_data = fp.read(2 * precision)
+                if len(times_data) < 2 * precision:
+                    break
+                time, _ = struct.unpack(">" + real * 2, times_data)
+
+                data = fp.tell()
+                data += header["ir_size"] + header["e_size"]
+                data += header["top_size"] + header["sym_size"]
+                box = data if header["box_size"] else -1
+                data += header["box_size"] + header["vir_size"] + header["pres_size"]
+                x = data if header["x_size"] else -1
+                data += header["x_size"] + header["v_size"] + header["f_size"]
+                if data > size:
+                    # Last frame cut short e.g. by a killed mdrun
+                    break
+
+                offsets.append(offset)
+                steps.append(header["step"])
+                times.append(time)
+                x_offsets.append(x)
+                box_offsets.append(box)
+                offset = data
+
+        return cls(
+            traj_file,
+            "trr",
+            natoms,
+            precision,
+            numpy.array(offsets, dtype=numpy.int64),
+            numpy.array(steps, dtype=numpy.int64),
+            numpy.array(times, dtype=float),
+            numpy.array(x_offsets, dtype=numpy.int64),
+            numpy.array(box_offsets, dtype=numpy.int64),
+        )
+
+    @classmethod
+    def _scan_xtc(cls, traj_file: str, size: int) -> "TrajectoryIndex":
+        offsets, steps, times, x_offsets, box_offsets = [], [], [], [], []
+        natoms = 0
+
+        with open(traj_file, "rb") as fp:
+            offset = 0
+            while offset + 16 <= size:
+                fp.seek(offset)
+                magic, natoms, step, time = struct.unpack(">iiif", fp.read(16))
+                if magic != _XTC_MAGIC:
+                    raise ValueError(f"{traj_file} is not a valid xtc file.")
+
+                if natoms <= 9:
+                    # Small systems are stored uncompressed
+                    x = offset + 56
+                    data = x + 12 * natoms
+                else:
+                    x = -1
+                    fp.seek(offset + 88)
+                    nbytes = fp.read(4)
+                    if len(nbytes) < 4:
+                        break
+                    data = offset + 92 + _pad4(struct.unpack(">i", nbytes)[0])
+                if data > size:
+                    # Last frame cut short e.g. by a killed mdrun
+                    break
+
+                offsets.append(offset)
+                steps.append(step)
+                times.append(time)
+                x_offsets.append(x)
+                box_offsets.append(offset + 16)
+                offset = data
+
+        return cls(
+            traj_file,
+            "xtc",
+            natoms,
+            4,
+            numpy.array(offsets, dtype=numpy.int64),
+            numpy.array(steps, dtype=numpy.int64),
+            numpy.array(times, dtype=float),
+            numpy.array(x_offsets, dtype=numpy.int64),
+            numpy.array(box_offsets, dtype=numpy.int64),
+        )
+
+    def _view(self, offset: int, shape) -> numpy.ndarray:
+        if self._mmap is None:
+            self._mmap = numpy.memmap(self.traj_file, dtype=numpy.uint8, mode="r")
+        return numpy.ndarray(shape, dtype=self._dtype, buffer=self._mmap, offset=offset)
+
+    def box(self, frame: int) -> Optional[numpy.ndarray]:
+        """Returns the (3, 3) box of a frame in nm, None if the frame has no box."""
+        offset = self.box_offsets[frame]
+        if offset < 0:
+            return None
+        return self._view(offset, (3, 3)).astype(float)
+
+    def positions(self, frame: int) -> Optional[numpy.ndarray]:
+        """Returns the (natoms, 3) coordinates of a frame in nm, None if the frame has none."""
+        offset = self.x_offsets[frame]
+        if offset >= 0:
+            return self._view(offset, (self.natoms, 3)).astype(float)
+        if self.format == "trr":
+            return None
+
+        # Compressed xtc frame, decoded by MDAnalysis from the known offset
+        if self._xtc is None:
+            from MDAnalysis.lib.formats.libmdaxdr import XTCFile
+
+            self._xtc = XTCFile(self.traj_file)
+            self._xtc.set_offsets(self.offsets)
+        self._xtc.seek(frame)
+        return numpy.array(self._xtc.read().x, dtype=float)
+
+    def frame_at_step(self, step: int) -> int:
+        """Returns the index of the frame written at the given step."""
+        frames = numpy.flatnonzero(self.steps == step)
+        if not len(frames):
+            raise KeyError(f"No frame at step {step} in {self.traj_file}.")
+        return int(frames[0])
+
+    def close(self):
+        self._mmap = None
+        if self._xtc is not None:
+            self._xtc.close()
+            self._xtc = None
@@ -0,0 +1,72 @@
+"""
+Allocation of the files written by a job.
+
+Every file is created atomically with a unique name, or given a random
+name for the tools which refuse to overwrite a file, so jobs running in
+concurrent threads or processes never share a path. A job gets its own
+private directory, removed with everything left in it when the job ends.
+"""
+from typing import Optional
+import os
+import shutil
+import tempfile
+import uuid
+
+__all__ = ["Workspace", "new_file", "new_path"]
+
+
+def new_file(suffix: str, work_dir: Optional[str] = None) -> str:
+    """
+    Creates an empty file with a unique name and returns its path.
+
+    Parameters
+    ----------
+    suffix : str
+        Extension of the file e.g. ".gro".
+    work_dir : str, Optional
+        Directory of the file, the system temp directory if None.
+    """
+    fd, path = tempfile.mkstemp(suffix=suffix, dir=work_dir)
+    os.close(fd)
+    return path
+
+
+def new_path(suffix: str, work_dir: Optional[str] = None) -> str:
+    """
+    Returns a unique path of a file which does not exist yet, for the
+    writers which refuse to overwrite a file e.g. ParmEd.
+
+    Parameters
+    ----------
+    suffix : str
+        Extension of the file e.g. ".gro".
+    work_dir : str, Optional
+        Directory of the file, the system temp directory if None.
+    """
+    return os.path.join(
+        work_dir or tempfile.gettempdir(), f"tmp{uuid.uuid4().hex}{suffix}"
+    )
+
+
+class Workspace:
+    """
+    Private directory of a job, used as a context manager:
+
+        with Workspace() as work_dir:
+            gro_file = new_file(".gro", work_dir)
+    """
+
+    def __init__(self, root: Optional[str] = None):
+        self.path = tempfile.mkdtemp(prefix="mmic_optim_gmx_", dir=root)
+
+    def new_file(self, suffix: str) -> str:
+        return new_file(suffix, self.path)
+
+    def close(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self) -> str:
+        return self.path
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,229 @@
+"""
+worker.py
+Long-lived worker serving energy minimizations over JSON-RPC 2.0.
+
+The worker imports the mmic stack, the translators and probes gmx once at
+start-up, so each request only pays for the minimization itself. Requests
+and responses are newline delimited JSON objects, read from stdin/written
+to stdout or exchanged over a Unix socket:
+
+    {"jsonrpc": "2.0", "id": 1, "method": "compute", "params": {...InputOptim...}}
+
+Since molecules cannot be JSON keys, "system" is given as a list of
+[molecule, forcefield] pairs. "compute_npz" takes the same params and
+returns the whole output as a base64 encoded .npz archive, see
+util.serialize, much smaller and faster to decode than JSON for large
+systems.
+"""
+from typing import Any, Dict, Optional, TextIO
+import argparse
+import base64
+import importlib
+import inspect
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+import traceback
+
+from .util.gmx import probe_gmx
+
+__all__ = ["Worker", "serve_stdio", "serve_unix"]
+
+# JSON-RPC 2.0 error codes
+_PARSE_ERROR = -32700
+_INVALID_REQUEST = -32600
+_METHOD_NOT_FOUND = -32601
+_INVALID_PARAMS = -32602
+_SERVER_ERROR = -32000
+
+# Modules loaded at start-up if installed, the translators are
+# otherwise imported by mmelemental on the first file read/write
+_warm_modules = (
+    "mmic_optim_gmx.models",
+    "mmic_optim_gmx.components.gmx_optim_component",
+    "mmelemental.models",
+    "mmic_parmed",
+    "mmic_mda",
+)
+
+
+class Worker:
+    """Dispatches JSON-RPC requests to OptimGmxComponent."""
+
+    def __init__(self, engine: str = "gmx"):
+        self.engine = engine
+        self.started = time.time()
+        self.served = 0
+        self._lock = threading.Lock()  # Requests are served by several threads
+        self.modules = {}
+        for name in _warm_modules:
+            try:
+                self.modules[name] = importlib.import_module(name)
+            except ImportError:
+                pass
+        self.gmx = probe_gmx(engine)
+        self.running = True
+
+    # Methods callable over JSON-RPC
+    def ping(self) -> str:
+        return "pong"
+
+    def capabilities(self) -> Dict[str, Any]:
+        return {
+            "gmx": self.gmx,
+            "modules": sorted(self.modules),
+            "uptime": time.time() - self.started,
+            "served": self.served,
+        }
+
+    def compute(self, **params) -> Dict[str, Any]:
+        outputs = self._compute(params)
+        # proc_input holds molecules as dict keys, which JSON cannot represent
+        return json.loads(outputs.json(exclude={"proc_input"}))
+
+    def compute_npz(self, **params) -> Dict[str, Any]:
+        from .util.serialize import dumps_output
+
+        outputs = self._compute(params)
+        return {
+            "format": "npz",
+            "data": base64.b64encode(dumps_output(outputs)).decode(),
+        }
+
+    def _compute(self, params: Dict[str, Any]) -> Any:
+        from mmelemental.models import Molecule, ForceField
+        from .components import OptimGmxComponent
+
+        system = params.get("system")
+        if isinstance(system, list):
+            # The caller's params are left untouched
+            params = {
+                **params,
+                "system": {Molecule(**mol): ForceField(**ff) for mol, ff in system},
+            }
+
+        outputs = OptimGmxComponent.compute(params)
+        with self._lock:
+            self.served += 1
+        return outputs
+
+    def shutdown(self) -> bool:
+        self.running = False
+        return True
+
+    _methods = ("ping", "capabilities", "compute", "compute_npz", "shutdown")
+
+    def handle(self, line: str) -> Optional[str]:
+        """Handles a single JSON-RPC request, returns the response line or None for notifications."""
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return self._error(None, _PARSE_ERROR, str(e))
+
+        if not isinstance(request, dict) or "method" not in request:
+            return self._error(None, _INVALID_REQUEST, "Not a JSON-RPC request.")
+
+        response = self._dispatch(request)
+        # Notifications are never answered, not even when they fail
+        if "id" not in request:
+            return None
+        return response
+
+    def _dispatch(self, request: Dict[str, Any]) -> str:
+        rid, method = request.get("id"), request["method"]
+        params = request.get("params") or {}
+
+        if method not in self._methods:
+            return self._error(rid, _METHOD_NOT_FOUND, f"Unknown method {method!r}.")
+        if not isinstance(params, dict):
+            return self._error(rid, _INVALID_PARAMS, "params must be an object.")
+
+        func = getattr(self, method)
+        try:
+            inspect.signature(func).bind(**params)
+        except TypeError as e:
+            return self._error(rid, _INVALID_PARAMS, str(e))
+
+        try:
+            result = func(**params)
+        except Exception as e:
+            return self._error(
+                rid,
+                _SERVER_ERROR,
+                str(e),
+                {"type": type(e).__name__, "traceback": traceback.format_exc()},
+            )
+        return json.dumps({"jsonrpc": "2.0", "id": rid, "result": result})
+
+    @staticmethod
+    def _error(rid, code: int, message: str, data: Optional[Dict] = None) -> str:
+        error = {"code": code, "message": message}
+        if data:
+            error["data"] = data
+        return json.dumps({"jsonrpc": "2.0", "id": rid, "error": error})
+
+
+def serve_stdio(worker: Worker, stdin: TextIO = sys.stdin, stdout: TextIO = sys.stdout):
+    """Serves requests read line by line from stdin until EOF or shutdown."""
+    for line in stdin:
+        if not line.strip():
+            continue
+        response = worker.handle(line)
+        if response is not None:
+            stdout.write(response + "\n")
+            stdout.flush()
+        if not worker.running:
+            break
+
+
+def serve_unix(worker: Worker, path: str):
+    """Serves requests on a Unix socket, one thread per connection."""
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                response = worker.handle(line.decode())
+                if response is not None:
+                    self.wfile.write(response.encode() + b"\n")
+                    self.wfile.flush()
+                if not worker.running:
+                    # shutdown() blocks until serve_forever returns
+                    threading.Thread(target=server.shutdown).start()
+                    break
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    with socketserver.ThreadingUnixStreamServer(path, Handler) as server:
+        server.daemon_threads = True
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "--socket", help="Path of the Unix socket to listen on, stdio if not set."
+    )
+    parser.add_argument("--engine", default="gmx", help="gmx executable to use.")
+    args = parser.parse_args(argv)
+
+    worker = Worker(engine=args.engine)
+    if args.socket:
+        serve_unix(worker, args.socket)
+    else:
+        # Responses go to the real stdout, anything printed while
+        # computing is sent to stderr so the stream stays valid JSON
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        serve_stdio(worker, sys.stdin, stdout)
+
+
+if __name__ == "__main__":
+    main()